@@ -0,0 +1,348 @@
+from __future__ import print_function
+import os
+import json
+import struct
+import tempfile
+import zipfile
+from io import BytesIO
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+from compile_cache import get_net_shared, get_shared_inputs
+
+# Checkpoints are uncompressed zip files with the architecture (ARCH_MEMBER) and
+# one npy member per parameter, aligned to ALIGN bytes so they can be memory-mapped.
+FORMAT_VERSION = 1
+ARCH_MEMBER = 'arch.json'
+STATE_MEMBER = 'state.json'
+ALIGN = 64
+# Header id of the zip extra field used for padding (the one used by zipalign)
+PADDING_ID = 0xD935
+
+
+def get_layers(net):
+    # Layers of a NeuralNet (keyed by the names used by load_params_from) or of a lasagne graph
+    if hasattr(net, 'layers_'):
+        net.initialize()
+        return net.layers_.values()
+    from lasagne.layers import get_all_layers
+    return get_all_layers(net)
+
+
+def npy_bytes(value):
+    f = BytesIO()
+    np.lib.format.write_array(f, np.asarray(value), version=(1, 0))
+    data = f.getvalue()
+    # Length of the npy header (the array data starts after it)
+    f.seek(0)
+    read_array_header(f)
+    return data, f.tell()
+
+
+def read_array_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def write_aligned(zf, name, value):
+    data, header_length = npy_bytes(value)
+    info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_STORED
+    info.external_attr = 0o644 << 16
+    data_offset = zf.fp.tell() + zipfile.sizeFileHeader + len(name) + header_length
+    padding = -data_offset % ALIGN
+    if 0 < padding < 4:
+        padding += ALIGN
+    if padding:
+        info.extra = struct.pack('<HH', PADDING_ID, padding - 4) + b'\0' * (padding - 4)
+    zf.writestr(info, data)
+
+
+def read_member(zf, member):
+    # Memory-mapped array (when possible) of a npy member of an open zip file
+    info = zf.getinfo(member)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return np.lib.format.read_array(BytesIO(zf.read(member)))
+    with open(zf.filename, 'rb') as f:
+        # The data of the member starts after its local header (name and extra field included)
+        f.seek(info.header_offset)
+        header = f.read(zipfile.sizeFileHeader)
+        name_length, extra_length = struct.unpack('<2H', header[-4:])
+        f.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+        shape, fortran_order, dtype = read_array_header(f)
+        offset = f.tell()
+    if dtype.hasobject or not shape or not np.prod(shape):
+        return np.lib.format.read_array(BytesIO(zf.read(member)))
+    return np.memmap(
+        zf.filename, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C', offset=offset
+    )
+
+
+@contextmanager
+def atomic_zip(filename):
+    # The zip file is written to a temporary file that replaces filename when it is complete
+    directory = os.path.dirname(os.path.abspath(filename))
+    f_tmp = tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False)
+    try:
+        with f_tmp:
+            with zipfile.ZipFile(f_tmp, 'w', zipfile.ZIP_STORED) as zf:
+                yield zf
+        os.rename(f_tmp.name, filename)
+    except:
+        os.remove(f_tmp.name)
+        raise
+
+
+def save_checkpoint(net, filename):
+    """
+    Writes the parameters of a NeuralNet (or a lasagne graph) and a JSON
+    description of its layers into a checkpoint. Parameters shared by
+    several layers are only stored once. The file is written to a
+    temporary file that replaces filename when it is complete.
+    """
+    layers = get_layers(net)
+    members = dict()
+    arch = list()
+    with atomic_zip(filename) as zf:
+        for i, layer in enumerate(layers):
+            params = list()
+            for j, param in enumerate(layer.get_params()):
+                value = param.get_value(borrow=True)
+                if param not in members:
+                    members[param] = 'params/%d_%d.npy' % (i, j)
+                    write_aligned(zf, members[param], value)
+                params.append({
+                    'name': param.name,
+                    'member': members[param],
+                    'shape': list(value.shape),
+                    'dtype': str(value.dtype),
+                    'tags': sorted(layer.params.get(param, []))
+                })
+            incomings = layer.input_layers if hasattr(layer, 'input_layers') else\
+                [getattr(layer, 'input_layer', None)]
+            arch.append({
+                'name': layer.name,
+                'type': type(layer).__name__,
+                'output_shape': list(layer.output_shape),
+                'incomings': [l.name for l in incomings if l is not None],
+                'params': params
+            })
+        zf.writestr(ARCH_MEMBER, json.dumps({'version': FORMAT_VERSION, 'layers': arch}))
+
+
+class Checkpoint(object):
+    """
+    Read access to a checkpoint written by save_checkpoint. Only the
+    architecture is read when it is opened. The parameters of each layer
+    are memory-mapped when that layer is accessed (checkpoint[name] returns
+    the values in the order of layer.get_params()). It works like the
+    dictionaries of NeuralNet.get_all_params_values, so it can be passed
+    to NeuralNet.load_params_from.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.zf = zipfile.ZipFile(filename, 'r')
+        arch = json.loads(self.zf.read(ARCH_MEMBER).decode('utf-8'))
+        if arch['version'] > FORMAT_VERSION:
+            raise ValueError('Unknown checkpoint version %d in %s' % (arch['version'], filename))
+        self.version = arch['version']
+        self.layers = arch['layers']
+        self.index = dict((layer['name'], layer) for layer in self.layers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.zf.close()
+
+    def keys(self):
+        return [layer['name'] for layer in self.layers]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return [self.get_array(param['member']) for param in self.index[name]['params']]
+
+    def items(self):
+        for name in self.keys():
+            yield name, self[name]
+
+    def get_array(self, member):
+        return read_member(self.zf, member)
+
+
+def load_weights(net, filename):
+    """
+    Loads the parameters of a checkpoint into a NeuralNet (by layer name,
+    like load_params_from). Old pickled weights with the same name and the
+    .pkl extension are used if the checkpoint does not exist. Raises
+    IOError if there are no weights or if the training of the net was
+    interrupted (there is an unfinished training state), so the drivers
+    train the net again (and resume it).
+    """
+    state_name = get_state_name(net)
+    if state_name is not None and os.path.isfile(state_name):
+        raise IOError('The training of the net was interrupted (%s)' % state_name)
+    if not os.path.isfile(filename):
+        pkl_name = os.path.splitext(filename)[0] + '.pkl'
+        if os.path.isfile(pkl_name):
+            filename = pkl_name
+    if not zipfile.is_zipfile(filename):
+        net.load_params_from(filename)
+        return
+    with Checkpoint(filename) as checkpoint:
+        net.load_params_from(checkpoint)
+
+
+class SaveCheckpoint(object):
+    """
+    Same as nolearn's SaveWeights, but the weights are saved with save_checkpoint.
+    If net is given, it is saved instead of the net being trained (like the
+    whole net when only its head is trained on cached features).
+    """
+    def __init__(self, path, every_n_epochs=1, only_best=False, verbose=0, net=None):
+        self.path = path
+        self.every_n_epochs = every_n_epochs
+        self.only_best = only_best
+        self.verbose = verbose
+        self.net = net
+
+    def __call__(self, nn, train_history):
+        if self.only_best:
+            this_loss = train_history[-1]['valid_loss']
+            best_loss = min([h['valid_loss'] for h in train_history])
+            if this_loss > best_loss:
+                return
+
+        if train_history[-1]['epoch'] % self.every_n_epochs != 0:
+            return
+
+        path = self.path.format(
+            loss=train_history[-1]['valid_loss'],
+            timestamp=datetime.now().strftime('%Y-%m-%d-%H-%M-%S'),
+            epoch='{:04d}'.format(train_history[-1]['epoch'])
+        )
+        if self.verbose:
+            print('Writing {}'.format(path))
+        save_checkpoint(nn if self.net is None else self.net, path)
+
+
+def get_training_shared(net):
+    # Parameters and state of the update rule and random streams (shared variables updated by
+    # train_iter_ or, if the net is trained by a training.Trainer, by the functions of the trainer)
+    shared = get_net_shared(net)
+    shared_ids = set(id(v) for v in shared)
+    trainer = getattr(net, 'trainer_', None)
+    for v in trainer.get_shared() if trainer is not None else get_shared_inputs(net.train_iter_):
+        if id(v) not in shared_ids:
+            shared_ids.add(id(v))
+            shared.append(v)
+    return shared
+
+
+def get_state_handlers(net):
+    # on_epoch_finished handlers with a state (get_state and set_state)
+    handlers = net.on_epoch_finished if isinstance(net.on_epoch_finished, (list, tuple)) else [net.on_epoch_finished]
+    return [h for h in handlers if hasattr(h, 'get_state') and hasattr(h, 'set_state')]
+
+
+def get_state_name(net):
+    handlers = net.on_epoch_finished if isinstance(net.on_epoch_finished, (list, tuple)) else [net.on_epoch_finished]
+    paths = [h.path for h in handlers if isinstance(h, SaveTrainingState)]
+    return paths[0] if paths else None
+
+
+def to_json(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def save_training_state(net, filename):
+    """
+    Saves everything needed to resume the training of a NeuralNet: the
+    parameters, the shared variables of the update rule and the random
+    streams, train_history_, the state of the on_epoch_finished handlers
+    (like EarlyStopping) and the state of NumPy's random generator.
+    """
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_gauss = np.random.get_state()
+    shared = get_training_shared(net)
+    handlers = list()
+    with atomic_zip(filename) as zf:
+        for i, v in enumerate(shared):
+            write_aligned(zf, 'shared/%d.npy' % i, np.asarray(v.get_value(borrow=True)))
+        for i, handler in enumerate(get_state_handlers(net)):
+            state, arrays = handler.get_state()
+            for j, value in enumerate(arrays):
+                write_aligned(zf, 'handlers/%d_%d.npy' % (i, j), value)
+            handlers.append({'type': type(handler).__name__, 'state': state, 'arrays': len(arrays)})
+        write_aligned(zf, 'rng/keys.npy', rng_keys)
+        zf.writestr(STATE_MEMBER, json.dumps({
+            'version': FORMAT_VERSION,
+            'shared': [v.name for v in shared],
+            'handlers': handlers,
+            'train_history': [dict((k, to_json(v)) for k, v in row.items()) for row in net.train_history_],
+            'rng': [rng_name, rng_pos, rng_has_gauss, rng_gauss]
+        }))
+
+
+def load_training_state(net, filename):
+    # Restores a state saved with save_training_state (the net must have the same architecture)
+    net.initialize()
+    shared = get_training_shared(net)
+    handlers = get_state_handlers(net)
+    with zipfile.ZipFile(filename, 'r') as zf:
+        state = json.loads(zf.read(STATE_MEMBER).decode('utf-8'))
+        if state['version'] > FORMAT_VERSION:
+            raise ValueError('Unknown training state version %d in %s' % (state['version'], filename))
+        if len(state['shared']) != len(shared) or len(state['handlers']) != len(handlers):
+            raise ValueError('The training state %s does not match the net' % filename)
+        values = [read_member(zf, 'shared/%d.npy' % i) for i in range(len(shared))]
+        for v, value in zip(shared, values):
+            if v.get_value(borrow=True).shape != value.shape:
+                raise ValueError('The training state %s does not match the net' % filename)
+        for v, value in zip(shared, values):
+            v.set_value(np.asarray(value, dtype=v.dtype))
+        for i, (handler, handler_state) in enumerate(zip(handlers, state['handlers'])):
+            arrays = [np.array(read_member(zf, 'handlers/%d_%d.npy' % (i, j))) for j in range(handler_state['arrays'])]
+            handler.set_state(handler_state['state'], arrays)
+        rng_name, rng_pos, rng_has_gauss, rng_gauss = state['rng']
+        np.random.set_state((str(rng_name), np.array(read_member(zf, 'rng/keys.npy')), rng_pos, rng_has_gauss, rng_gauss))
+    net.train_history_ = state['train_history']
+    return state
+
+
+def resume_training(net):
+    """
+    Loads the last training state of a net (saved by its SaveTrainingState
+    handler) if there is one and returns the number of epochs left to
+    reach max_epochs (or None if there was no state).
+    """
+    state_name = get_state_name(net)
+    if state_name is None or not os.path.isfile(state_name):
+        return None
+    load_training_state(net, state_name)
+    return net.max_epochs - len(net.train_history_)
+
+
+class SaveTrainingState(object):
+    """
+    on_epoch_finished handler that saves the training state every
+    every_n_epochs epochs. finish (an on_training_finished handler) removes
+    it when the training ends.
+    """
+    def __init__(self, path, every_n_epochs=10):
+        self.path = path
+        self.every_n_epochs = every_n_epochs
+
+    def __call__(self, nn, train_history):
+        if train_history[-1]['epoch'] % self.every_n_epochs == 0:
+            save_training_state(nn, self.path)
+
+    def finish(self, nn=None, train_history=None):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -0,0 +1,255 @@
+import os
+import sys
+import hashlib
+import pickle
+import tempfile
+import types
+import numpy as np
+import theano
+from theano.compile import SharedVariable
+from theano.sandbox.rng_mrg import MRG_RandomStreams
+from lasagne.layers import Layer
+from lasagne.random import get_rng
+from nolearn.lasagne import NeuralNet
+
+
+def describe_code(code):
+    # Hash of the bytecode, constants and names of a function (the repr of a nested code
+    # object includes its address, so they are described recursively)
+    consts = tuple(describe_code(c) if isinstance(c, types.CodeType) else c for c in code.co_consts)
+    return hashlib.sha1(repr((code.co_code, consts, code.co_names))).hexdigest()
+
+
+def describe(value):
+    # Canonical (hashable through repr) description of a layer or net attribute
+    if isinstance(value, SharedVariable):
+        return 'shared', value.dtype, value.get_value(borrow=True).shape
+    if isinstance(value, theano.Variable):
+        return 'variable', str(value.type)
+    if isinstance(value, Layer):
+        return 'layer', value.name
+    if isinstance(value, np.ndarray):
+        return 'array', str(value.dtype), value.shape
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return tuple(describe(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, describe(v)) for k, v in value.items()))
+    if isinstance(value, types.FunctionType):
+        # Lambdas (and functions redefined with the same name) are told apart by their code
+        closure = [c.cell_contents for c in value.__closure__] if value.__closure__ else []
+        return (
+            'function', value.__module__, value.__name__,
+            describe_code(value.__code__), describe(value.__defaults__), describe(closure)
+        )
+    if isinstance(value, (types.BuiltinFunctionType, type)):
+        return 'function', getattr(value, '__module__', None), value.__name__
+    if isinstance(value, (bool, int, long, float, str, unicode, type(None))):
+        return value
+    # Callable objects (nonlinearities like LeakyRectify, initialisers, iterators)
+    attributes = dict((k, v) for k, v in vars(value).items() if not k.startswith('_')) \
+        if hasattr(value, '__dict__') else dict()
+    return type(value).__module__, type(value).__name__, describe(attributes)
+
+
+def describe_layer(layer):
+    skip = ['params', 'input_layer', 'input_layers', 'input_shape', 'input_shapes', 'name']
+    attributes = dict((k, v) for k, v in vars(layer).items() if not k.startswith('_') and k not in skip)
+    incomings = layer.input_layers if hasattr(layer, 'input_layers') else [getattr(layer, 'input_layer', None)]
+    params = [(describe(p), sorted(tags)) for p, tags in layer.params.items()]
+    return (
+        type(layer).__name__,
+        layer.name,
+        layer.output_shape,
+        [None if l is None else l.name for l in incomings],
+        params,
+        describe(attributes)
+    )
+
+
+def architecture_signature(net):
+    """
+    Hash of everything that defines the functions compiled by a NeuralNet:
+    the layers (types, names, shapes, connections and hyperparameters),
+    objective, update rule, scores and the Theano configuration.
+    """
+    signature = (
+        [describe_layer(layer) for layer in net.layers_.values()],
+        describe(net.objective),
+        describe(net._get_params_for('objective')),
+        describe(net.update),
+        describe(net._get_params_for('update')),
+        net.regression,
+        describe(net.y_tensor_type),
+        describe(getattr(net, 'custom_scores', None)),
+        describe(getattr(net, 'scores_train', None)),
+        describe(getattr(net, 'scores_valid', None)),
+        theano.config.floatX,
+        theano.config.device,
+        theano.__version__
+    )
+    return hashlib.sha1(repr(signature)).hexdigest()
+
+
+def get_shared_inputs(f):
+    return [i.variable for i in f.maker.inputs if isinstance(i.variable, SharedVariable)]
+
+
+def get_net_shared(net):
+    # Shared variables of the net that the compiled functions have to use
+    update_shared = [v for v in net._get_params_for('update').values() if isinstance(v, SharedVariable)]
+    return net.get_all_params() + update_shared
+
+
+def save_functions(functions, net, filename):
+    # Each function is stored with the position (in get_net_shared) of its shared inputs
+    # to be able to swap them with the ones of a new net when it is loaded.
+    positions = dict((id(v), i) for i, v in enumerate(get_net_shared(net)))
+    shared_positions = [[positions.get(id(v)) for v in get_shared_inputs(f)] for f in functions]
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 50000))
+    directory = os.path.dirname(filename)
+    f_tmp = tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False)
+    try:
+        with f_tmp:
+            pickle.dump((functions, shared_positions), f_tmp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(f_tmp.name, filename)
+    except:
+        os.remove(f_tmp.name)
+        raise
+
+
+def reseed_random_states(functions, net, random=None):
+    """
+    Draws new random states (like the ones of dropout) for the shared inputs
+    of functions that are not shared variables of the net. Otherwise, every
+    net would replay the random stream stored with the functions. The seeds
+    come from random (a RandomState, lasagne's generator by default).
+    """
+    random = get_rng() if random is None else random
+    seen = set(id(v) for v in get_net_shared(net))
+    for v in [v for f in functions for v in get_shared_inputs(f)]:
+        if id(v) in seen:
+            continue
+        seen.add(id(v))
+        value = v.get_value(borrow=True)
+        seed = random.randint(1, 2147462579)
+        if isinstance(value, np.random.RandomState):
+            v.set_value(np.random.RandomState(seed), borrow=True)
+        elif getattr(v, 'default_update', None) is not None and value.dtype == np.int32 and\
+                value.ndim == 2 and value.shape[1] == 6:
+            # State of a MRG_RandomStreams sample (one row per stream)
+            v.set_value(MRG_RandomStreams(seed).get_substream_rstates(len(value), theano.config.floatX))
+
+
+def load_functions(net, filename):
+    net_shared = get_net_shared(net)
+    reoptimize = theano.config.reoptimize_unpickled_function
+    theano.config.reoptimize_unpickled_function = False
+    try:
+        with open(filename, 'rb') as f:
+            functions, shared_positions = pickle.load(f)
+    finally:
+        theano.config.reoptimize_unpickled_function = reoptimize
+    functions = [
+        f.copy(swap=dict(
+            (v, net_shared[i]) for v, i in zip(get_shared_inputs(f), positions) if i is not None
+        ))
+        for f, positions in zip(functions, shared_positions)
+    ]
+    reseed_random_states(functions, net)
+    return functions
+
+
+class CachedNeuralNet(NeuralNet):
+    """
+    NeuralNet that stores its compiled train, eval and predict functions
+    in cache_dir (keyed by architecture_signature) and reuses them
+    when a net with the same signature is initialised, even from another
+    process. Theano's graph optimisation and compilation are skipped, and
+    the functions are rewired to the parameters of the new net.
+    """
+    def __init__(self, layers, cache_dir=None, **kwargs):
+        self.cache_dir = cache_dir
+        super(CachedNeuralNet, self).__init__(layers, **kwargs)
+
+    def _create_iter_funcs(self, layers, objective, update, output_type):
+        if self.cache_dir is None:
+            return super(CachedNeuralNet, self)._create_iter_funcs(layers, objective, update, output_type)
+
+        filename = os.path.join(self.cache_dir, architecture_signature(self) + '.pkl')
+        if os.path.isfile(filename):
+            try:
+                return load_functions(self, filename)
+            except Exception as e:
+                if self.verbose:
+                    print('Could not load the compiled functions from %s (%s)' % (filename, e))
+
+        functions = super(CachedNeuralNet, self)._create_iter_funcs(layers, objective, update, output_type)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            save_functions(functions, self, filename)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            if self.verbose:
+                print('Could not save the compiled functions to %s (%s)' % (filename, e))
+
+        return functions
+
+
+class NetworkPool(object):
+    """
+    Keeps one compiled network per architecture in the process. acquire
+    compiles the first net of each architecture, and the following nets
+    with the same signature reuse its layers and compiled functions: the
+    parameter values of the new net (its fresh initialisation) are copied
+    into the pooled parameters, the optimiser state (update rule
+    accumulators) is reset and the random states are drawn again. A net
+    that was acquired before with the same architecture shares these
+    parameters and should not be used anymore. The parameter tags (like
+    'trainable') are also taken from the new net.
+    """
+    def __init__(self):
+        self.nets = dict()
+
+    def acquire(self, net):
+        if getattr(net, '_initialized', False):
+            return net
+        if getattr(net, '_output_layer', None) is None:
+            net._output_layer = net.initialize_layers()
+        key = architecture_signature(net)
+
+        if key not in self.nets:
+            net.initialize()
+            net_shared = get_net_shared(net)
+            net_ids = set(id(v) for v in net_shared)
+            state = [
+                (v, v.get_value())
+                for f in [net.train_iter_, net.eval_iter_, net.predict_iter_]
+                for v in get_shared_inputs(f) if id(v) not in net_ids
+            ]
+            self.nets[key] = (
+                net.layers, net.layers_, net._output_layer,
+                (net.train_iter_, net.eval_iter_, net.predict_iter_), net_shared, state
+            )
+            return net
+
+        layers, layers_, output_layer, functions, pooled_shared, state = self.nets[key]
+        for pooled, fresh in zip(pooled_shared, get_net_shared(net)):
+            pooled.set_value(fresh.get_value())
+        for v, value in state:
+            v.set_value(value)
+        # The parameter tags can be changed after training (freezing the layers, for instance)
+        for pooled, fresh in zip(layers_.values(), net.layers_.values()):
+            for param, tags in zip(pooled.params.keys(), fresh.params.values()):
+                pooled.params[param] = set(tags)
+        net.layers = layers
+        net.layers_ = layers_
+        net._output_layer = output_layer
+        net.train_iter_, net.eval_iter_, net.predict_iter_ = functions
+        net._initialized = True
+        reseed_random_states(functions, net)
+        return net
+
+    def clear(self):
+        self.nets = dict()
@@ -8,7 +8,7 @@ from nibabel import load as load_nii
 from nibabel import save as save_nii
 from nibabel import Nifti1Image as NiftiImage
 from data_manipulation.generate_features import get_mask_voxels, get_patches, get_patches2_5d
-from utils import color_codes
+from utils import color_codes, random_affine3d_matrix
 from itertools import izip
 
 
@@ -206,8 +206,37 @@ def get_image_patches(image_list, centers, size):
     return patches
 
 
-def get_list_of_patches(image_list, center_list, size):
+def get_random_affine(angle, seed):
+    # Random rotation (+/- angle / 2 radians per axis). There is no translation, since the label of
+    # each patch is the one of its original center.
+    return random_affine3d_matrix(angle, angle, angle, 0, random=np.random.RandomState(seed))
+
+
+def get_affine_patches(image, centers, size, affine, chunk_size=10000):
+    # Instead of extracting the patches and resampling them afterwards, we transform the
+    # coordinates of the patch voxels (relative to their center) and interpolate them directly
+    # from the source volume. That way each rotated patch costs a single interpolation and
+    # uses the real neighbourhood of the patch instead of the padded borders.
+    offsets = np.stack(np.meshgrid(*[np.arange(s) - s // 2 for s in size], indexing='ij')).reshape((3, -1))
+    offsets = np.dot(affine[:3, :3], offsets)
+    patches = list()
+    for i in range(0, len(centers), chunk_size):
+        chunk = np.array(centers[i:i + chunk_size]).T
+        coords = chunk[:, :, np.newaxis] + offsets[:, np.newaxis, :]
+        patches.append(
+            nd.map_coordinates(image, coords.reshape((3, -1)), order=1).reshape((-1,) + tuple(size))
+        )
+    return np.concatenate(patches)
+
+
+def get_list_of_patches(image_list, center_list, size, affine_angle=None, random_state=42):
+    # When affine_angle is defined, each volume gets its own random affine transformation. Since the
+    # seed only depends on the position of the volume in the list, all the images of a patient
+    # get the same transformation.
     patches = [
+        get_affine_patches(image, centers, size, get_random_affine(affine_angle, int(random_state) + i))
+        for i, (image, centers) in enumerate(izip(image_list, center_list)) if centers
+        ] if affine_angle is not None and len(size) == 3 else [
         get_patches(image, centers, size) for image, centers in izip(image_list, center_list) if centers
         ] if len(size) == 3 else [
         np.stack(get_patches2_5d(image, centers, size)) for image, centers in izip(image_list, center_list) if centers
@@ -225,14 +254,29 @@ def get_centers_from_masks(positive_masks, negative_masks, balanced=True, random
     return positive_centers, negative_centers
 
 
-def get_norm_patch_vectors(image_names, positive_masks, negative_masks, size, balanced=True, random_state=42):
+def get_norm_patch_vectors(
+        image_names,
+        positive_masks,
+        negative_masks,
+        size,
+        balanced=True,
+        random_state=42,
+        affine_angle=None
+):
     # Get all the centers for each image
     c = color_codes()
     print(c['lgy'] + '                ' + image_names[0].rsplit('/')[-1] + c['nc'])
 
     # Get all the patches for each image
     positive_centers, negative_centers = get_centers_from_masks(positive_masks, negative_masks, balanced, random_state)
-    return get_patch_vectors(norm_image_generator(image_names), positive_centers, negative_centers, size)
+    return get_patch_vectors(
+        norm_image_generator(image_names),
+        positive_centers,
+        negative_centers,
+        size,
+        affine_angle,
+        random_state
+    )
 
 
 def get_defo_patch_vectors(image_names, masks, size=(5, 5, 5), balanced=True, random_state=42):
@@ -258,9 +302,9 @@ def get_defo_patch_vectors(image_names, masks, size=(5, 5, 5), balanced=True, ra
     return patches
 
 
-def get_patch_vectors(images, positive_centers, negative_centers, size):
+def get_patch_vectors(images, positive_centers, negative_centers, size, affine_angle=None, random_state=42):
     centers = [p + list(n) for p, n in izip(positive_centers, negative_centers)]
-    patches = get_list_of_patches(images, centers, size)
+    patches = get_list_of_patches(images, centers, size, affine_angle, random_state)
 
     # Return the patch vectors
     data = patches if len(size) == 3 else [np.swapaxes(p, 0, 1) for p in izip(patches)]
@@ -326,7 +370,7 @@ def get_cnn_rois(names, mask_names, roi_names=None, pr_names=None, th=1.0, balan
     return rois_p, rois_n
 
 
-def load_and_stack(names, rois, patch_size, balanced=True, random_state=42):
+def load_and_stack(names, rois, patch_size, balanced=True, random_state=42, affine_angle=None):
     rois_p, rois_n = rois
 
     images_loaded = [
@@ -336,7 +380,8 @@ def load_and_stack(names, rois, patch_size, balanced=True, random_state=42):
             rois_n,
             patch_size,
             balanced=balanced,
-            random_state=random_state
+            random_state=random_state,
+            affine_angle=affine_angle
         ) for names_i in names]
 
     x_train = [np.stack(images, axis=1) for images in izip(*images_loaded)]
@@ -372,7 +417,10 @@ def load_lesion_cnn_data(
         defo_size=(5, 5, 5),
         balanced=True,
         random_state=42,
+        affine_angle=None
 ):
+    # affine_angle (in radians) enables the volume-level rotation of the image patches.
+    # The deformation patches are not transformed.
     seed = time.clock() if not random_state else random_state
     pr_names = names[0, :] if pr_names is None else pr_names
     rois = get_cnn_rois(names, mask_names, roi_names=roi_names, pr_names=pr_names, balanced=balanced)
@@ -389,7 +437,14 @@ def load_lesion_cnn_data(
         rois = (rois_p, rois_n)
 
     print('                Loading image data and labels vector')
-    x_train, y_train, rois = load_and_stack(names, rois, patch_size, balanced=balanced, random_state=seed)
+    x_train, y_train, rois = load_and_stack(
+        names,
+        rois,
+        patch_size,
+        balanced=balanced,
+        random_state=seed,
+        affine_angle=affine_angle
+    )
     x_train = np.concatenate(x_train)
     x_train = permute(x_train, seed)
     y_train = np.concatenate(y_train)
@@ -408,7 +463,7 @@ def load_lesion_cnn_data(
     return x_train, y_train
 
 
-def load_register_data(names, image_size, seed):
+def load_register_data(names, image_size, seed, stride=1):
     print('                Creating data vector')
     images = [norm_image_generator(n) for n in names]
     images_loaded = [
@@ -416,7 +471,7 @@ def load_register_data(names, image_size, seed):
         for gen in images]
     x_train = np.stack(images_loaded)
     x_train = np.concatenate([x_train, np.stack([x_train[:, 1, :, :, :], x_train[:, 0, :, :, :]], axis=1)])
-    y_train = x_train[:, 1, :, :, :].reshape(x_train.shape[0], -1)
+    y_train = x_train[:, 1, ::stride, ::stride, ::stride].reshape(x_train.shape[0], -1)
     print('                Permuting the data')
     np.random.seed(seed)
     x_train = np.random.permutation(x_train.astype(dtype=np.float32))
@@ -0,0 +1,150 @@
+import os
+import copy
+import numpy as np
+import theano
+from lasagne.layers import get_all_layers, get_output, InputLayer, MergeLayer
+from nolearn.lasagne import BatchIterator
+from memory import MemoryPlanner
+from checkpoint import SaveCheckpoint
+
+
+def get_incomings(layer):
+    return layer.input_layers if isinstance(layer, MergeLayer) else\
+        [] if isinstance(layer, InputLayer) else [layer.input_layer]
+
+
+def split_frozen(output_layer):
+    """
+    Splits a lasagne graph into the frozen part (the layers without
+    trainable parameters that do not depend on a trainable layer) and the
+    head (the rest). Returns the boundary (the frozen layers used by the
+    head, in topological order) and the head layers (in topological order).
+    """
+    layers = get_all_layers(output_layer)
+    head = list()
+    for layer in layers:
+        if layer.get_params(trainable=True) or any(l in head for l in get_incomings(layer)):
+            head.append(layer)
+    boundary = [
+        layer for layer in layers
+        if layer not in head and any(layer in get_incomings(l) for l in head)
+    ]
+    return boundary, head
+
+
+def copy_head(output_layer, boundary, head):
+    """
+    Copies the head layers on top of new InputLayers (with the names and
+    shapes of the boundary layers). The copies share the parameters of the
+    original layers, so training them also trains output_layer.
+    """
+    copies = dict((layer, InputLayer(shape=layer.output_shape, name=layer.name)) for layer in boundary)
+    for layer in head:
+        layer_copy = copy.copy(layer)
+        if isinstance(layer, MergeLayer):
+            layer_copy.input_layers = [copies[l] for l in layer.input_layers]
+            layer_copy.input_shapes = [l.output_shape for l in layer_copy.input_layers]
+        else:
+            layer_copy.input_layer = copies[layer.input_layer]
+            layer_copy.input_shape = layer_copy.input_layer.output_shape
+        copies[layer] = layer_copy
+    return copies[output_layer]
+
+
+def compute_features(boundary, x, memory_budget=None, dtype=None, directory=None):
+    """
+    Computes the (deterministic) outputs of the boundary layers for the
+    inputs x (a dictionary keyed by the input layer names) in chunks as
+    large as memory_budget allows. The outputs are stored with dtype
+    (floatX by default) in memory or, if directory is given, in .npy files
+    that are returned memory-mapped. Returns a dictionary keyed by the
+    names of the boundary layers.
+    """
+    dtype = theano.config.floatX if dtype is None else dtype
+    inputs = [layer for layer in get_all_layers(boundary) if isinstance(layer, InputLayer)]
+    names = [layer.name for layer in inputs]
+    f = theano.function(
+        [theano.In(layer.input_var, name=layer.name) for layer in inputs],
+        get_output(boundary, deterministic=True),
+        name='features'
+    )
+    chunk_size = MemoryPlanner(boundary, memory_budget).inference_batch_size()
+    n_samples = len(x[names[0]])
+
+    features = list()
+    for i, layer in enumerate(boundary):
+        shape = (n_samples,) + tuple(layer.output_shape[1:])
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            filename = os.path.join(directory, 'features_%d.npy' % i)
+            features.append(np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape))
+        else:
+            features.append(np.empty(shape, dtype=dtype))
+
+    for i in range(0, n_samples, chunk_size):
+        outputs = f(**dict(
+            (name, np.asarray(x[name][i:i + chunk_size], dtype=theano.config.floatX)) for name in names
+        ))
+        for feature, output in zip(features, outputs):
+            feature[i:i + len(output)] = output
+
+    for feature in features:
+        if isinstance(feature, np.memmap):
+            feature.flush()
+    return dict((layer.name, feature) for layer, feature in zip(boundary, features))
+
+
+def create_head_net(net, boundary, head):
+    """
+    Copy of a NeuralNet (same objective, update rule and handlers) that only
+    has the head layers (see copy_head). The data augmentation of the
+    training batch iterator cannot be applied to the features, so a plain
+    BatchIterator with the same batch size is used. The weight checkpoints
+    are written with the whole net, so they can be loaded like the ones of
+    any other net.
+    """
+    head_net = copy.copy(net)
+    head_net.layers = [copy_head(net.layers_[-1], boundary, head)]
+    head_net.layers_ = None
+    head_net._output_layer = None
+    head_net._initialized = False
+    head_net.train_history_ = []
+    handlers = net.on_epoch_finished if isinstance(net.on_epoch_finished, (list, tuple)) else [net.on_epoch_finished]
+    head_net.on_epoch_finished = [
+        SaveCheckpoint(h.path, h.every_n_epochs, h.only_best, h.verbose, net=net)
+        if isinstance(h, SaveCheckpoint) else h
+        for h in handlers
+    ]
+    head_net.batch_iterator_train = BatchIterator(batch_size=net.batch_iterator_train.batch_size)
+    head_net.initialize()
+    return head_net
+
+
+class FrozenFeatures(object):
+    """
+    Trains only the head of a NeuralNet whose first layers are frozen (their
+    parameters are not trainable). The outputs of the frozen layers are
+    computed once for the whole training set (see compute_features) and each
+    epoch only runs the head (see create_head_net). The head shares its
+    parameters with net, so net is trained too. The frozen layers run
+    deterministically (without dropout and with the stored batch
+    normalisation statistics).
+    """
+    def __init__(self, net, memory_budget=None, dtype=None, directory=None):
+        net.initialize()
+        self.net = net
+        self.memory_budget = memory_budget
+        self.dtype = dtype
+        self.directory = directory
+        self.boundary, self.head = split_frozen(net.layers_[-1])
+        if not self.boundary or not self.head:
+            raise ValueError('The net does not have frozen layers and a trainable head')
+        self.head_net = create_head_net(net, self.boundary, self.head)
+
+    def features(self, x):
+        return compute_features(self.boundary, x, self.memory_budget, self.dtype, self.directory)
+
+    def fit(self, x, y, epochs=None):
+        self.head_net.fit(self.features(x), y, epochs=epochs)
+        return self.net
@@ -0,0 +1,156 @@
+import numpy as np
+from data_creation import norm_image_generator, norm_defo_generator, get_image_patches, get_defo_patches
+from data_creation import get_cnn_rois
+from data_manipulation.generate_features import get_mask_voxels
+
+
+def get_bounding_box(mask, margin):
+    # Slices of the bounding box of a mask (enlarged by margin voxels)
+    coords = np.nonzero(mask)
+    return tuple(
+        slice(max(0, c.min() - margin), min(s, c.max() + margin + 1)) if len(c) else slice(0, 0)
+        for c, s in zip(coords, mask.shape)
+    )
+
+
+def negative_loss(probabilities, eps=1e-6):
+    # Cross-entropy of the negative samples given their lesion probability
+    return -np.log(np.clip(1 - probabilities, eps, 1))
+
+
+class HardNegativeMiner(object):
+    """
+    Samples the training patches of a lesion detection net during its
+    training, instead of the two iterations of train_test_longitudinal
+    (where the negatives of the second one come from testing the first net
+    on every training patient). For each patient, the normalised images
+    (cropped to the region of interest), all the lesion voxels and a pool
+    of up to pool_size candidate negatives (the unbalanced negatives of
+    get_cnn_rois) are kept in memory. score computes the loss of every
+    candidate with the current net and sample builds a balanced training
+    set (like load_lesion_cnn_data) where a uniform fraction of the
+    negatives is sampled uniformly and the rest proportionally to their
+    last loss. Until the first scoring, all the candidates have the same
+    probability. A valid_size fraction of the positives and the candidate
+    negatives of each patient is kept apart for validation (see validation),
+    so the validation set is the same during the whole training.
+    """
+    def __init__(
+            self,
+            names,
+            mask_names,
+            roi_names,
+            pr_names,
+            defo_names=None,
+            patch_size=(11, 11, 11),
+            defo_size=(5, 5, 5),
+            pool_size=20000,
+            uniform=0.25,
+            valid_size=0.2,
+            random_state=42
+    ):
+        self.patch_size = patch_size
+        self.defo_size = defo_size if defo_names is not None else None
+        self.uniform = uniform
+        self.random = np.random.RandomState(random_state)
+        margin = max(patch_size + (defo_size if defo_names is not None else ())) // 2 + 1
+        rois_p, rois_n = get_cnn_rois(names, mask_names, roi_names=roi_names, pr_names=pr_names, balanced=False)
+
+        print('                Loading the images and the candidate negatives')
+        self.patients = list()
+        for i, (roi_p, roi_n) in enumerate(zip(rois_p, rois_n)):
+            box = get_bounding_box(np.logical_or(roi_p, roi_n), margin)
+            images = [im[box].astype(np.float32) for im in norm_image_generator(names[:, i])]
+            defos = [d[box].astype(np.float32) for d in norm_defo_generator(defo_names[:, i])]\
+                if defo_names is not None else []
+            negatives = np.array(get_mask_voxels(roi_n[box]), dtype=np.int32).reshape((-1, 3))
+            if len(negatives) > pool_size:
+                negatives = negatives[self.random.choice(len(negatives), pool_size, replace=False)]
+            positives = np.array(get_mask_voxels(roi_p[box]), dtype=np.int32).reshape((-1, 3))
+            positives, valid_positives = self.split(positives, valid_size)
+            negatives, valid_negatives = self.split(negatives, valid_size)
+            self.patients.append({
+                'images': images,
+                'defos': defos,
+                'positives': positives,
+                'negatives': negatives,
+                'loss': np.ones(len(negatives)),
+                'valid_positives': valid_positives,
+                'valid_negatives': valid_negatives,
+            })
+
+    def split(self, centers, valid_size):
+        # Random (training, validation) partition of a list of centers
+        order = self.random.permutation(len(centers))
+        n_valid = int(round(len(centers) * valid_size))
+        return centers[order[n_valid:]], centers[order[:n_valid]]
+
+    def get_patches(self, patient, centers):
+        # Same layout as the patches of load_lesion_cnn_data
+        centers = [tuple(center) for center in centers]
+        x = get_image_patches(patient['images'], centers, self.patch_size).astype(np.float32)
+        if not patient['defos']:
+            return x
+        return x, get_defo_patches(patient['defos'], centers, size=self.defo_size).astype(np.float32)
+
+    def choose_negatives(self, patient, n_negatives):
+        loss = patient['loss'] + 1e-6
+        n_hard = int(round(n_negatives * (1 - self.uniform)))
+        hard = self.random.choice(len(loss), n_hard, replace=False, p=loss / loss.sum()) if n_hard else []
+        rest = np.setdiff1d(np.arange(len(loss)), hard)
+        easy = self.random.choice(rest, n_negatives - n_hard, replace=False)
+        return patient['negatives'][np.concatenate([hard, easy]).astype(np.int64)]
+
+    def get_set(self, patient_centers):
+        # Patches and labels of a list of (patient, positives, negatives) in random order
+        x = list()
+        y = list()
+        for patient, positives, negatives in patient_centers:
+            centers = np.concatenate([positives, negatives])
+            if len(centers):
+                x.append(self.get_patches(patient, centers))
+                y.append(np.concatenate([np.ones(len(positives)), np.zeros(len(negatives))]).astype(np.int32))
+        order = self.random.permutation(sum(len(y_i) for y_i in y))
+        y = np.concatenate(y)[order]
+        if self.defo_size is not None:
+            x_i, d_i = zip(*x)
+            return (np.concatenate(x_i)[order], np.concatenate(d_i)[order]), y
+        return np.concatenate(x)[order], y
+
+    def sample(self):
+        """
+        Returns a training set (x, y) with all the training positives and as
+        many negatives for each patient, in random order.
+        """
+        return self.get_set([
+            (patient, patient['positives'], self.choose_negatives(
+                patient, min(len(patient['positives']), len(patient['negatives']))
+            ))
+            for patient in self.patients
+        ])
+
+    def validation(self):
+        """
+        Returns the validation set (x, y) with all the validation positives
+        and as many validation negatives (sampled uniformly) for each patient.
+        """
+        return self.get_set([
+            (patient, patient['valid_positives'], patient['valid_negatives'][self.random.choice(
+                len(patient['valid_negatives']),
+                min(len(patient['valid_positives']), len(patient['valid_negatives'])),
+                replace=False
+            )])
+            for patient in self.patients
+        ])
+
+    def score(self, predict_proba, batch_size=10000):
+        """
+        Updates the loss of the candidate negatives with predict_proba
+        (a function that returns the probabilities of a set of patches with
+        the layout of sample) in batches of batch_size candidates.
+        """
+        for patient in self.patients:
+            negatives = patient['negatives']
+            for i in range(0, len(negatives), batch_size):
+                probabilities = predict_proba(self.get_patches(patient, negatives[i:i + batch_size]))[:, -1]
+                patient['loss'][i:i + batch_size] = negative_loss(probabilities)
@@ -0,0 +1,196 @@
+import numpy as np
+import theano
+from lasagne.layers import get_all_layers, InputLayer, MergeLayer, DropoutLayer, NonlinearityLayer
+from lasagne.layers import BatchNormLayer, Pool2DLayer, Pool3DLayer
+from lasagne.layers.conv import BaseConvLayer
+from lasagne.nonlinearities import identity, linear
+from lasagne.utils import as_tuple
+from layers import BatchSplitLayer
+from memory import MemoryPlanner
+
+
+def is_identity(layer):
+    # Layers that do nothing at test time
+    if isinstance(layer, DropoutLayer):
+        return True
+    if isinstance(layer, NonlinearityLayer):
+        return layer.nonlinearity in [identity, linear, None]
+    if isinstance(layer, (Pool2DLayer, Pool3DLayer)):
+        ndim = len(layer.pool_size)
+        return all(p == 1 for p in as_tuple(layer.pool_size, ndim)) and\
+            all(s == 1 for s in as_tuple(layer.stride, ndim)) and\
+            all(p == 0 for p in as_tuple(layer.pad, ndim))
+    return False
+
+
+def get_consumers(layers):
+    consumers = dict([(layer, []) for layer in layers])
+    for layer in layers:
+        incomings = layer.input_layers if isinstance(layer, MergeLayer) else\
+            [] if isinstance(layer, InputLayer) else [layer.input_layer]
+        for incoming in incomings:
+            consumers[incoming].append(layer)
+    return consumers
+
+
+def get_normalised_conv(bn):
+    # Convolution normalised by bn and the BatchSplitLayer between them (if any). The shared
+    # convolutions of the longitudinal nets run on stacked inputs that are split before their
+    # own normalisation.
+    layer = bn.input_layer
+    if isinstance(layer, BatchSplitLayer):
+        return layer.input_layer, layer
+    return layer, None
+
+
+def fold_batch_norm(bn):
+    """
+    Returns the weights and biases of the convolution that precedes a
+    BatchNormLayer with the batch normalisation folded into them:
+    W' = W * gamma * inv_std and b' = (b - mean) * gamma * inv_std + beta
+    """
+    conv, _ = get_normalised_conv(bn)
+    scale = bn.inv_std.get_value()
+    if bn.gamma is not None:
+        scale = scale * bn.gamma.get_value()
+    shift = - bn.mean.get_value() * scale
+    if conv.b is not None:
+        shift += conv.b.get_value() * scale
+    if bn.beta is not None:
+        shift += bn.beta.get_value()
+    w = conv.W.get_value()
+    w_folded = w * scale.reshape((-1,) + (1,) * (w.ndim - 1))
+    return w_folded.astype(w.dtype), shift.astype(w.dtype)
+
+
+def can_fold(bn, consumers):
+    # Only per-channel normalisations of a linear convolution whose output
+    # is only used by the normalisation can be folded. With a batch split,
+    # every part of the convolution must go straight to its own normalisation
+    # (each part is then convolved with its own folded weights).
+    conv, split = get_normalised_conv(bn)
+    if split is None:
+        single = consumers[conv] == [bn]
+    else:
+        single = all(
+            isinstance(part, BatchSplitLayer) and len(consumers[part]) == 1 and
+            isinstance(consumers[part][0], BatchNormLayer)
+            for part in consumers[conv]
+        )
+    return isinstance(conv, BaseConvLayer) and\
+        isinstance(conv.W, theano.compile.SharedVariable) and\
+        conv.nonlinearity in [identity, linear, None] and\
+        single and\
+        tuple(bn.axes) == (0,) + tuple(range(2, len(bn.input_shape)))
+
+
+def get_inference_output(output_layer):
+    """
+    Builds a deterministic expression for output_layer where the batch
+    normalisations are folded into the preceding convolutions and dropout,
+    linear nonlinearities and identity pools are removed.
+    """
+    layers = get_all_layers(output_layer)
+    consumers = get_consumers(layers)
+    outputs = dict()
+    for layer in layers:
+        if isinstance(layer, InputLayer):
+            outputs[layer] = layer.input_var
+        elif isinstance(layer, BatchNormLayer) and can_fold(layer, consumers):
+            conv, split = get_normalised_conv(layer)
+            w, b = fold_batch_norm(layer)
+            w_folded = theano.shared(w, name=conv.W.name)
+            b_folded = theano.shared(b, name='b')
+            # The convolution works sample by sample, so splitting its input is the same as
+            # splitting its output
+            data = outputs[conv.input_layer]
+            data = data if split is None else split.get_output_for(data)
+            convolution = theano.clone(
+                conv.convolve(data),
+                replace={conv.W: w_folded}
+            )
+            outputs[layer] = convolution + b_folded.dimshuffle(('x', 0) + ('x',) * (convolution.ndim - 2))
+        elif is_identity(layer):
+            outputs[layer] = outputs[layer.input_layer]
+        elif isinstance(layer, MergeLayer):
+            outputs[layer] = layer.get_output_for([outputs[l] for l in layer.input_layers], deterministic=True)
+        else:
+            outputs[layer] = layer.get_output_for(outputs[layer.input_layer], deterministic=True)
+
+    inputs = [layer for layer in layers if isinstance(layer, InputLayer)]
+    return inputs, outputs[output_layer]
+
+
+def compile_inference(net, output_layer=None, batch_size=None):
+    """
+    Compiles a lean version of net.predict_proba. The returned function
+    takes the same inputs (an array or a dictionary of arrays keyed by the
+    input layer names) and processes them in batches of batch_size
+    (by default, the batch size of net.batch_iterator_test).
+    """
+    output_layer = net.layers_[-1] if output_layer is None else net.layers_[output_layer]
+    inputs, output = get_inference_output(output_layer)
+    names = [layer.name for layer in inputs]
+    f = theano.function(
+        [theano.In(layer.input_var, name=layer.name) for layer in inputs],
+        output,
+        name='inference'
+    )
+    batch_size = net.batch_iterator_test.batch_size if batch_size is None else batch_size
+
+    def predict_proba(x):
+        x = [x[name] for name in names] if isinstance(x, dict) else [x]
+        x = [np.asarray(x_i, dtype=theano.config.floatX) for x_i in x]
+        n_samples = len(x[0])
+        return np.concatenate([
+            f(*[x_i[i:i + batch_size] for x_i in x])
+            for i in range(0, n_samples, batch_size)
+        ])
+
+    return predict_proba
+
+
+def check_inference(net, x, predict_proba=None):
+    # Maximum absolute difference between the lean function and net.predict_proba
+    predict_proba = compile_inference(net) if predict_proba is None else predict_proba
+    return np.abs(predict_proba(x) - net.predict_proba(x)).max()
+
+
+class Predictor(object):
+    """
+    Runs the compiled prediction function of a NeuralNet directly on chunks
+    of samples as large as memory_budget (in bytes) allows (according to
+    MemoryPlanner), writing the results in a preallocated array. The inputs
+    follow the layout of net.predict_proba (an array or a dictionary keyed
+    by the input layer names). With fold=True the optimised graph of get_inference_output is
+    compiled and used instead of net.predict_iter_.
+    """
+    def __init__(self, net, memory_budget=None, fold=False):
+        net.initialize()
+        self.output_layer = net.layers_[-1]
+        if fold:
+            inputs, output = get_inference_output(self.output_layer)
+            self.names = [layer.name for layer in inputs]
+            self.function = theano.function(
+                [theano.In(layer.input_var, name=layer.name) for layer in inputs],
+                output,
+                name='predictor'
+            )
+        else:
+            self.names = [layer.name for layer in net.layers_.values() if isinstance(layer, InputLayer)]
+            self.function = net.predict_iter_
+        self.planner = MemoryPlanner(self.output_layer, memory_budget)
+        self.chunk_size = self.planner.inference_batch_size()
+
+    def predict_proba(self, x, out=None):
+        x = x if isinstance(x, dict) else {self.names[0]: x}
+        x = dict((name, np.asarray(x[name], dtype=theano.config.floatX)) for name in self.names)
+        n_samples = len(x[self.names[0]])
+        for i in range(0, n_samples, self.chunk_size):
+            y = self.function(**dict((name, x_i[i:i + self.chunk_size]) for name, x_i in x.items()))
+            if out is None:
+                out = np.empty((n_samples,) + y.shape[1:], dtype=y.dtype)
+            out[i:i + len(y)] = y
+        if out is None:
+            out = np.empty((0,) + tuple(self.output_layer.output_shape[1:]), dtype=theano.config.floatX)
+        return out
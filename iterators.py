@@ -1,23 +1,184 @@
 import numpy as np
-from time import clock
+import tempfile
+import threading
+import multiprocessing
 from utils import random_affine3d_matrix
 from nolearn.lasagne import BatchIterator
 from scipy.ndimage.interpolation import affine_transform
+try:
+    from Queue import Queue, Full, Empty
+except ImportError:
+    from queue import Queue, Full, Empty
 
 
-class Affine3DTransformBatchIterator(BatchIterator):
+def _put_batch(queue, item, stop):
+    # Bounded put that gives up as soon as the consumer is gone
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _produce_batches(batch_iterator, queue, stop, seed):
+    # Runs the (possibly overriden) __iter__ of the batch iterator, including
+    # any transform, and pushes the resulting minibatches into the queue.
+    # The transforms use the generator of the iterator (not the global one).
+    batch_iterator.transform_random = np.random.RandomState(seed)
+    try:
+        for batch in iter(batch_iterator):
+            if not _put_batch(queue, ('batch', batch), stop):
+                break
+        else:
+            _put_batch(queue, ('done', None), stop)
+    except Exception as e:
+        _put_batch(queue, ('error', e), stop)
+
+
+def _get_batch(queue, worker):
+    # Waits for the next item and fails if the producer died without sending it
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not worker.is_alive():
+                # Whatever the producer sent before finishing has already been flushed
+                try:
+                    return queue.get(timeout=1)
+                except Empty:
+                    raise RuntimeError('The batch producer stopped unexpectedly')
+
+
+class _PrefetchedBatches(object):
+    def __init__(self, batch_iterator, seed):
+        self.batch_iterator = batch_iterator
+        self.seed = seed
+
+    def __iter__(self):
+        bi = self.batch_iterator
+        if bi.prefetch == 'process':
+            queue = multiprocessing.Queue(bi.queue_size)
+            stop = multiprocessing.Event()
+            worker = multiprocessing.Process(target=_produce_batches, args=(bi, queue, stop, self.seed))
+        else:
+            queue = Queue(bi.queue_size)
+            stop = threading.Event()
+            worker = threading.Thread(target=_produce_batches, args=(bi, queue, stop, self.seed))
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                kind, item = _get_batch(queue, worker)
+                if kind == 'batch':
+                    yield item
+                elif kind == 'error':
+                    raise item
+                else:
+                    break
+        finally:
+            stop.set()
+            worker.join(1)
+            if bi.prefetch == 'process' and worker.is_alive():
+                worker.terminate()
+
+
+class PrefetchBatchIterator(BatchIterator):
+    """
+    Prepare the minibatches in the background while the main thread runs
+    the Theano functions. The __iter__ and transform methods of any subclass
+    are run unchanged on a producer thread (or process) that stays at most
+    queue_size batches ahead of training.
+    With prefetch='process' the batches are pickled through a multiprocessing
+    queue, which is only worth it for expensive transforms. With prefetch=None
+    the iterator behaves like a plain BatchIterator.
+    The transforms draw their random numbers from self.transform_random. The producer
+    gets its own RandomState at the start of every epoch, seeded with
+    prefetch_seed + epoch (or a seed drawn from the main thread if
+    prefetch_seed is None), so augmentations are reproducible in both
+    modes. With prefetch=None, self.transform_random is the global numpy generator.
+    """
+    def __init__(self, batch_size, queue_size=2, prefetch='thread', prefetch_seed=None, *args, **kwargs):
+        super(PrefetchBatchIterator, self).__init__(batch_size, *args, **kwargs)
+        self.queue_size = queue_size
+        self.prefetch = prefetch
+        self.prefetch_seed = prefetch_seed
+        self.epoch = 0
+        self.transform_random = np.random.RandomState(prefetch_seed)
+
+    def __call__(self, X, y=None):
+        # BatchIterator shuffles X and y in place with this state (see AugmentationBank.follow_shuffle)
+        self.shuffle_state = self.random.get_state() if self.shuffle else None
+        super(PrefetchBatchIterator, self).__call__(X, y)
+        self.epoch += 1
+        seed = np.random.randint(np.iinfo(np.int32).max) if self.prefetch_seed is None\
+            else (self.prefetch_seed + self.epoch) % np.iinfo(np.int32).max
+        # Anything that has to outlive the epoch is prepared here (in the main
+        # process), before the batches are produced
+        self.prepare(np.random.RandomState(seed))
+        if not self.prefetch:
+            self.transform_random = np.random.RandomState(seed)
+            return self
+        return _PrefetchedBatches(self, seed)
+
+    def prepare(self, random):
+        pass
+
+
+def _update_banks(batch_iterator, keys, random):
+    # Builds (or partially refreshes) the AugmentationBank of each transformed input (None if X is an array)
+    bi = batch_iterator
+    arr = bi.X if isinstance(bi.X, dict) else {None: bi.X}
+    for k in [k for k in keys if k in arr]:
+        bank = bi.banks.get(k)
+        if bank is not None and bank.source is arr[k]:
+            if bi.shuffle_state is not None:
+                bank.follow_shuffle(bi.shuffle_state)
+            bank.update(random)
+        else:
+            bank = AugmentationBank(bi.bank_size, bi.bank_refresh, bi.bank_dir)
+            bank.build(arr[k], random)
+            bi.banks[k] = bank
+
+
+class Affine3DTransformBatchIterator(PrefetchBatchIterator):
     """
     Apply affine transform (scale, translate and rotation)
     with a random chance
+    If bank_size is given, the transformed volumes are drawn from an
+    AugmentationBank with bank_size resamplings per sample, of which a
+    bank_refresh fraction is recomputed each epoch.
     """
     def __init__(self, affine_p, parameter_range=(-np.pi/36, np.pi/36), input_layers=list(),
-                 *args, **kwargs):
+                 bank_size=None, bank_refresh=0.1, bank_dir=None, *args, **kwargs):
         super(Affine3DTransformBatchIterator,
               self).__init__(*args, **kwargs)
         self.range = max(parameter_range) - min(parameter_range)
         self.min = min(parameter_range)
         self.affine_p = affine_p
         self.input_layers = input_layers
+        self.bank_size = bank_size
+        self.bank_refresh = bank_refresh
+        self.bank_dir = bank_dir
+        self.banks = dict()
+        self.indices = None
+
+    def prepare(self, random):
+        if self.bank_size and self.affine_p != 0:
+            _update_banks(self, self.input_layers if isinstance(self.X, dict) else [None], random)
+
+    def __iter__(self):
+        # Same batches as BatchIterator, but the indices of the samples are
+        # kept to find their resamplings in the banks
+        bs = self.batch_size
+        for i in range((self.n_samples + bs - 1) // bs):
+            sl = slice(i * bs, (i + 1) * bs)
+            self.indices = np.arange(self.n_samples)[sl]
+            xb = {k: v[sl] for k, v in self.X.items()} if isinstance(self.X, dict) else self.X[sl]
+            yb = self.y[sl] if self.y is not None else None
+            yield self.transform(xb, yb)
+        self.indices = None
 
     def transform(self, xb, yb):
         xb, yb = super(Affine3DTransformBatchIterator,
@@ -27,39 +188,162 @@ class Affine3DTransformBatchIterator(BatchIterator):
         if self.affine_p == 0:
             return xb, yb
 
-        seed = np.random.randint(clock())
-        xb_transformed = xb.copy()
+        seed = self.transform_random.randint(np.iinfo(np.int32).max)
         if isinstance(xb, dict):
+            xb_transformed = xb.copy()
             for k in self.input_layers:
-                np.random.seed(seed)
-                x_t = np.random.permutation(xb_transformed[k])
-                for i in range(int(x_t.shape[0] * self.affine_p)):
-                    t = random_affine3d_matrix()
-                    img_transformed = affine_transform(x_t[i], t)
-                    xb_transformed[k][i] = img_transformed
+                xb_transformed[k] = self.transform_samples(xb[k], seed, self.banks.get(k))
         else:
-            np.random.seed(seed)
-            xb_transformed = np.random.permutation(xb)
-            for i in range(int(xb.shape[0] * self.affine_p)):
-                t = random_affine3d_matrix
-                img_transformed = affine_transform(xb[i], t)
-                xb_transformed[i] = img_transformed
+            xb_transformed = self.transform_samples(xb, seed, self.banks.get(None))
 
         return xb_transformed, yb
 
+    def transform_samples(self, x, seed, bank=None):
+        # The same random affine_p fraction of the samples is transformed in every input
+        x_t = x.copy()
+        chosen = np.random.RandomState(seed).permutation(len(x))[:int(len(x) * self.affine_p)]
+        for i in chosen:
+            x_t[i] = bank.sample(self.indices[i], 1, self.transform_random)[0]\
+                if bank is not None and self.indices is not None\
+                else affine_transform(x[i], random_affine3d_matrix(random=self.transform_random))
+        return x_t
+
 
-class Affine3DTransformExpandBatchIterator(BatchIterator):
+class DiscreteSymmetryBatchIterator(PrefetchBatchIterator):
+    """
+    Apply a random symmetry of the patch grid (axis flips and, for axes of
+    the same length, axis permutations, which together include all the
+    90 degree rotations) to each minibatch with probability symmetry_p.
+    The symmetry is applied as a strided view of the batch, so the data is
+    only copied once into the contiguous batch handed to Theano. All the
+    inputs (or those in input_layers) get the same symmetry and the labels
+    are transformed only if they have the same spatial shape as the inputs.
+    Only 3D patches (5D batches) are transformed. A symmetry of a 2D view
+    (like the orthogonal slices of the 2.5D patches) is not a symmetry of
+    the volume, so the other inputs are left untouched.
+    """
+    def __init__(self, symmetry_p=1.0, input_layers=None, flip=True, permute=True, *args, **kwargs):
+        super(DiscreteSymmetryBatchIterator,
+              self).__init__(*args, **kwargs)
+        self.symmetry_p = symmetry_p
+        self.input_layers = input_layers
+        self.flip = flip
+        self.permute = permute
+
+    def transform(self, xb, yb):
+        xb, yb = super(DiscreteSymmetryBatchIterator,
+                       self).transform(xb, yb)
+        if self.transform_random.random() >= self.symmetry_p:
+            return xb, yb
+
+        symmetries = dict()
+        if isinstance(xb, dict):
+            input_layers = self.input_layers if self.input_layers is not None else xb.keys()
+            input_layers = [k for k in input_layers if k in xb and xb[k].ndim == 5]
+            xb_transformed = {
+                k: self.transform_symmetry(v, symmetries) if k in input_layers else v
+                for k, v in xb.items()
+            }
+            shapes = [v.shape[2:] for k, v in xb.items() if k in input_layers]
+        elif xb.ndim == 5:
+            xb_transformed = self.transform_symmetry(xb, symmetries)
+            shapes = [xb.shape[2:]]
+        else:
+            return xb, yb
+        if yb is not None and yb.ndim > 1 and yb.shape[1:] in shapes:
+            yb = self.transform_symmetry(yb, symmetries, n_lead=1)
+
+        return xb_transformed, yb
+
+    def get_symmetry(self, shape):
+        n_axes = len(shape)
+        flips = self.transform_random.random(n_axes) < 0.5 if self.flip else np.zeros(n_axes, dtype=bool)
+        axes = np.arange(n_axes)
+        if self.permute:
+            # Only axes with the same length can be swapped
+            for length in set(shape):
+                same = np.flatnonzero(np.array(shape) == length)
+                axes[same] = self.transform_random.permutation(same)
+        return flips, axes
+
+    def transform_symmetry(self, x, symmetries, n_lead=2):
+        shape = x.shape[n_lead:]
+        if shape not in symmetries:
+            symmetries[shape] = self.get_symmetry(shape)
+        flips, axes = symmetries[shape]
+        lead = tuple(range(n_lead))
+        x_view = x.transpose(lead + tuple(n_lead + axes))
+        x_view = x_view[tuple([slice(None)] * n_lead + [slice(None, None, -1) if f else slice(None) for f in flips])]
+        return np.ascontiguousarray(x_view)
+
+
+class AugmentationBank(object):
+    """
+    Pool of precomputed random affine resamplings for each sample, stored in
+    a memory-mapped file. The whole pool is computed once and only a fraction
+    of it (refresh) is recomputed on each epoch. The samples are given by
+    their position in the source array, and ids keeps the pool of the sample
+    in each position when the source is shuffled in place.
+    """
+    def __init__(self, pool_size=16, refresh=0.1, directory=None):
+        self.pool_size = pool_size
+        self.refresh = refresh
+        self.directory = directory
+        self.source = None
+        self.data = None
+        self.ids = None
+
+    def build(self, x, random=np.random):
+        self.source = x
+        self.ids = np.arange(len(x))
+        shape = (len(x), self.pool_size) + x.shape[1:]
+        self.data = np.memmap(tempfile.TemporaryFile(dir=self.directory), dtype=x.dtype, mode='w+', shape=shape)
+        for i in range(len(x)):
+            for j in range(self.pool_size):
+                self.data[i, j] = affine_transform(x[i], random_affine3d_matrix(random=random))
+
+    def follow_shuffle(self, state):
+        # Same permutation as shuffling the source with a RandomState in this state
+        random = np.random.RandomState()
+        random.set_state(state)
+        random.shuffle(self.ids)
+
+    def update(self, random=np.random):
+        n_refresh = int(np.ceil(self.refresh * self.pool_size))
+        for i in range(len(self.source)):
+            for j in random.permutation(self.pool_size)[:n_refresh]:
+                self.data[self.ids[i], j] = affine_transform(self.source[i], random_affine3d_matrix(random=random))
+
+    def sample(self, i, n, random=np.random):
+        indices = random.permutation(self.pool_size)[:n] if n <= self.pool_size\
+            else random.randint(0, self.pool_size, n)
+        return self.data[self.ids[i], np.sort(indices)]
+
+
+class Affine3DTransformExpandBatchIterator(PrefetchBatchIterator):
     """
     Apply affine transform (scale, translate and rotation)
     with a random chance
+    If bank_size is given, the transformed volumes are drawn from an
+    AugmentationBank with bank_size resamplings per sample, of which a
+    bank_refresh fraction is recomputed each epoch.
     """
     def __init__(self, parameter_range=(-np.pi/36, np.pi/36), input_layers=list(),
-                 *args, **kwargs):
+                 bank_size=None, bank_refresh=0.1, bank_dir=None, *args, **kwargs):
         super(Affine3DTransformExpandBatchIterator,
               self).__init__(*args, **kwargs)
         self.range = max(parameter_range) - min(parameter_range)
         self.min = min(parameter_range)
         self.input_layers = input_layers
+        self.bank_size = bank_size
+        self.bank_refresh = bank_refresh
+        self.bank_dir = bank_dir
+        self.banks = dict()
+
+    def prepare(self, random):
+        if self.bank_size:
+            # Only the inputs of a dictionary are transformed
+            _update_banks(self, self.input_layers if isinstance(self.X, dict) else [], random)
 
     def __iter__(self):
         bs = self.batch_size
@@ -67,21 +351,23 @@ class Affine3DTransformExpandBatchIterator(BatchIterator):
             arr = self.X
             if isinstance(arr, dict):
                 xb = {k:
-                      self.transform_expand(v[i]) if k in self.input_layers
-                      else np.repeat(np.expand_dims(v[i], axis=0), bs, axis=0)
+                      self.transform_expand(v[i], self.banks.get(k), i) if k in self.input_layers
+                      else np.broadcast_to(v[i], (bs,) + v[i].shape)
                       for k, v in arr.items()
                       }
             else:
-                xb = np.repeat(np.expand_dims(arr[i], axis=0), bs, axis=0)
+                xb = np.broadcast_to(arr[i], (bs,) + arr[i].shape)
             if self.y is not None:
-                yb = np.repeat(np.expand_dims(self.y[i], axis=0), bs, axis=0)
+                yb = np.broadcast_to(self.y[i], (bs,) + self.y[i].shape)
             else:
                 yb = None
             yield self.transform(xb, yb)
 
-    def transform_expand(self, x):
+    def transform_expand(self, x, bank=None, i=None):
 
-        x_trans = np.concatenate([x] + [affine_transform(x, random_affine3d_matrix()) for i in range(self.batch_size-1)])
+        x_trans = np.concatenate([x] + list(bank.sample(i, self.batch_size-1, self.transform_random))) if bank is not None\
+            else np.concatenate([x] + [
+                affine_transform(x, random_affine3d_matrix(random=self.transform_random)) for _ in range(self.batch_size-1)
+            ])
 
         return np.expand_dims(x_trans, axis=1)
-
@@ -1,23 +1,161 @@
+from inspect import getargspec
+import numpy as np
 import theano
 import theano.tensor as T
 
-from lasagne.init import Constant
+from lasagne.init import Constant, GlorotUniform
 from lasagne.layers import Layer, MergeLayer
+from lasagne.layers.conv import conv_output_length
+from lasagne.nonlinearities import rectify, identity
 from lasagne.utils import as_tuple
+from ops import trilinear_sample_3d
 
 
 class Unpooling3D(Layer):
     def __init__(self, pool_size=2, ignore_border=True, **kwargs):
         super(Unpooling3D, self).__init__(**kwargs)
-        self.pool_size = pool_size
+        self.pool_size = as_tuple(pool_size, 3)
         self.ignore_border = ignore_border
 
     def get_output_for(self, data, **kwargs):
-        output = data.repeat(self.pool_size, axis=2).repeat(self.pool_size, axis=3).repeat(self.pool_size, axis=4)
-        return output
+        # Each voxel is broadcasted to its pooling block with a single alloc and then
+        # reshaped (no intermediate copies). The gradient is a single sum over the
+        # broadcasted axes.
+        num_batch, num_channels, height, width, depth = data.shape
+        ph, pw, pd = self.pool_size
+        output = T.alloc(
+            data.dimshuffle(0, 1, 2, 'x', 3, 'x', 4, 'x'),
+            num_batch, num_channels, height, ph, width, pw, depth, pd
+        )
+        return T.reshape(output, (num_batch, num_channels, height * ph, width * pw, depth * pd), ndim=5)
 
     def get_output_shape_for(self, input_shape):
-        return input_shape[:2] + tuple(a * self.pool_size for a in input_shape[2:])
+        return input_shape[:2] + tuple(None if a is None else a * p for a, p in zip(input_shape[2:], self.pool_size))
+
+
+class MaxUnpooling3D(MergeLayer):
+    """
+    Max unpooling using the switches of a MaxPool3DLayer. Each value is placed
+    at the position of the maximum of its pooling block and the rest of the
+    block is set to 0. As in lasagne's InverseLayer, the switches are taken
+    from the gradient of the pooling layer.
+    """
+    def __init__(self, incoming, pool_layer, **kwargs):
+        super(MaxUnpooling3D, self).__init__(
+            [incoming, pool_layer, pool_layer.input_layer], **kwargs)
+
+    def get_output_shape_for(self, input_shapes):
+        return input_shapes[2]
+
+    def get_output_for(self, inputs, **kwargs):
+        data, pool_output, pool_input = inputs
+        return theano.grad(None, wrt=pool_input, known_grads={pool_output: data})
+
+
+class GroupedConv3DLayer(MergeLayer):
+    """
+    Computes several parallel 3D convolutions (one per incoming) with a single
+    grouped convolution. All the incomings must have the same shape and all
+    the convolutions share filter size, number of filters and padding.
+
+    Each convolution is represented by one of the members of this layer
+    (a GroupMemberLayer in self.members) that behaves like a Conv3DLayer:
+    it keeps its own name, W, b and nonlinearity, so batch_norm can be
+    applied to it and saved weights are loaded by name as with separate
+    convolutions. tied[i] (if not None) is the index of a previous member
+    whose parameters are shared with member i.
+
+    If the grouped convolution is not supported by Theano, each group is
+    convolved separately and the outputs are concatenated.
+    """
+    def __init__(self, incomings, num_filters, filter_size, pad=0, W=GlorotUniform(), b=Constant(0.),
+                 nonlinearity=rectify, flip_filters=True, names=None, tied=None, **kwargs):
+        super(GroupedConv3DLayer, self).__init__(incomings, **kwargs)
+        if any(shape != self.input_shapes[0] for shape in self.input_shapes):
+            raise ValueError("All the grouped inputs must have the same shape")
+        self.num_groups = len(incomings)
+        self.num_filters = num_filters
+        self.filter_size = as_tuple(filter_size, 3)
+        self.pad = pad if isinstance(pad, str) else as_tuple(pad, 3)
+        self.flip_filters = flip_filters
+
+        names = [None] * self.num_groups if names is None else names
+        tied = [None] * self.num_groups if tied is None else tied
+        w_shape = (num_filters, self.input_shapes[0][1]) + self.filter_size
+        self.members = list()
+        for i, (name, tie) in enumerate(zip(names, tied)):
+            member_w = W if tie is None else self.members[tie].W
+            member_b = b if tie is None else self.members[tie].b
+            self.members.append(
+                GroupMemberLayer(self, i, num_filters, w_shape, member_w, member_b, nonlinearity, name=name)
+            )
+
+    def get_output_shape_for(self, input_shapes):
+        shape = input_shapes[0]
+        pad = self.pad if isinstance(self.pad, tuple) else (self.pad,) * 3
+        return (shape[0], self.num_groups * self.num_filters) + tuple(
+            conv_output_length(s, f, 1, p) for s, f, p in zip(shape[2:], self.filter_size, pad)
+        )
+
+    def get_output_for(self, inputs, **kwargs):
+        border_mode = 'half' if self.pad == 'same' else self.pad
+        if 'num_groups' in getargspec(T.nnet.conv3d).args:
+            data = T.concatenate(inputs, axis=1)
+            filters = T.concatenate([member.W for member in self.members], axis=0)
+            return T.nnet.conv3d(
+                data, filters,
+                border_mode=border_mode,
+                filter_flip=self.flip_filters,
+                num_groups=self.num_groups
+            )
+        # Older Theano versions (like the pinned one) do not have grouped convolutions. A block
+        # diagonal filter bank would cost num_groups times the operations, so each group gets its
+        # own convolution instead.
+        return T.concatenate([
+            T.nnet.conv3d(x, member.W, border_mode=border_mode, filter_flip=self.flip_filters)
+            for x, member in zip(inputs, self.members)
+        ], axis=1)
+
+
+class GroupMemberLayer(Layer):
+    """
+    One of the convolutions of a GroupedConv3DLayer. It selects its filters
+    from the grouped output and applies its bias and nonlinearity.
+    """
+    def __init__(self, incoming, index, num_filters, w_shape, W, b, nonlinearity, **kwargs):
+        super(GroupMemberLayer, self).__init__(incoming, **kwargs)
+        self.index = index
+        self.num_filters = num_filters
+        self.nonlinearity = identity if nonlinearity is None else nonlinearity
+        self.W = self.add_param(W, w_shape, name='W')
+        self.b = None if b is None else self.add_param(b, (num_filters,), name='b', regularizable=False)
+
+    def get_output_shape_for(self, input_shape):
+        return (input_shape[0], self.num_filters) + input_shape[2:]
+
+    def get_output_for(self, data, **kwargs):
+        output = data[:, self.index * self.num_filters:(self.index + 1) * self.num_filters]
+        if self.b is not None:
+            output = output + self.b.dimshuffle('x', 0, 'x', 'x', 'x')
+        return self.nonlinearity(output)
+
+
+class BatchSplitLayer(Layer):
+    """
+    Returns one of the parts of a batch built by concatenating several inputs
+    with the same number of samples along the batch axis.
+    """
+    def __init__(self, incoming, index, parts=2, **kwargs):
+        super(BatchSplitLayer, self).__init__(incoming, **kwargs)
+        self.index = index
+        self.parts = parts
+
+    def get_output_shape_for(self, input_shape):
+        return (None if input_shape[0] is None else input_shape[0] // self.parts,) + input_shape[1:]
+
+    def get_output_for(self, data, **kwargs):
+        size = data.shape[0] // self.parts
+        return data[self.index * size:(self.index + 1) * size]
 
 
 class WeightedSumLayer(MergeLayer):
@@ -58,6 +196,13 @@ class Transformer3DLayer(MergeLayer):
         output image (in both spatial dimensions). A value of 1 will keep the
         original size of the input. Values larger than 1 will downsample the
         input. Values below 1 will upsample the input.
+    native : bool or None
+        Use the compiled TrilinearSampler3D op instead of the Theano graph
+        for the interpolation. By default it is used on CPU devices.
+    stride : int
+        Only sample every stride-th voxel of the output grid. The sampled
+        positions are the voxels of the full grid (no resampling), so the
+        output can be compared with a strided target volume.
     References
     ----------
     .. [1]  Max Jaderberg, Karen Simonyan, Andrew Zisserman,
@@ -86,10 +231,12 @@ class Transformer3DLayer(MergeLayer):
     """
 
     def __init__(self, incoming, localization_network, downsample_factor=1,
-                 **kwargs):
+                 native=None, stride=1, **kwargs):
         super(Transformer3DLayer, self).__init__(
             [incoming, localization_network], **kwargs)
         self.downsample_factor = as_tuple(downsample_factor, 3)
+        self.stride = stride
+        self.native = theano.config.device.startswith('cpu') if native is None else native
 
         input_shp, loc_shp = self.input_shapes
 
@@ -104,27 +251,69 @@ class Transformer3DLayer(MergeLayer):
     def get_output_shape_for(self, input_shapes):
         shape = input_shapes[0]
         factors = self.downsample_factor
-        return (shape[:2] + tuple(None if s is None else int(s // f)
+        stride = self.stride
+        return (shape[:2] + tuple(None if s is None else (int(s // f) + stride - 1) // stride
                                   for s, f in zip(shape[2:], factors)))
 
     def get_output_for(self, inputs, **kwargs):
         # see eq. (1) and sec 3.1 in [1]
         input_l, theta = inputs
-        return _transform_affine(theta, input_l, self.downsample_factor)
+        return _transform_affine(
+            theta, input_l, self.downsample_factor, self.input_shapes[0], self.native, self.stride
+        )
+
 
+class AffineComposeLayer(MergeLayer):
+    """
+    Composes two batches of flattened (batch_size, 12) affine transforms as
+    A_prev x A_delta (in homogeneous coordinates). When A_prev was used to warp
+    an input, A_delta is a refinement estimated on the warped input, and the
+    output is the transform to apply to the original input.
+    """
+    def __init__(self, incomings, **kwargs):
+        super(AffineComposeLayer, self).__init__(incomings, **kwargs)
+        for shape in self.input_shapes:
+            if shape[-1] != 12 or len(shape) != 2:
+                raise ValueError("The transforms must have "
+                                 "output shape: (batch_size, 12)")
 
-def _transform_affine(theta, input_l, downsample_factor):
+    def get_output_shape_for(self, input_shapes):
+        return input_shapes[0]
+
+    def get_output_for(self, inputs, **kwargs):
+        prev, delta = [T.reshape(theta, (-1, 3, 4)) for theta in inputs]
+        output = T.batched_dot(prev[:, :, :3], delta)
+        output = T.inc_subtensor(output[:, :, 3], prev[:, :, 3])
+        return T.reshape(output, (-1, 12))
+
+
+def _transform_affine(theta, input_l, downsample_factor, input_shape=None, native=False, stride=1):
     num_batch, num_channels, height, width, depth = input_l.shape
     theta = T.reshape(theta, (-1, 3, 4))
 
     # grid of (x_t, y_t, z_t, 1), eq (1) in ref [1]
-    out_height = T.cast(height // downsample_factor[0], 'int64')
-    out_width = T.cast(width // downsample_factor[1], 'int64')
-    out_depth = T.cast(width // downsample_factor[2], 'int64')
-    grid = _meshgrid(out_height, out_width, out_depth)
+    # When the spatial shape is known beforehand, the grid is a constant.
+    static_shape = input_shape is not None and all(s is not None for s in input_shape[2:])
+    if static_shape:
+        full_shape = [int(s // f) for s, f in zip(input_shape[2:], downsample_factor)]
+        out_height, out_width, out_depth = [(s + stride - 1) // stride for s in full_shape]
+        grid = T.constant(_meshgrid_numpy(*full_shape, stride=stride), dtype=theano.config.floatX)
+    else:
+        full_height = T.cast(height // downsample_factor[0], 'int64')
+        full_width = T.cast(width // downsample_factor[1], 'int64')
+        full_depth = T.cast(depth // downsample_factor[2], 'int64')
+        out_height = (full_height + stride - 1) // stride
+        out_width = (full_width + stride - 1) // stride
+        out_depth = (full_depth + stride - 1) // stride
+        grid = _meshgrid(full_height, full_width, full_depth, stride)
 
     # Transform A x (x_t, y_t, z_t, 1)^T -> (x_s, y_s, z_s)
     T_g = T.dot(theta, grid)
+
+    if native:
+        input_transformed = trilinear_sample_3d(input_l, T_g)
+        return T.reshape(input_transformed, (num_batch, num_channels, out_height, out_width, out_depth))
+
     x_s = T_g[:, 0]
     y_s = T_g[:, 1]
     z_s = T_g[:, 2]
@@ -215,10 +404,10 @@ def _interpolate(im, x, y, z, out_height, out_width, out_depth):
     wb = ((x1_f - x) * (y - y0_f) * (z1_f - z)).dimshuffle(0, 'x')
     wc = ((x - x0_f) * (y1_f - y) * (z1_f - z)).dimshuffle(0, 'x')
     wd = ((x - x0_f) * (y - y0_f) * (z1_f - z)).dimshuffle(0, 'x')
-    we = ((x1_f - x) * (y1_f - y) * (z0_f - z)).dimshuffle(0, 'x')
-    wf = ((x1_f - x) * (y - y0_f) * (z0_f - z)).dimshuffle(0, 'x')
-    wg = ((x - x0_f) * (y1_f - y) * (z0_f - z)).dimshuffle(0, 'x')
-    wh = ((x - x0_f) * (y - y0_f) * (z0_f - z)).dimshuffle(0, 'x')
+    we = ((x1_f - x) * (y1_f - y) * (z - z0_f)).dimshuffle(0, 'x')
+    wf = ((x1_f - x) * (y - y0_f) * (z - z0_f)).dimshuffle(0, 'x')
+    wg = ((x - x0_f) * (y1_f - y) * (z - z0_f)).dimshuffle(0, 'x')
+    wh = ((x - x0_f) * (y - y0_f) * (z - z0_f)).dimshuffle(0, 'x')
     output = T.sum([wa * Ia, wb * Ib, wc * Ic, wd * Id, we * Ie, wf * If, wg *Ig, wh * Ih], axis=0)
     return output
 
@@ -232,7 +421,19 @@ def _linspace(start, stop, num):
     return T.arange(num, dtype=theano.config.floatX) * step + start
 
 
-def _meshgrid(height, width, depth):
+def _meshgrid_numpy(height, width, depth, stride=1):
+    # Numpy version of _meshgrid (same ordering) for grids of known size
+    x_t, y_t, z_t = np.meshgrid(
+        np.linspace(-1.0, 1.0, height)[::stride],
+        np.linspace(-1.0, 1.0, width)[::stride],
+        np.linspace(-1.0, 1.0, depth)[::stride],
+        indexing='ij'
+    )
+    ones = np.ones(x_t.size)
+    return np.vstack([x_t.flatten(), y_t.flatten(), z_t.flatten(), ones]).astype(theano.config.floatX)
+
+
+def _meshgrid(height, width, depth, stride=1):
     # This function is the grid generator from eq. (1) in reference [1].
     # It is equivalent to the following numpy code:
     #  x_t, y_t,z_t = np.meshgrid(np.linspace(-1, 1, width),
@@ -243,19 +444,24 @@ def _meshgrid(height, width, depth):
     # Note: If the image size is known at layer construction time, we could
     # compute the meshgrid offline in numpy instead of doing it dynamically
     # in Theano. However, it hardly affected performance when we tried.
+    # With stride > 1 only every stride-th point of each axis is kept.
+    x_lin = _linspace(-1.0, 1.0, height)[::stride]
+    y_lin = _linspace(-1.0, 1.0, width)[::stride]
+    z_lin = _linspace(-1.0, 1.0, depth)[::stride]
+    height, width, depth = x_lin.shape[0], y_lin.shape[0], z_lin.shape[0]
     x_t = T.dot(
         T.reshape(T.dot(
-            _linspace(-1.0, 1.0, height).dimshuffle(0, 'x'),
+            x_lin.dimshuffle(0, 'x'),
             T.ones((1, width))), (height, width, 1)),
         T.ones((1, 1, depth))
     )
     y_t = T.dot(
         T.reshape(T.dot(
             T.ones((height, 1)),
-            _linspace(-1.0, 1.0, width).dimshuffle('x', 0)), (height, width, 1)),
+            y_lin.dimshuffle('x', 0)), (height, width, 1)),
         T.ones((1, 1, depth))
     )
-    z_t = T.dot(T.ones((height, width, 1)), T.reshape(_linspace(-1.0, 1.0, depth), (1, 1, -1)))
+    z_t = T.dot(T.ones((height, width, 1)), T.reshape(z_lin, (1, 1, -1)))
 
     x_t_flat = x_t.reshape((1, -1))
     y_t_flat = y_t.reshape((1, -1))
@@ -0,0 +1,81 @@
+import numpy as np
+import theano
+from lasagne.layers import get_all_layers, get_all_params, InputLayer
+
+# Default memory budget (in bytes) when none is given
+DEFAULT_BUDGET = 2**30
+
+
+def activation_bytes(output_layer):
+    # Bytes of the outputs of all the layers for one sample
+    itemsize = np.dtype(theano.config.floatX).itemsize
+    return itemsize * sum(
+        np.prod([s for s in layer.output_shape[1:] if s is not None]) for layer in get_all_layers(output_layer)
+    )
+
+
+def parameter_bytes(output_layer):
+    return sum(p.get_value(borrow=True).nbytes for p in get_all_params(output_layer))
+
+
+def input_bytes(output_layer):
+    # Bytes of the inputs for one sample
+    itemsize = np.dtype(theano.config.floatX).itemsize
+    return itemsize * sum(
+        np.prod([s for s in layer.output_shape[1:] if s is not None])
+        for layer in get_all_layers(output_layer) if isinstance(layer, InputLayer)
+    )
+
+
+class MemoryPlanner(object):
+    """
+    Estimates the memory used by a lasagne graph and chooses batch sizes
+    that fit in a memory budget (in bytes).
+
+    For inference, each sample needs its inputs and the outputs of every
+    layer. Training also keeps the gradients of all the activations, and
+    the parameters are stored together with their gradients and
+    optimiser_copies more copies for the update rule (2 for adam).
+    """
+    def __init__(self, output_layer, budget=None, optimiser_copies=2, min_batch=1, max_batch=None):
+        self.output_layer = output_layer
+        self.budget = DEFAULT_BUDGET if budget is None else budget
+        self.optimiser_copies = optimiser_copies
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.activations = activation_bytes(output_layer)
+        self.inputs = input_bytes(output_layer)
+        self.parameters = parameter_bytes(output_layer)
+
+    def inference_sample_bytes(self):
+        return self.inputs + self.activations
+
+    def train_sample_bytes(self):
+        return self.inputs + 2 * self.activations
+
+    def train_fixed_bytes(self):
+        return self.parameters * (2 + self.optimiser_copies)
+
+    def _batch_size(self, available, sample_bytes):
+        batch_size = max(self.min_batch, int(available // sample_bytes))
+        return min(batch_size, self.max_batch) if self.max_batch else batch_size
+
+    def inference_batch_size(self):
+        return self._batch_size(self.budget - self.parameters, self.inference_sample_bytes())
+
+    def train_batch_size(self):
+        return self._batch_size(self.budget - self.train_fixed_bytes(), self.train_sample_bytes())
+
+
+def plan_training(net, budget=None):
+    """
+    Reduces the training batch size of a NeuralNet (if needed) to fit in
+    budget according to a MemoryPlanner and returns the planner. The
+    configured batch size is never increased, since that would change the
+    optimisation.
+    """
+    net.initialize()
+    batch_size = net.batch_iterator_train.batch_size
+    planner = MemoryPlanner(net.layers_[-1], budget, max_batch=batch_size)
+    net.batch_iterator_train.batch_size = planner.train_batch_size()
+    return planner
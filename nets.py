@@ -1,35 +1,69 @@
 from operator import mul
 import itertools
 from nolearn.lasagne import NeuralNet, BatchIterator
-from nolearn.lasagne.handlers import SaveWeights
-from utils import EarlyStopping, WeightsLogger
+from utils import EarlyStopping, CheckpointManager
 from lasagne import objectives
 from lasagne.layers import InputLayer
 from lasagne.layers import ReshapeLayer, DenseLayer, DropoutLayer, ElemwiseSumLayer, ConcatLayer, FlattenLayer
+from lasagne.layers import BatchNormLayer, NonlinearityLayer
 from lasagne.layers import Conv2DLayer, Conv3DLayer, MaxPool2DLayer, MaxPool3DLayer, Pool3DLayer, batch_norm
-from layers import Unpooling3D, Transformer3DLayer, WeightedSumLayer
+from layers import Unpooling3D, MaxUnpooling3D, Transformer3DLayer, WeightedSumLayer, AffineComposeLayer
+from layers import GroupedConv3DLayer, BatchSplitLayer
 from lasagne import updates
 from lasagne import nonlinearities
 from lasagne.init import Constant
 import objective_functions as objective_f
 from iterators import Affine3DTransformBatchIterator, Affine3DTransformExpandBatchIterator
+from iterators import DiscreteSymmetryBatchIterator
+from compile_cache import CachedNeuralNet
+from checkpoint import SaveCheckpoint, SaveTrainingState
 import numpy as np
 
 
-def get_epoch_finished(name, patience):
+def get_epoch_finished(name, patience, snapshot_every=0, keyframe_every=10, keep=None, state_every=10):
+    # The training state is saved last, when the rest of handlers have been updated
+    checkpoints = CheckpointManager(
+        name + 'training_log.jsonl',
+        snapshot_every=snapshot_every,
+        keyframe_every=keyframe_every,
+        keep=keep
+    )
     return [
-        SaveWeights(name + 'model_weights.pkl', only_best=True, pickle=False),
-        WeightsLogger(name + 'weights_log.pkl'),
-        EarlyStopping(patience=patience)
+        SaveCheckpoint(name + 'model_weights.ckpt', only_best=True),
+        checkpoints,
+        EarlyStopping(patience=patience, checkpoints=checkpoints),
+        SaveTrainingState(name + 'training_state.ckpt', every_n_epochs=state_every)
     ]
 
 
-def get_back_pathway(forward_pathway, multi_channel=True):
+def reset_epoch_finished(net, name):
+    # The handlers of get_epoch_finished start a new training run that writes its files with a new name
+    # (they are found by type, since nolearn appends a PrintLog to the same list when the net is verbose)
+    handlers = net.on_epoch_finished if isinstance(net.on_epoch_finished, (list, tuple)) else [net.on_epoch_finished]
+    for h in handlers:
+        if isinstance(h, SaveCheckpoint):
+            h.path = name + 'model_weights.ckpt'
+        elif isinstance(h, CheckpointManager):
+            h.reset(name + 'training_log.jsonl')
+        elif isinstance(h, EarlyStopping):
+            h.reset()
+        elif isinstance(h, SaveTrainingState):
+            h.path = name + 'training_state.ckpt'
+
+
+def get_training_finished(epoch_finished):
+    # The checkpoint writers have to finish their pending writes and the training state is removed
+    return [h.finish for h in epoch_finished if isinstance(h, (CheckpointManager, SaveTrainingState))]
+
+
+def get_back_pathway(forward_pathway, multi_channel=True, max_unpooling=False):
     # We create the backwards path of the encoder from the forward path
     # We need to mirror the configuration of the layers and change the pooling operators with unpooling,
     # and the convolutions with deconvolutions (convolutions with diferent padding). This definitions
-    # match the values of the possible_layers dictionary
-    back_pathway = ''.join(['d' if l is 'c' else 'u' for l in forward_pathway[::-1]])
+    # match the values of the possible_layers dictionary. Max pooling layers can also be mirrored with
+    # max unpooling layers (that reuse the pooling switches).
+    back_pathway = ''.join(['d' if l is 'c' else 'M' if max_unpooling and l is 'm' else 'u'
+                            for l in forward_pathway[::-1]])
     last_conv = back_pathway.rfind('d')
     final_conv = 'f' if multi_channel else 'fU'
     back_pathway = back_pathway[:last_conv] + final_conv + back_pathway[last_conv + 1:]
@@ -45,14 +79,18 @@ def get_layers_string(
         dense_size=256,
         number_filters=32,
         multi_channel=True,
-        padding='valid'
+        padding='valid',
+        grouped=False
 ):
+    # With grouped=True, the convolutions of each channel (for multi_channel=False) are computed
+    # with one grouped convolution.
     input_shape_single = tuple(input_shape[:1] + (1,) + input_shape[2:])
     channels = range(0, input_shape[1])
     previous_layer = InputLayer(name='\033[30minput\033[0m', shape=input_shape) if multi_channel\
         else [InputLayer(name='\033[30minput_%d\033[0m' % i, shape=input_shape_single) for i in channels]
 
     convolutions = dict()
+    pools = dict()
     c_index = 1
     p_index = 1
     c_size = (convo_size, convo_size, convo_size)
@@ -68,6 +106,16 @@ def get_layers_string(
                 ),
                 name='norm%d' % c_index
             ) if multi_channel else [batch_norm(
+                layer=member,
+                name='norm%d_%d' % (c_index, i)
+            ) for member, i in zip(GroupedConv3DLayer(
+                incomings=previous_layer,
+                name='\033[34mgconv%d\033[0m' % c_index,
+                num_filters=number_filters,
+                filter_size=c_size,
+                pad=padding,
+                names=['\033[34mconv%d_%d\033[0m' % (c_index, i) for i in channels]
+            ).members, channels)] if grouped else [batch_norm(
                 layer=Conv3DLayer(
                     incoming=layer,
                     name='\033[34mconv%d_%d\033[0m' % (c_index, i),
@@ -132,7 +180,19 @@ def get_layers_string(
                 name='\033[31mmax_pool%d_%d\033[0m' % (p_index, i),
                 pool_size=pool_size
             ) for layer, i in zip(previous_layer, channels)]
+            pools['pool%d' % p_index] = previous_layer
             p_index += 1
+        elif layer == 'M':
+            p_index -= 1
+            previous_layer = MaxUnpooling3D(
+                incoming=previous_layer,
+                pool_layer=pools['pool%d' % p_index],
+                name='\033[35mmax_unpool%d\033[0m' % p_index
+            ) if multi_channel else [MaxUnpooling3D(
+                incoming=layer,
+                pool_layer=pool,
+                name='\033[35mmax_unpool%d_%d\033[0m' % (p_index, i)
+            ) for pool, layer, i in zip(pools['pool%d' % p_index], previous_layer, channels)]
         elif layer == 'u':
             p_index -= 1
             previous_layer = Unpooling3D(
@@ -242,7 +302,8 @@ def get_layers_registration(
         convo_blocks=2,
         convo_size=3,
         pool_size=2,
-        number_filters=32
+        number_filters=32,
+        stride=1
 ):
     source_input = InputLayer(name='\033[30mbaseline\033[0m', shape=(None, 1) + tuple(input_shape))
     source = source_input
@@ -271,10 +332,99 @@ def get_layers_registration(
             name='\033[33mloc_net\033[0m',
             num_units=12,
             W=w,
-            b=b.flatten,
+            b=b.flatten(),
             nonlinearity=None
         ),
         incoming=source_input,
+        stride=stride,
+        name='\033[33mtransf\033[0m'
+    )
+    output = FlattenLayer(
+        incoming=register,
+        name='\033[32m3d_out\033[0m',
+    )
+    return output
+
+
+def get_layers_registration_pyramid(
+        input_shape,
+        levels=3,
+        convo_blocks=1,
+        convo_size=3,
+        pool_size=2,
+        number_filters=32,
+        stride=1
+):
+    # Coarse to fine registration. Each level estimates a refinement of the
+    # current transform from the inputs downsampled by pool_size ** level,
+    # after warping the baseline with that transform. Only the final
+    # transformer works at full resolution (sampling every stride-th voxel).
+    source_input = InputLayer(name='\033[30mbaseline\033[0m', shape=(None, 1) + tuple(input_shape))
+    target_input = InputLayer(name='\033[30mfollow\033[0m', shape=(None, 1) + tuple(input_shape))
+
+    b = np.zeros((3, 4), dtype='float32')
+    b[0, 0] = 1
+    b[1, 1] = 1
+    b[2, 2] = 1
+    theta = None
+    for level in range(levels, 0, -1):
+        factor = pool_size ** level
+        source = Pool3DLayer(
+            incoming=source_input,
+            name='\033[31mavg_pool_baseline_l%d\033[0m' % level,
+            pool_size=factor,
+            mode='average_inc_pad'
+        )
+        target = Pool3DLayer(
+            incoming=target_input,
+            name='\033[31mavg_pool_follow_l%d\033[0m' % level,
+            pool_size=factor,
+            mode='average_inc_pad'
+        )
+        if theta is not None:
+            source = Transformer3DLayer(
+                localization_network=theta,
+                incoming=source,
+                name='\033[33mtransf_l%d\033[0m' % level
+            )
+
+        counter = itertools.count()
+        for i in range(convo_blocks):
+            source, target = get_shared_convolutional_block(
+                source,
+                target,
+                convo_size=convo_size,
+                num_filters=number_filters,
+                pool_size=pool_size,
+                padding='same',
+                counter=counter,
+                sufix='l%d' % level
+            )
+
+        name = '\033[33mloc_net\033[0m' if level == 1 and theta is None else '\033[33mloc_net_l%d\033[0m' % level
+        delta = DenseLayer(
+            incoming=ConcatLayer(
+                incomings=[source, target],
+                name='union_l%d' % level
+            ),
+            name=name,
+            num_units=12,
+            W=Constant(0.0),
+            b=b.flatten(),
+            nonlinearity=None
+        )
+        if theta is None:
+            theta = delta
+        else:
+            theta = AffineComposeLayer(
+                incomings=[theta, delta],
+                name='\033[33mloc_net\033[0m' if level == 1 else '\033[33mcompose_l%d\033[0m' % level
+            )
+
+    register = Transformer3DLayer(
+        localization_network=theta,
+        incoming=source_input,
+        stride=stride,
         name='\033[33mtransf\033[0m'
     )
     output = FlattenLayer(
@@ -320,7 +470,8 @@ def get_convolutional_longitudinal(
     number_filters,
     padding,
     drop,
-    register
+    register,
+    grouped=False
 ):
     if not isinstance(convo_size, list):
         convo_size = [convo_size] * convo_blocks
@@ -365,6 +516,40 @@ def get_convolutional_longitudinal(
     ) for p1, p2, i in zip(baseline, followup, images)]
 
     for c, f in zip(convo_size, number_filters):
+        if grouped:
+            # All the convolutions of this level (baseline, follow-up and subtraction for each image)
+            # are computed at once. The member layers keep the names of the separate convolutions.
+            index = sub_counter.next()
+            indices = [convo_counter.next() for convo_counter in convo_counters]
+            sub_indices = [counter.next() for counter in subconvo_counters]
+            n_images = len(images)
+            sufixes = ['%s_1_%d' % (i, ind) for i, ind in zip(images, indices)] +\
+                ['%s_2_%d' % (i, ind) for i, ind in zip(images, indices)] +\
+                ['%s%d' % (i, ind) for i, ind in zip(images, sub_indices)]
+            convolutions = GroupedConv3DLayer(
+                incomings=list(baseline) + list(followup) + list(subtraction),
+                name='\033[34mgconv_%d\033[0m' % index,
+                num_filters=f,
+                filter_size=c,
+                pad=padding,
+                names=['\033[34mconv_%s\033[0m' % s for s in sufixes],
+                tied=[None] * n_images + range(n_images) + [None] * n_images
+            ).members
+            blocks = [get_pooling_block(conv, pool_size, drop, s) for conv, s in zip(convolutions, sufixes)]
+            baseline = blocks[:n_images]
+            followup = blocks[n_images:2 * n_images]
+            subtraction = [ElemwiseSumLayer(
+                name='subtraction_%s_%d' % (i, index),
+                incomings=[
+                    s,
+                    WeightedSumLayer(
+                        name='wsubtraction_%s_%d' % (i, index),
+                        incomings=[p1, p2]
+                    )
+                ]
+            ) for p1, p2, s, i in zip(baseline, followup, blocks[2 * n_images:], images)]
+            continue
+
         baseline, followup = zip(*[get_shared_convolutional_block(
             p1,
             p2,
@@ -411,6 +596,7 @@ def get_layers_longitudinal(
         padding='valid',
         drop=0.5,
         register=False,
+        grouped=False
 ):
     baseline, followup, subtraction = get_convolutional_longitudinal(
         convo_blocks,
@@ -421,7 +607,8 @@ def get_layers_longitudinal(
         number_filters,
         padding,
         drop,
-        register
+        register,
+        grouped
     )
 
     image_union = [ConcatLayer(
@@ -463,6 +650,7 @@ def get_layers_longitudinal_deformation(
             padding='valid',
             drop=0.5,
             register=False,
+            grouped=False
 ):
     if not isinstance(convo_size, list):
         convo_size = [convo_size] * convo_blocks
@@ -478,7 +666,8 @@ def get_layers_longitudinal_deformation(
         number_filters,
         padding,
         drop,
-        register
+        register,
+        grouped
     )
 
     defo_input_shape = (input_shape[:1] + (3,) + (convo_blocks*2+d_off, convo_blocks*2+d_off, convo_blocks*2+d_off))
@@ -542,18 +731,24 @@ def get_convolutional_block(
         filter_size=convo_size,
         pad=padding
     )
+
+    return get_pooling_block(convolution, pool_size, drop, '%s%d' % (sufix, index))
+
+
+def get_pooling_block(convolution, pool_size, drop, sufix):
+    # Normalisation, dropout and pooling after a convolution
     normalisation = batch_norm(
         layer=convolution,
-        name='norm_%s%d' % (sufix, index)
+        name='norm_%s' % sufix
     )
     dropout = DropoutLayer(
         incoming=normalisation,
-        name='drop_%s%d' % (sufix, index),
+        name='drop_%s' % sufix,
         p=drop
     )
     pool = Pool3DLayer(
         incoming=dropout,
-        name='\033[31mavg_pool_%s%d\033[0m' % (sufix, index),
+        name='\033[31mavg_pool_%s\033[0m' % sufix,
         pool_size=pool_size,
         mode='average_inc_pad'
     )
@@ -575,52 +770,52 @@ def get_shared_convolutional_block(
 
     index = counter.next()
 
-    convolution1 = Conv3DLayer(
-        incoming=incoming1,
-        name='\033[34mconv_%s_1_%d\033[0m' % (sufix, index),
-        num_filters=num_filters,
-        filter_size=convo_size,
-        pad=padding
+    # Both inputs are stacked along the batch axis to run the shared convolution, dropout and pooling
+    # only once. Each input keeps its own normalisation (with the same names as when there were two
+    # convolutions that shared their weights), so the parameters are the same as before.
+    union = ConcatLayer(
+        incomings=[incoming1, incoming2],
+        name='stack_%s_%d' % (sufix, index),
+        axis=0
     )
-    convolution2 = Conv3DLayer(
-        incoming=incoming2,
-        name='\033[34mconv_%s_2_%d\033[0m' % (sufix, index),
+    convolution = Conv3DLayer(
+        incoming=union,
+        name='\033[34mconv_%s_1_%d\033[0m' % (sufix, index),
         num_filters=num_filters,
         filter_size=convo_size,
-        W=convolution1.W,
-        b=convolution1.b,
-        pad=padding
-    )
-    normalisation1 = batch_norm(
-        layer=convolution1,
-        name='norm_%s_1_%d' % (sufix, index)
-    )
-    normalisation2 = batch_norm(
-        layer=convolution2,
-        name='norm_%s_2_%d' % (sufix, index)
+        pad=padding,
+        b=None,
+        nonlinearity=None
     )
-    dropout1 = DropoutLayer(
-        incoming=normalisation1,
-        name='drop_%s_1_%d' % (sufix, index),
-        p=drop
+    normalisation = ConcatLayer(
+        incomings=[NonlinearityLayer(
+            incoming=BatchNormLayer(
+                incoming=BatchSplitLayer(
+                    incoming=convolution,
+                    name='split_conv_%s_%d_%d' % (sufix, i, index),
+                    index=i - 1
+                ),
+                name='norm_%s_%d_%d' % (sufix, i, index)
+            ),
+            name='norm_%s_%d_%d_nonlin' % (sufix, i, index),
+            nonlinearity=nonlinearities.rectify
+        ) for i in [1, 2]],
+        name='stack_norm_%s_%d' % (sufix, index),
+        axis=0
     )
-    dropout2 = DropoutLayer(
-        incoming=normalisation2,
-        name='drop_%s_2_%d' % (sufix, index),
+    dropout = DropoutLayer(
+        incoming=normalisation,
+        name='drop_%s_%d' % (sufix, index),
         p=drop
     )
-    pool1 = Pool3DLayer(
-        incoming=dropout1,
-        name='\033[31mavg_pool_%s_1_%d\033[0m' % (sufix, index),
-        pool_size=pool_size,
-        mode='average_inc_pad'
-    )
-    pool2 = Pool3DLayer(
-        incoming=dropout2,
-        name='\033[31mavg_pool_%s_2_%d\033[0m' % (sufix, index),
+    pool = Pool3DLayer(
+        incoming=dropout,
+        name='\033[31mavg_pool_%s_%d\033[0m' % (sufix, index),
         pool_size=pool_size,
         mode='average_inc_pad'
     )
+    pool1 = BatchSplitLayer(incoming=pool, name='split_%s_1_%d' % (sufix, index), index=0)
+    pool2 = BatchSplitLayer(incoming=pool, name='split_%s_2_%d' % (sufix, index), index=1)
 
     return pool1, pool2
 
@@ -677,44 +872,32 @@ def get_shared_convolutional_block2d(
 ):
     index = counter.next()
 
-    convolution1 = Conv2DLayer(
-        incoming=incoming1,
-        name='\033[34mconv_%s1_%d\033[0m' % (sufix, index),
-        num_filters=num_filters,
-        filter_size=convo_size,
-        pad=padding,
-        nonlinearity=nonlinearity
+    # Both inputs are stacked along the batch axis to run the shared convolution only once
+    union = ConcatLayer(
+        incomings=[incoming1, incoming2],
+        name='stack_%s_%d' % (sufix, index),
+        axis=0
     )
-    convolution2 = Conv2DLayer(
-        incoming=incoming2,
-        name='\033[34mconv_%s2_%d\033[0m' % (sufix, index),
+    convolution = Conv2DLayer(
+        incoming=union,
+        name='\033[34mconv_%s1_%d\033[0m' % (sufix, index),
         num_filters=num_filters,
         filter_size=convo_size,
-        W=convolution1.W,
-        b=convolution1.b,
         pad=padding,
         nonlinearity=nonlinearity
     )
-    dropout1 = DropoutLayer(
-        incoming=convolution1,
-        name='drop_%s1_%d' % (sufix, index),
-        p=drop
-    )
-    dropout2 = DropoutLayer(
-        incoming=convolution2,
-        name='drop_%s2_%d' % (sufix, index),
+    dropout = DropoutLayer(
+        incoming=convolution,
+        name='drop_%s_%d' % (sufix, index),
         p=drop
     )
-    pool1 = MaxPool2DLayer(
-        incoming=dropout1,
-        name='\033[31mmax_pool_%s1_%d\033[0m' % (sufix, index),
-        pool_size=pool_size
-    )
-    pool2 = MaxPool2DLayer(
-        incoming=dropout2,
-        name='\033[31mmax_pool_%s2_%d\033[0m' % (sufix, index),
+    pool = MaxPool2DLayer(
+        incoming=dropout,
+        name='\033[31mmax_pool_%s_%d\033[0m' % (sufix, index),
         pool_size=pool_size
     )
+    pool1 = BatchSplitLayer(incoming=pool, name='split_%s1_%d' % (sufix, index), index=0)
+    pool2 = BatchSplitLayer(incoming=pool, name='split_%s2_%d' % (sufix, index), index=1)
 
     return pool1, pool2
 
@@ -776,19 +959,27 @@ def create_classifier_net(
         patience,
         name,
         obj_f='xent',
-        epochs=200
+        epochs=200,
+        symmetry_p=None,
+        symmetry_inputs=None,
+        cache_dir=None,
+        snapshots=None
 ):
-
+    # snapshots has the optional arguments of get_epoch_finished for the weight snapshots
+    # (snapshot_every, keyframe_every and keep)
     objective_function = {
         'xent': objectives.categorical_crossentropy,
         'pdsc': objective_f.probabilistic_dsc_objective,
         'ldsc': objective_f.logarithmic_dsc_objective
     }
+    epoch_finished = get_epoch_finished(name, patience, **(snapshots or {}))
 
-    return NeuralNet(
+    return CachedNeuralNet(
 
         layers=layers,
 
+        cache_dir=cache_dir,
+
         regression=False,
         objective_loss_function=objective_function[obj_f],
         custom_scores=[
@@ -800,9 +991,14 @@ def create_classifier_net(
         update=updates.adam,
         update_learning_rate=1e-4,
 
-        on_epoch_finished=get_epoch_finished(name, patience),
+        on_epoch_finished=epoch_finished,
+        on_training_finished=get_training_finished(epoch_finished),
 
-        batch_iterator_train=BatchIterator(batch_size=512),
+        batch_iterator_train=BatchIterator(batch_size=512) if not symmetry_p else DiscreteSymmetryBatchIterator(
+            batch_size=512,
+            symmetry_p=symmetry_p,
+            input_layers=symmetry_inputs
+        ),
 
         verbose=11,
         max_epochs=epochs
@@ -814,18 +1010,23 @@ def create_segmentation_net(
         patience,
         name,
         custom_scores=None,
-        epochs=200
+        epochs=200,
+        cache_dir=None
 ):
-    return NeuralNet(
+    epoch_finished = get_epoch_finished(name, patience)
+    return CachedNeuralNet(
 
         layers=layers,
 
+        cache_dir=cache_dir,
+
         regression=True,
 
         update=updates.adam,
         update_learning_rate=1e-3,
 
-        on_epoch_finished=get_epoch_finished(name, patience),
+        on_epoch_finished=epoch_finished,
+        on_training_finished=get_training_finished(epoch_finished),
 
         custom_scores=custom_scores,
 
@@ -845,18 +1046,23 @@ def create_registration_net(
                 input_layers=['\033[30mbaseline\033[0m']
             ),
             custom_scores=None,
-            epochs=200
+            epochs=200,
+            cache_dir=None
 ):
-        return NeuralNet(
+        epoch_finished = get_epoch_finished(name, patience)
+        return CachedNeuralNet(
 
             layers=layers,
 
+            cache_dir=cache_dir,
+
             regression=True,
 
             update=updates.adadelta,
             # update_learning_rate=1e-3,
 
-            on_epoch_finished=get_epoch_finished(name, patience),
+            on_epoch_finished=epoch_finished,
+            on_training_finished=get_training_finished(epoch_finished),
 
             custom_scores=custom_scores,
 
@@ -880,7 +1086,10 @@ def create_cnn3d_det_string(
             patience,
             multichannel,
             name,
-            epochs
+            epochs,
+            symmetry_p=None,
+            cache_dir=None,
+            snapshots=None
 ):
 
     # We create the final string defining the net with the necessary input and reshape layers
@@ -904,7 +1113,10 @@ def create_cnn3d_det_string(
         layer_list,
         patience,
         name,
-        epochs=epochs
+        epochs=epochs,
+        symmetry_p=symmetry_p,
+        cache_dir=cache_dir,
+        snapshots=snapshots
     )
 
 
@@ -922,7 +1134,11 @@ def create_cnn3d_longitudinal(
         defo,
         patience,
         name,
-        epochs
+        epochs,
+        symmetry_p=None,
+        grouped=False,
+        cache_dir=None,
+        snapshots=None
 ):
     layer_list = get_layers_longitudinal(
         convo_blocks=convo_blocks,
@@ -934,7 +1150,8 @@ def create_cnn3d_longitudinal(
         number_filters=number_filters,
         padding=padding,
         drop=drop,
-        register=register
+        register=register,
+        grouped=grouped
     ) if not defo else get_layers_longitudinal_deformation(
         convo_blocks=convo_blocks,
         input_shape=input_shape,
@@ -946,14 +1163,25 @@ def create_cnn3d_longitudinal(
         number_filters=number_filters,
         padding=padding,
         drop=drop,
-        register=register
+        register=register,
+        grouped=grouped
     )
 
+    # The deformation inputs are vector fields, flipping or permuting their axes would also require
+    # changing their components. Therefore, only the images are used for the symmetries.
+    symmetry_inputs = [
+        '\033[30m%s_%s\033[0m' % (t, i) for t in ['baseline', 'follow'] for i in images
+    ] if defo else None
+
     return create_classifier_net(
         layer_list,
         patience,
         name,
-        epochs=epochs
+        epochs=epochs,
+        symmetry_p=symmetry_p,
+        symmetry_inputs=symmetry_inputs,
+        cache_dir=cache_dir,
+        snapshots=snapshots
     )
 
 
@@ -961,7 +1189,9 @@ def create_cnn_greenspan(
             input_channels,
             patience,
             name,
-            epochs
+            epochs,
+            cache_dir=None,
+            snapshots=None
 ):
         layer_list = get_layers_greenspan(input_channels)
 
@@ -969,7 +1199,9 @@ def create_cnn_greenspan(
             layer_list,
             patience,
             name,
-            epochs=epochs
+            epochs=epochs,
+            cache_dir=cache_dir,
+            snapshots=snapshots
         )
 
 
@@ -982,14 +1214,27 @@ def create_cnn3d_register(
             data_augment_p,
             patience,
             name,
-            epochs
+            epochs,
+            bank_size=None,
+            levels=None,
+            stride=1,
+            cache_dir=None
 ):
     layer_list = get_layers_registration(
         input_shape=input_shape,
         convo_size=convo_size,
         convo_blocks=convo_blocks,
         pool_size=pool_size,
-        number_filters=number_filters
+        number_filters=number_filters,
+        stride=stride
+    ) if not levels else get_layers_registration_pyramid(
+        input_shape=input_shape,
+        levels=levels,
+        convo_size=convo_size,
+        convo_blocks=convo_blocks,
+        pool_size=pool_size,
+        number_filters=number_filters,
+        stride=stride
     )
 
     return create_registration_net(
@@ -997,10 +1242,12 @@ def create_cnn3d_register(
         patience,
         name,
         epochs=epochs,
+        cache_dir=cache_dir,
         batch_iterator=Affine3DTransformBatchIterator(
                 affine_p=data_augment_p,
                 batch_size=32,
-                input_layers=['\033[30mbaseline\033[0m']
+                input_layers=['\033[30mbaseline\033[0m'],
+                bank_size=bank_size
             )
     )
 
@@ -1157,6 +1404,7 @@ def create_encoder3d_string(
     # We assume that the user will never put these parameters as part of the net definition when
     # calling the main python function
     final_layers = forward_path + get_back_pathway(forward_path, multichannel) + 'r'
+    epoch_finished = get_epoch_finished(name, patience)
 
     encoder = NeuralNet(
         layers=get_layers_string(final_layers, input_shape, convo_size, pool_size, number_filters, multichannel),
@@ -1166,7 +1414,8 @@ def create_encoder3d_string(
         update=updates.adam,
         update_learning_rate=1e-3,
 
-        on_epoch_finished=get_epoch_finished(name, patience),
+        on_epoch_finished=epoch_finished,
+        on_training_finished=get_training_finished(epoch_finished),
 
         verbose=11,
         max_epochs=epochs
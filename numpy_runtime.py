@@ -0,0 +1,427 @@
+import os
+import json
+import tempfile
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# The architecture is stored as a JSON string with this key next to the weights
+SPEC_KEY = '__spec__'
+FORMAT_VERSION = 1
+
+# The exporter needs lasagne (only imported when exporting), the runtime only needs NumPy
+
+
+def export_nonlinearity(nonlinearity):
+    from lasagne import nonlinearities
+    if isinstance(nonlinearity, nonlinearities.LeakyRectify):
+        return {'name': 'leaky_rectify', 'leakiness': float(nonlinearity.leakiness)}
+    names = [
+        (None, 'linear'),
+        (nonlinearities.linear, 'linear'),
+        (nonlinearities.identity, 'linear'),
+        (nonlinearities.rectify, 'rectify'),
+        (nonlinearities.softmax, 'softmax'),
+        (nonlinearities.sigmoid, 'sigmoid'),
+        (nonlinearities.tanh, 'tanh'),
+        (nonlinearities.elu, 'elu'),
+        (nonlinearities.softplus, 'softplus'),
+    ]
+    for f, name in names:
+        if nonlinearity is f:
+            return {'name': name}
+    raise ValueError('The nonlinearity %r can not be exported' % nonlinearity)
+
+
+def export_pad(pad, filter_size):
+    if pad == 'same':
+        return [k // 2 for k in filter_size]
+    if pad == 'full':
+        return [k - 1 for k in filter_size]
+    if pad == 'valid':
+        return [0] * len(filter_size)
+    return [int(p) for p in pad]
+
+
+def export_layer(layer):
+    """
+    Returns the type, attributes and parameter values (a dictionary of
+    arrays) of a layer in the format of the runtime.
+    """
+    from lasagne.layers import InputLayer, DenseLayer, DropoutLayer, BatchNormLayer, NonlinearityLayer
+    from lasagne.layers import ConcatLayer, ElemwiseSumLayer, FlattenLayer, ReshapeLayer, DimshuffleLayer
+    from lasagne.layers import Pool2DLayer, Pool3DLayer
+    from lasagne.layers.conv import BaseConvLayer
+    from lasagne.utils import as_tuple
+    from layers import WeightedSumLayer, BatchSplitLayer, Unpooling3D, GroupedConv3DLayer, GroupMemberLayer
+
+    if isinstance(layer, InputLayer):
+        return 'input', {'shape': list(layer.shape)}, {}
+    if isinstance(layer, BaseConvLayer):
+        n = layer.n
+        params = {'W': layer.W.get_value()}
+        if layer.b is not None:
+            params['b'] = layer.b.get_value()
+        return 'conv', {
+            'stride': list(as_tuple(layer.stride, n)),
+            'pad': export_pad(layer.pad, as_tuple(layer.filter_size, n)),
+            'dilation': list(as_tuple(getattr(layer, 'filter_dilation', 1), n)),
+            'groups': getattr(layer, 'num_groups', 1),
+            'flip_filters': bool(layer.flip_filters),
+            'untie_biases': bool(layer.untie_biases),
+            'nonlinearity': export_nonlinearity(layer.nonlinearity)
+        }, params
+    if isinstance(layer, GroupedConv3DLayer):
+        # A grouped convolution of the concatenated inputs (the biases are applied by the members)
+        w = np.concatenate([member.W.get_value() for member in layer.members])
+        return 'conv', {
+            'stride': [1] * 3,
+            'pad': export_pad(layer.pad, layer.filter_size),
+            'dilation': [1] * 3,
+            'groups': layer.num_groups,
+            'flip_filters': bool(layer.flip_filters),
+            'untie_biases': False,
+            'nonlinearity': export_nonlinearity(None)
+        }, {'W': w}
+    if isinstance(layer, GroupMemberLayer):
+        params = {} if layer.b is None else {'b': layer.b.get_value()}
+        return 'group_member', {
+            'index': layer.index,
+            'num_filters': layer.num_filters,
+            'nonlinearity': export_nonlinearity(layer.nonlinearity)
+        }, params
+    if isinstance(layer, DenseLayer):
+        params = {'W': layer.W.get_value()}
+        if layer.b is not None:
+            params['b'] = layer.b.get_value()
+        return 'dense', {
+            'num_leading_axes': getattr(layer, 'num_leading_axes', 1),
+            'nonlinearity': export_nonlinearity(layer.nonlinearity)
+        }, params
+    if isinstance(layer, BatchNormLayer):
+        # Stored as an affine transformation (x * scale + shift) with the shape of the parameters
+        scale = layer.inv_std.get_value()
+        if layer.gamma is not None:
+            scale = scale * layer.gamma.get_value()
+        shift = - layer.mean.get_value() * scale
+        if layer.beta is not None:
+            shift += layer.beta.get_value()
+        return 'batch_norm', {'axes': list(layer.axes)}, {'scale': scale, 'shift': shift}
+    if isinstance(layer, NonlinearityLayer):
+        return 'nonlinearity', {'nonlinearity': export_nonlinearity(layer.nonlinearity)}, {}
+    if isinstance(layer, (Pool2DLayer, Pool3DLayer)):
+        n = len(layer.output_shape) - 2
+        return 'pool', {
+            'pool_size': list(as_tuple(layer.pool_size, n)),
+            'stride': list(as_tuple(layer.stride, n)),
+            'pad': list(as_tuple(layer.pad, n)),
+            'ignore_border': bool(layer.ignore_border),
+            'mode': layer.mode
+        }, {}
+    if isinstance(layer, Unpooling3D):
+        return 'unpool', {'pool_size': list(layer.pool_size)}, {}
+    if isinstance(layer, DropoutLayer):
+        return 'identity', {}, {}
+    if isinstance(layer, ConcatLayer):
+        return 'concat', {'axis': layer.axis}, {}
+    if isinstance(layer, ElemwiseSumLayer):
+        return 'sum', {'coeffs': [float(c) for c in layer.coeffs]}, {}
+    if isinstance(layer, WeightedSumLayer):
+        return 'sum', {'coeffs': [
+            float(layer.coeff_left.get_value()[0]),
+            float(layer.coeff_right.get_value()[0])
+        ]}, {}
+    if isinstance(layer, FlattenLayer):
+        return 'flatten', {'outdim': layer.outdim}, {}
+    if isinstance(layer, ReshapeLayer):
+        return 'reshape', {'shape': [list(s) if isinstance(s, list) else int(s) for s in layer.shape]}, {}
+    if isinstance(layer, DimshuffleLayer):
+        return 'dimshuffle', {'pattern': list(layer.pattern)}, {}
+    if isinstance(layer, BatchSplitLayer):
+        return 'batch_split', {'index': layer.index, 'parts': layer.parts}, {}
+    raise ValueError('The layer %s (%s) can not be exported' % (layer.name, type(layer).__name__))
+
+
+def export_layers(output_layer):
+    from lasagne.layers import get_all_layers, InputLayer, MergeLayer
+    layers = get_all_layers(output_layer)
+    index = dict((layer, i) for i, layer in enumerate(layers))
+    spec = list()
+    arrays = dict()
+    for i, layer in enumerate(layers):
+        incomings = layer.input_layers if isinstance(layer, MergeLayer) else\
+            [] if isinstance(layer, InputLayer) else [layer.input_layer]
+        kind, attributes, params = export_layer(layer)
+        spec.append({
+            'name': layer.name,
+            'type': kind,
+            'incomings': [index[incoming] for incoming in incomings],
+            'params': sorted(params.keys()),
+            'attributes': attributes
+        })
+        arrays.update(('%d_%s' % (i, k), v) for k, v in params.items())
+    return spec, arrays
+
+
+def export_net(net, filename):
+    """
+    Writes a trained NeuralNet (or the output layer of a lasagne graph) into
+    a self-describing npz file: the weights of each layer and a JSON
+    description of the graph that NumpyNet can run without Theano.
+    """
+    if hasattr(net, 'layers_'):
+        net.initialize()
+        output_layer = net.layers_[-1]
+    else:
+        output_layer = net
+    spec, arrays = export_layers(output_layer)
+    arrays[SPEC_KEY] = np.array(json.dumps({'version': FORMAT_VERSION, 'layers': spec}))
+    directory = os.path.dirname(os.path.abspath(filename))
+    f_tmp = tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False)
+    try:
+        with f_tmp:
+            np.savez(f_tmp, **arrays)
+        os.rename(f_tmp.name, filename)
+    except:
+        os.remove(f_tmp.name)
+        raise
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def apply_nonlinearity(x, nonlinearity):
+    name = nonlinearity['name']
+    if name == 'linear':
+        return x
+    if name == 'rectify':
+        return np.maximum(x, 0)
+    if name == 'leaky_rectify':
+        return np.maximum(x, nonlinearity['leakiness'] * x)
+    if name == 'softmax':
+        return softmax(x)
+    if name == 'sigmoid':
+        return 1 / (1 + np.exp(-x))
+    if name == 'tanh':
+        return np.tanh(x)
+    if name == 'elu':
+        return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+    if name == 'softplus':
+        return np.logaddexp(0, x)
+    raise ValueError('Unknown nonlinearity %s' % name)
+
+
+def pad_spatial(x, pad, value=0):
+    # pad is a list of (before, after) pairs for the spatial axes
+    if not any(b or a for b, a in pad):
+        return x
+    return np.pad(x, [(0, 0), (0, 0)] + [tuple(p) for p in pad], mode='constant', constant_values=value)
+
+
+def sliding_windows(x, window, stride, dilation=None):
+    """
+    View (no copies) of the sliding windows of x (batch, channels, *spatial)
+    with shape (batch, channels, *output, *window).
+    """
+    dilation = [1] * len(window) if dilation is None else dilation
+    output = tuple(
+        (s - d * (k - 1) - 1) // st + 1 for s, k, st, d in zip(x.shape[2:], window, stride, dilation)
+    )
+    strides = x.strides[:2] +\
+        tuple(xs * st for xs, st in zip(x.strides[2:], stride)) +\
+        tuple(xs * d for xs, d in zip(x.strides[2:], dilation))
+    return as_strided(x, shape=x.shape[:2] + output + tuple(window), strides=strides, writeable=False)
+
+
+def conv_forward(layer, params, inputs):
+    # im2col convolution: the windows are multiplied with the filters with a single tensordot per group
+    # (the inputs of a grouped convolution are concatenated)
+    x = np.concatenate(inputs, axis=1) if len(inputs) > 1 else inputs[0]
+    attributes = layer['attributes']
+    w = params['W']
+    n = w.ndim - 2
+    if attributes['flip_filters']:
+        w = w[(slice(None), slice(None)) + (slice(None, None, -1),) * n]
+    x = pad_spatial(x, [(p, p) for p in attributes['pad']])
+    windows = sliding_windows(x, w.shape[2:], attributes['stride'], attributes['dilation'])
+    groups = attributes['groups']
+    in_channels = w.shape[1]
+    filters = w.shape[0] // groups
+    window_axes = list(range(n + 2, 2 * n + 2))
+    filter_axes = list(range(2, n + 2))
+    y = np.concatenate([
+        np.tensordot(
+            windows[:, g * in_channels:(g + 1) * in_channels],
+            w[g * filters:(g + 1) * filters],
+            axes=([1] + window_axes, [1] + filter_axes)
+        )
+        for g in range(groups)
+    ], axis=-1) if groups > 1 else np.tensordot(windows, w, axes=([1] + window_axes, [1] + filter_axes))
+    y = y.transpose((0, n + 1) + tuple(range(1, n + 1)))
+    if 'b' in params:
+        b = params['b']
+        y = y + (b[np.newaxis] if attributes['untie_biases'] else b.reshape((1, -1) + (1,) * n))
+    return apply_nonlinearity(y, attributes['nonlinearity'])
+
+
+def group_member_forward(layer, params, inputs):
+    x, = inputs
+    attributes = layer['attributes']
+    index = attributes['index']
+    n_filters = attributes['num_filters']
+    y = x[:, index * n_filters:(index + 1) * n_filters]
+    if 'b' in params:
+        y = y + params['b'].reshape((1, -1) + (1,) * (y.ndim - 2))
+    return apply_nonlinearity(y, attributes['nonlinearity'])
+
+
+def dense_forward(layer, params, inputs):
+    x, = inputs
+    attributes = layer['attributes']
+    leading = attributes['num_leading_axes']
+    x = x.reshape(x.shape[:leading] + (-1,))
+    y = np.dot(x, params['W'])
+    if 'b' in params:
+        y += params['b']
+    return apply_nonlinearity(y, attributes['nonlinearity'])
+
+
+def batch_norm_forward(layer, params, inputs):
+    x, = inputs
+    axes = layer['attributes']['axes']
+    shape = [1 if i in axes else s for i, s in enumerate(x.shape)]
+    return x * params['scale'].reshape(shape) + params['shift'].reshape(shape)
+
+
+def pool_forward(layer, params, inputs):
+    x, = inputs
+    attributes = layer['attributes']
+    pool_size = attributes['pool_size']
+    stride = attributes['stride']
+    pad = attributes['pad']
+    mode = attributes['mode']
+    if attributes['ignore_border']:
+        output = [(s + 2 * p - k) // st + 1 for s, k, st, p in zip(x.shape[2:], pool_size, stride, pad)]
+    else:
+        output = [
+            (s + st - 1) // st if st >= k else max(0, (s - k + st - 1) // st) + 1
+            for s, k, st in zip(x.shape[2:], pool_size, stride)
+        ]
+    # Padding after the input to cover the partial windows when the border is not ignored
+    extra = [max(0, (o - 1) * st + k - s - 2 * p) for o, k, st, s, p in zip(output, pool_size, stride, x.shape[2:], pad)]
+    window_axes = tuple(range(len(output) + 2, 2 * len(output) + 2))
+    if mode == 'max':
+        x = pad_spatial(x, [(p, p + e) for p, e in zip(pad, extra)], -np.inf)
+        return sliding_windows(x, pool_size, stride).max(axis=window_axes)
+    padded = pad_spatial(x, [(p, p + e) for p, e in zip(pad, extra)])
+    y = sliding_windows(padded, pool_size, stride).sum(axis=window_axes)
+    if mode == 'average_inc_pad':
+        return y / np.prod(pool_size)
+    counts = pad_spatial(np.ones((1, 1) + x.shape[2:], dtype=x.dtype), [(p, p + e) for p, e in zip(pad, extra)])
+    return y / sliding_windows(counts, pool_size, stride).sum(axis=window_axes)
+
+
+def unpool_forward(layer, params, inputs):
+    x, = inputs
+    for axis, p in enumerate(layer['attributes']['pool_size']):
+        x = np.repeat(x, p, axis=axis + 2)
+    return x
+
+
+def reshape_forward(layer, params, inputs):
+    x, = inputs
+    shape = [x.shape[s[0]] if isinstance(s, list) else s for s in layer['attributes']['shape']]
+    return x.reshape(shape)
+
+
+def dimshuffle_forward(layer, params, inputs):
+    x, = inputs
+    pattern = layer['attributes']['pattern']
+    kept = [p for p in pattern if p != 'x']
+    # Axes missing from the pattern are broadcastable (size 1) and are dropped
+    x = np.squeeze(x, axis=tuple(i for i in range(x.ndim) if i not in kept))
+    x = x.transpose([sorted(kept).index(p) for p in kept])
+    return x.reshape([1 if p == 'x' else x.shape[kept.index(p)] for p in pattern])
+
+
+def batch_split_forward(layer, params, inputs):
+    x, = inputs
+    index = layer['attributes']['index']
+    size = len(x) // layer['attributes']['parts']
+    return x[index * size:(index + 1) * size]
+
+
+FORWARD = {
+    'conv': conv_forward,
+    'group_member': group_member_forward,
+    'dense': dense_forward,
+    'batch_norm': batch_norm_forward,
+    'nonlinearity': lambda layer, params, inputs: apply_nonlinearity(inputs[0], layer['attributes']['nonlinearity']),
+    'pool': pool_forward,
+    'unpool': unpool_forward,
+    'identity': lambda layer, params, inputs: inputs[0],
+    'concat': lambda layer, params, inputs: np.concatenate(inputs, axis=layer['attributes']['axis']),
+    'sum': lambda layer, params, inputs: sum(c * x for c, x in zip(layer['attributes']['coeffs'], inputs)),
+    'flatten': lambda layer, params, inputs: inputs[0].reshape(inputs[0].shape[:layer['attributes']['outdim'] - 1] + (-1,)),
+    'reshape': reshape_forward,
+    'dimshuffle': dimshuffle_forward,
+    'batch_split': batch_split_forward,
+}
+
+
+class NumpyNet(object):
+    """
+    Runs a net exported with export_net using only NumPy. predict_proba
+    takes the same inputs as NeuralNet.predict_proba (an array or a
+    dictionary keyed by the input layer names) and runs batches of
+    batch_size samples in a pool of n_threads threads (most of the time is
+    spent in BLAS calls that release the GIL).
+    """
+    def __init__(self, filename, batch_size=128, n_threads=None, dtype=np.float32):
+        with np.load(filename) as data:
+            description = json.loads(str(data[SPEC_KEY]))
+            if description['version'] > FORMAT_VERSION:
+                raise ValueError('Unknown format version %d in %s' % (description['version'], filename))
+            self.layers = description['layers']
+            self.params = [
+                dict((k, data['%d_%s' % (i, k)].astype(dtype)) for k in layer['params'])
+                for i, layer in enumerate(self.layers)
+            ]
+        self.inputs = [i for i, layer in enumerate(self.layers) if layer['type'] == 'input']
+        # Index of the last layer that uses the output of each layer (to release it after that)
+        self.last_use = dict((j, i) for i, layer in enumerate(self.layers) for j in layer['incomings'])
+        self.input_names = [self.layers[i]['name'] for i in self.inputs]
+        self.batch_size = batch_size
+        self.dtype = dtype
+        self.n_threads = cpu_count() if n_threads is None else n_threads
+        self.pool = ThreadPool(self.n_threads) if self.n_threads > 1 else None
+
+    def forward(self, x):
+        # x is a list of arrays (one per input layer, in the order of self.inputs)
+        outputs = dict(zip(self.inputs, x))
+        for i, (layer, params) in enumerate(zip(self.layers, self.params)):
+            if layer['type'] != 'input':
+                outputs[i] = FORWARD[layer['type']](layer, params, [outputs[j] for j in layer['incomings']])
+                for j in layer['incomings']:
+                    if self.last_use[j] == i:
+                        del outputs[j]
+        return outputs[len(self.layers) - 1]
+
+    def predict_proba(self, x):
+        x = x if isinstance(x, dict) else {self.input_names[0]: x}
+        x = [np.asarray(x[name], dtype=self.dtype) for name in self.input_names]
+        n_samples = len(x[0])
+        batches = [[x_i[i:i + self.batch_size] for x_i in x] for i in range(0, n_samples, self.batch_size)]
+        outputs = self.pool.map(self.forward, batches) if self.pool is not None else [self.forward(b) for b in batches]
+        return np.concatenate(outputs)
+
+    def predict(self, x):
+        return self.predict_proba(x).argmax(axis=1)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
@@ -0,0 +1,291 @@
+import numpy as np
+import theano
+import theano.tensor as T
+from theano.gof.utils import MethodNotDefined
+from theano.gradient import grad_not_implemented
+
+
+# C kernels for the trilinear sampling. They are written for a generic type
+# (%(dtype)s) and follow the same conventions as layers._interpolate:
+#  - the image has the conv layout (batch, channels, height, width, depth),
+#  - the coordinates have shape (batch, 3, n) with rows x (width axis),
+#    y (height axis) and z (depth axis), normalised to [-1, 1] and clipped.
+_sampler_support_code = """
+static void trilinear_corners_%(name)s(
+    %(dtype)s c, npy_intp size, npy_intp* i0, npy_intp* i1, %(dtype)s* d, %(dtype)s* scale
+)
+{
+    %(dtype)s s;
+    *scale = (c >= -1 && c <= 1) ? (%(dtype)s)(size - 1) / 2 : 0;
+    c = c < -1 ? -1 : (c > 1 ? 1 : c);
+    s = (c + 1) / 2 * (%(dtype)s)(size - 1);
+    *i0 = (npy_intp)floor(s);
+    *i1 = *i0 + 1 < size ? *i0 + 1 : size - 1;
+    *d = s - (%(dtype)s)(*i0);
+}
+
+static void trilinear_sample_%(name)s(
+    const %(dtype)s* im, const %(dtype)s* coords, %(dtype)s* out,
+    npy_intp n_batch, npy_intp n_channels, npy_intp height, npy_intp width, npy_intp depth, npy_intp n
+)
+{
+    npy_intp b, c, p, x0, x1, y0, y1, z0, z1;
+    %(dtype)s dx, dy, dz, sx, sy, sz;
+    for (b = 0; b < n_batch; b++) {
+        for (p = 0; p < n; p++) {
+            trilinear_corners_%(name)s(coords[(b * 3) * n + p], width, &x0, &x1, &dx, &sx);
+            trilinear_corners_%(name)s(coords[(b * 3 + 1) * n + p], height, &y0, &y1, &dy, &sy);
+            trilinear_corners_%(name)s(coords[(b * 3 + 2) * n + p], depth, &z0, &z1, &dz, &sz);
+            for (c = 0; c < n_channels; c++) {
+                const %(dtype)s* v = im + (b * n_channels + c) * height * width * depth;
+                out[(b * n_channels + c) * n + p] =
+                    (1 - dx) * (1 - dy) * (1 - dz) * v[(y0 * width + x0) * depth + z0] +
+                    dx * (1 - dy) * (1 - dz) * v[(y0 * width + x1) * depth + z0] +
+                    (1 - dx) * dy * (1 - dz) * v[(y1 * width + x0) * depth + z0] +
+                    dx * dy * (1 - dz) * v[(y1 * width + x1) * depth + z0] +
+                    (1 - dx) * (1 - dy) * dz * v[(y0 * width + x0) * depth + z1] +
+                    dx * (1 - dy) * dz * v[(y0 * width + x1) * depth + z1] +
+                    (1 - dx) * dy * dz * v[(y1 * width + x0) * depth + z1] +
+                    dx * dy * dz * v[(y1 * width + x1) * depth + z1];
+            }
+        }
+    }
+}
+
+static void trilinear_sample_grad_%(name)s(
+    const %(dtype)s* im, const %(dtype)s* coords, const %(dtype)s* gout, %(dtype)s* gim, %(dtype)s* gcoords,
+    npy_intp n_batch, npy_intp n_channels, npy_intp height, npy_intp width, npy_intp depth, npy_intp n
+)
+{
+    npy_intp b, c, p, x0, x1, y0, y1, z0, z1;
+    npy_intp i000, i100, i010, i110, i001, i101, i011, i111;
+    %(dtype)s dx, dy, dz, sx, sy, sz, gx, gy, gz, g;
+    %(dtype)s v000, v100, v010, v110, v001, v101, v011, v111;
+    for (b = 0; b < n_batch * n_channels * height * width * depth; b++)
+        gim[b] = 0;
+    for (b = 0; b < n_batch; b++) {
+        for (p = 0; p < n; p++) {
+            trilinear_corners_%(name)s(coords[(b * 3) * n + p], width, &x0, &x1, &dx, &sx);
+            trilinear_corners_%(name)s(coords[(b * 3 + 1) * n + p], height, &y0, &y1, &dy, &sy);
+            trilinear_corners_%(name)s(coords[(b * 3 + 2) * n + p], depth, &z0, &z1, &dz, &sz);
+            i000 = (y0 * width + x0) * depth + z0;
+            i100 = (y0 * width + x1) * depth + z0;
+            i010 = (y1 * width + x0) * depth + z0;
+            i110 = (y1 * width + x1) * depth + z0;
+            i001 = (y0 * width + x0) * depth + z1;
+            i101 = (y0 * width + x1) * depth + z1;
+            i011 = (y1 * width + x0) * depth + z1;
+            i111 = (y1 * width + x1) * depth + z1;
+            gx = gy = gz = 0;
+            for (c = 0; c < n_channels; c++) {
+                const %(dtype)s* v = im + (b * n_channels + c) * height * width * depth;
+                %(dtype)s* gv = gim + (b * n_channels + c) * height * width * depth;
+                g = gout[(b * n_channels + c) * n + p];
+                v000 = v[i000]; v100 = v[i100]; v010 = v[i010]; v110 = v[i110];
+                v001 = v[i001]; v101 = v[i101]; v011 = v[i011]; v111 = v[i111];
+                gv[i000] += (1 - dx) * (1 - dy) * (1 - dz) * g;
+                gv[i100] += dx * (1 - dy) * (1 - dz) * g;
+                gv[i010] += (1 - dx) * dy * (1 - dz) * g;
+                gv[i110] += dx * dy * (1 - dz) * g;
+                gv[i001] += (1 - dx) * (1 - dy) * dz * g;
+                gv[i101] += dx * (1 - dy) * dz * g;
+                gv[i011] += (1 - dx) * dy * dz * g;
+                gv[i111] += dx * dy * dz * g;
+                gx += g * (
+                    (1 - dy) * (1 - dz) * (v100 - v000) + dy * (1 - dz) * (v110 - v010) +
+                    (1 - dy) * dz * (v101 - v001) + dy * dz * (v111 - v011)
+                );
+                gy += g * (
+                    (1 - dx) * (1 - dz) * (v010 - v000) + dx * (1 - dz) * (v110 - v100) +
+                    (1 - dx) * dz * (v011 - v001) + dx * dz * (v111 - v101)
+                );
+                gz += g * (
+                    (1 - dx) * (1 - dy) * (v001 - v000) + dx * (1 - dy) * (v101 - v100) +
+                    (1 - dx) * dy * (v011 - v010) + dx * dy * (v111 - v110)
+                );
+            }
+            gcoords[(b * 3) * n + p] = gx * sx;
+            gcoords[(b * 3 + 1) * n + p] = gy * sy;
+            gcoords[(b * 3 + 2) * n + p] = gz * sz;
+        }
+    }
+}
+"""
+
+
+def _trilinear_corners(c, size):
+    scale = ((c >= -1) & (c <= 1)) * (size - 1) / 2.0
+    s = (np.clip(c, -1, 1) + 1) / 2 * (size - 1)
+    i0 = np.floor(s).astype(np.int64)
+    i1 = np.minimum(i0 + 1, size - 1)
+    return i0, i1, s - i0, scale
+
+
+def _trilinear_weights(coords, shape):
+    # Returns the 8 (index, weight) pairs of the neighbourhood of each point
+    # and the partial derivatives of the weights with respect to x, y and z.
+    height, width, depth = shape
+    x0, x1, dx, sx = _trilinear_corners(coords[:, 0], width)
+    y0, y1, dy, sy = _trilinear_corners(coords[:, 1], height)
+    z0, z1, dz, sz = _trilinear_corners(coords[:, 2], depth)
+    corners = list()
+    for xi, wx, gx in [(x0, 1 - dx, -sx), (x1, dx, sx)]:
+        for yi, wy, gy in [(y0, 1 - dy, -sy), (y1, dy, sy)]:
+            for zi, wz, gz in [(z0, 1 - dz, -sz), (z1, dz, sz)]:
+                corners.append(((yi, xi, zi), wx * wy * wz, (gx * wy * wz, wx * gy * wz, wx * wy * gz)))
+    return corners
+
+
+def trilinear_sample_numpy(im, coords):
+    b = np.arange(im.shape[0])[:, np.newaxis]
+    out = np.zeros(im.shape[:2] + coords.shape[2:], dtype=im.dtype)
+    for (yi, xi, zi), w, _ in _trilinear_weights(coords, im.shape[2:]):
+        out += w[:, np.newaxis] * np.transpose(im[b, :, yi, xi, zi], (0, 2, 1))
+    return out
+
+
+def trilinear_sample_grad_numpy(im, coords, gout):
+    b = np.arange(im.shape[0])[:, np.newaxis]
+    gim = np.zeros_like(im)
+    gcoords = np.zeros_like(coords)
+    for (yi, xi, zi), w, dw in _trilinear_weights(coords, im.shape[2:]):
+        np.add.at(gim, (b, slice(None), yi, xi, zi), np.transpose(w[:, np.newaxis] * gout, (0, 2, 1)))
+        v = np.sum(np.transpose(im[b, :, yi, xi, zi], (0, 2, 1)) * gout, axis=1)
+        for i, dwi in enumerate(dw):
+            gcoords[:, i] += dwi * v
+    return gim, gcoords
+
+
+class _TrilinearOp(theano.Op):
+    __props__ = ()
+
+    def c_support_code_apply(self, node, name):
+        dtype = node.inputs[0].dtype
+        if dtype not in ('float32', 'float64'):
+            raise MethodNotDefined()
+        return _sampler_support_code % dict(name=name, dtype='npy_' + dtype)
+
+    def c_headers(self):
+        return ['<math.h>']
+
+    def c_code_cache_version(self):
+        return (1,)
+
+
+class TrilinearSampler3D(_TrilinearOp):
+    """
+    Trilinear sampling of a 5D tensor (batch, channels, height, width, depth)
+    at the normalised coordinates of a (batch, 3, n) tensor. The output has
+    shape (batch, channels, n). The coordinates follow the same conventions
+    as the Theano graph in layers._interpolate.
+    """
+    def make_node(self, im, coords):
+        im = T.as_tensor_variable(im)
+        coords = T.cast(T.as_tensor_variable(coords), im.dtype)
+        if im.ndim != 5 or coords.ndim != 3:
+            raise TypeError('TrilinearSampler3D expects a 5D image and 3D coordinates')
+        out = T.tensor(dtype=im.dtype, broadcastable=(False, im.broadcastable[1], False))
+        return theano.Apply(self, [im, coords], [out])
+
+    def perform(self, node, inputs, output_storage):
+        im, coords = inputs
+        output_storage[0][0] = trilinear_sample_numpy(im, coords).astype(node.outputs[0].dtype)
+
+    def infer_shape(self, node, shapes):
+        im_shape, coords_shape = shapes
+        return [(coords_shape[0], im_shape[1], coords_shape[2])]
+
+    def grad(self, inputs, output_grads):
+        im, coords = inputs
+        gim, gcoords = TrilinearSampler3DGrad()(im, coords, output_grads[0])
+        return [gim, gcoords]
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        im, coords = inputs
+        out, = outputs
+        fail = sub['fail']
+        return """
+        PyArrayObject* im_c = PyArray_GETCONTIGUOUS(%(im)s);
+        PyArrayObject* coords_c = PyArray_GETCONTIGUOUS(%(coords)s);
+        npy_intp* im_dims = PyArray_DIMS(im_c);
+        npy_intp dims[3] = {im_dims[0], im_dims[1], PyArray_DIMS(coords_c)[2]};
+        if (PyArray_DIMS(coords_c)[0] != im_dims[0] || PyArray_DIMS(coords_c)[1] != 3) {
+            PyErr_SetString(PyExc_ValueError, "TrilinearSampler3D: coordinates must have shape (batch, 3, n)");
+            Py_DECREF(im_c);
+            Py_DECREF(coords_c);
+            %(fail)s
+        }
+        if (!%(out)s || PyArray_DIMS(%(out)s)[0] != dims[0] || PyArray_DIMS(%(out)s)[1] != dims[1] ||
+            PyArray_DIMS(%(out)s)[2] != dims[2] || !PyArray_IS_C_CONTIGUOUS(%(out)s)) {
+            Py_XDECREF(%(out)s);
+            %(out)s = (PyArrayObject*)PyArray_EMPTY(3, dims, PyArray_TYPE(im_c), 0);
+        }
+        if (!%(out)s) {
+            Py_DECREF(im_c);
+            Py_DECREF(coords_c);
+            %(fail)s
+        }
+        trilinear_sample_%(name)s(
+            (dtype_%(im)s*)PyArray_DATA(im_c), (dtype_%(im)s*)PyArray_DATA(coords_c), (dtype_%(im)s*)PyArray_DATA(%(out)s),
+            im_dims[0], im_dims[1], im_dims[2], im_dims[3], im_dims[4], dims[2]
+        );
+        Py_DECREF(im_c);
+        Py_DECREF(coords_c);
+        """ % locals()
+
+
+class TrilinearSampler3DGrad(_TrilinearOp):
+    """
+    Gradient of TrilinearSampler3D with respect to the image and the
+    coordinates (the gradient is 0 for coordinates outside of [-1, 1]).
+    """
+    def make_node(self, im, coords, gout):
+        im = T.as_tensor_variable(im)
+        coords = T.cast(T.as_tensor_variable(coords), im.dtype)
+        gout = T.cast(T.as_tensor_variable(gout), im.dtype)
+        return theano.Apply(self, [im, coords, gout], [im.type(), coords.type()])
+
+    def perform(self, node, inputs, output_storage):
+        im, coords, gout = inputs
+        gim, gcoords = trilinear_sample_grad_numpy(im, coords, gout)
+        output_storage[0][0] = gim.astype(node.outputs[0].dtype)
+        output_storage[1][0] = gcoords.astype(node.outputs[1].dtype)
+
+    def infer_shape(self, node, shapes):
+        return [shapes[0], shapes[1]]
+
+    def grad(self, inputs, output_grads):
+        return [grad_not_implemented(self, i, inp) for i, inp in enumerate(inputs)]
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        im, coords, gout = inputs
+        gim, gcoords = outputs
+        fail = sub['fail']
+        return """
+        PyArrayObject* im_c = PyArray_GETCONTIGUOUS(%(im)s);
+        PyArrayObject* coords_c = PyArray_GETCONTIGUOUS(%(coords)s);
+        PyArrayObject* gout_c = PyArray_GETCONTIGUOUS(%(gout)s);
+        npy_intp* im_dims = PyArray_DIMS(im_c);
+        Py_XDECREF(%(gim)s);
+        Py_XDECREF(%(gcoords)s);
+        %(gim)s = (PyArrayObject*)PyArray_EMPTY(5, im_dims, PyArray_TYPE(im_c), 0);
+        %(gcoords)s = (PyArrayObject*)PyArray_EMPTY(3, PyArray_DIMS(coords_c), PyArray_TYPE(im_c), 0);
+        if (!%(gim)s || !%(gcoords)s) {
+            Py_DECREF(im_c);
+            Py_DECREF(coords_c);
+            Py_DECREF(gout_c);
+            %(fail)s
+        }
+        trilinear_sample_grad_%(name)s(
+            (dtype_%(im)s*)PyArray_DATA(im_c), (dtype_%(im)s*)PyArray_DATA(coords_c),
+            (dtype_%(im)s*)PyArray_DATA(gout_c), (dtype_%(im)s*)PyArray_DATA(%(gim)s),
+            (dtype_%(im)s*)PyArray_DATA(%(gcoords)s),
+            im_dims[0], im_dims[1], im_dims[2], im_dims[3], im_dims[4], PyArray_DIMS(coords_c)[2]
+        );
+        Py_DECREF(im_c);
+        Py_DECREF(coords_c);
+        Py_DECREF(gout_c);
+        """ % locals()
+
+
+trilinear_sample_3d = TrilinearSampler3D()
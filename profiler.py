@@ -0,0 +1,236 @@
+from __future__ import print_function
+import argparse
+import csv
+import json
+import sys
+import itertools
+import numpy as np
+import theano
+from lasagne.layers import get_all_layers, InputLayer, MergeLayer, DenseLayer, DropoutLayer
+from lasagne.layers import BatchNormLayer, NonlinearityLayer, ElemwiseSumLayer, Pool2DLayer, Pool3DLayer
+from lasagne.layers.conv import BaseConvLayer
+from lasagne.utils import as_tuple
+from layers import Unpooling3D, MaxUnpooling3D, Transformer3DLayer, AffineComposeLayer, WeightedSumLayer
+from layers import GroupedConv3DLayer
+from utils import name_and_color
+
+
+def get_incomings(layer):
+    return layer.input_layers if isinstance(layer, MergeLayer) else\
+        [] if isinstance(layer, InputLayer) else [layer.input_layer]
+
+
+def get_size(shape):
+    return int(np.prod([s for s in shape if s is not None]))
+
+
+def layer_macs(layer):
+    # Multiply-accumulates per sample for the linear layers and elementwise operations for the rest
+    output_size = get_size(layer.output_shape[1:])
+    if isinstance(layer, BaseConvLayer):
+        in_channels = layer.input_shape[1] // getattr(layer, 'num_groups', 1)
+        return output_size * in_channels * get_size(layer.filter_size)
+    if isinstance(layer, GroupedConv3DLayer):
+        return output_size * layer.input_shapes[0][1] * get_size(layer.filter_size)
+    if isinstance(layer, DenseLayer):
+        return get_size(layer.input_shape[1:]) * layer.num_units
+    if isinstance(layer, Transformer3DLayer):
+        # 12 for each sampling coordinate and 8 neighbours for each sampled value
+        return 12 * get_size(layer.output_shape[2:]) + 8 * output_size
+    if isinstance(layer, AffineComposeLayer):
+        return 36
+    if isinstance(layer, (Pool2DLayer, Pool3DLayer)):
+        return output_size * get_size(as_tuple(layer.pool_size, len(layer.output_shape) - 2))
+    if isinstance(layer, (BatchNormLayer, NonlinearityLayer, ElemwiseSumLayer, WeightedSumLayer)):
+        return output_size
+    return 0
+
+
+def layer_receptive_field(layer, fields):
+    """
+    Receptive field of the layer (per spatial axis) given the fields of its
+    incomings. Each field is a (size, jump) pair, where jump is the distance
+    in input voxels between two neighbouring outputs. Layers without spatial
+    axes (or layers that sample the whole input) see the whole extent of
+    their incomings.
+    """
+    n_dims = len(layer.output_shape) - 2
+    incomings = get_incomings(layer)
+    if isinstance(layer, InputLayer):
+        return (1,) * n_dims, (1,) * n_dims
+    in_fields = [fields[l] for l in incomings if fields[l] is not None]
+    if not in_fields:
+        return None
+    if n_dims <= 0 or isinstance(layer, (Transformer3DLayer, AffineComposeLayer)):
+        extent = [
+            tuple(s + (n - 1) * j for s, j, n in zip(size, jump, l.output_shape[2:])) if jump is not None else size
+            for l, (size, jump) in zip([l for l in incomings if fields[l] is not None], in_fields)
+        ]
+        size = tuple(np.max(extent, axis=0))
+        return (size, (1,) * len(size)) if n_dims > 0 else (size, None)
+    in_fields = [(size, jump) for size, jump in in_fields if jump is not None]
+    if not in_fields:
+        return None
+    size, jump = [tuple(np.max(v, axis=0)) for v in zip(*in_fields)]
+    if isinstance(layer, (BaseConvLayer, GroupedConv3DLayer)):
+        filter_size = as_tuple(layer.filter_size, n_dims)
+        stride = as_tuple(getattr(layer, 'stride', 1), n_dims)
+        size = tuple(s + (f - 1) * j for s, f, j in zip(size, filter_size, jump))
+        jump = tuple(j * st for j, st in zip(jump, stride))
+    elif isinstance(layer, (Pool2DLayer, Pool3DLayer)):
+        pool_size = as_tuple(layer.pool_size, n_dims)
+        stride = as_tuple(layer.stride, n_dims)
+        size = tuple(s + (p - 1) * j for s, p, j in zip(size, pool_size, jump))
+        jump = tuple(j * st for j, st in zip(jump, stride))
+    elif isinstance(layer, (Unpooling3D, MaxUnpooling3D)):
+        factors = [o / float(i) for o, i in zip(layer.output_shape[2:], layer.input_shapes[0][2:])]\
+            if isinstance(layer, MaxUnpooling3D) else layer.pool_size
+        jump = tuple(j / float(f) for j, f in zip(jump, factors))
+    return size, jump
+
+
+def profile_layers(output_layer):
+    """
+    Per layer statistics of a lasagne graph (like the ones built in nets.py).
+    Returns a list of dictionaries (one per layer, in topological order)
+    with the name, type, output shape, number of parameters (shared
+    parameters are only counted in the first layer that uses them),
+    multiply-accumulates per sample, activation bytes per sample and
+    receptive field (in input voxels per spatial axis).
+    """
+    itemsize = np.dtype(theano.config.floatX).itemsize
+    seen = set()
+    fields = dict()
+    rows = list()
+    for layer in get_all_layers(output_layer):
+        params = [p for p in layer.get_params() if p not in seen]
+        seen.update(params)
+        fields[layer] = layer_receptive_field(layer, fields)
+        _, name = name_and_color(layer.name)
+        rows.append({
+            'name': name,
+            'type': type(layer).__name__,
+            'output_shape': 'x'.join(str(s) for s in layer.output_shape[1:]),
+            'params': sum(p.get_value(borrow=True).size for p in params),
+            'macs': 0 if isinstance(layer, DropoutLayer) else layer_macs(layer),
+            'activation_bytes': get_size(layer.output_shape[1:]) * itemsize,
+            'receptive_field': 'x'.join(
+                '%g' % s for s in fields[layer][0]
+            ) if fields[layer] is not None else '',
+        })
+    return rows
+
+
+def summarise(rows):
+    return {
+        'n_layers': len(rows),
+        'params': sum(row['params'] for row in rows),
+        'macs': sum(row['macs'] for row in rows),
+        'activation_bytes': sum(row['activation_bytes'] for row in rows),
+        'receptive_field': rows[-1]['receptive_field'] if rows else '',
+    }
+
+
+def parse_inputs():
+    parser = argparse.ArgumentParser(description='Static cost of the nets (parameters, MACs, memory).')
+    parser.add_argument('-l', '--layers', action='store', dest='layers', default=None)
+    parser.add_argument('-c', '--conv-blocks', dest='conv_blocks', nargs='+', type=int, default=[1, 2, 3])
+    parser.add_argument('-k', '--kernel-size', dest='conv_width', type=int, default=3)
+    parser.add_argument('-w', '--last-width', dest='last_width', type=int, default=3)
+    parser.add_argument('-i', '--patch-width', dest='patch_width', type=int, default=None)
+    parser.add_argument('-n', '--num-filters', dest='number_filters', nargs='+', type=int, default=[32, 64])
+    parser.add_argument('-d', '--dense-size', dest='dense_sizes', nargs='+', type=int, default=[16, 64, 128, 256])
+    parser.add_argument('-p', '--pool-size', dest='pool_size', type=int, default=1)
+    parser.add_argument('-D', '--deformation', dest='deformation', type=int, default=1)
+    parser.add_argument('--images', dest='images', nargs='+', default=['flair', 'pd', 't2'])
+    parser.add_argument('--padding', action='store', dest='padding', default='valid')
+    parser.add_argument('--per-layer', action='store_true', dest='per_layer', default=False)
+    parser.add_argument('--format', dest='format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('-o', '--output', dest='output', default=None)
+    return vars(parser.parse_args())
+
+
+def get_configurations(options):
+    # Same sweep as test_generalisation (longitudinal nets with deformation) or
+    # multi-channel nets from an architecture string (as in create_cnn3d_det_string)
+    from nets import get_layers_longitudinal, get_layers_longitudinal_deformation, get_layers_string
+    images = options['images']
+    conv_width = options['conv_width']
+    for blocks, filters, dense in itertools.product(
+            options['conv_blocks'], options['number_filters'], options['dense_sizes']
+    ):
+        width = options['patch_width'] or blocks * (conv_width - 1) + options['last_width']
+        input_shape = (None, 2 * len(images), width, width, width)
+        config = {
+            'blocks': blocks,
+            'patch': width,
+            'filters': filters,
+            'dense': dense,
+        }
+        if options['layers']:
+            config['layers'] = options['layers']
+            net_layers = options['layers'].replace('a', 'ao').replace('m', 'mo') + 'rC'
+            layer = get_layers_string(
+                net_layers=net_layers,
+                input_shape=input_shape,
+                convo_size=conv_width,
+                pool_size=options['pool_size'],
+                dense_size=dense,
+                number_filters=filters,
+                padding=options['padding']
+            )
+        elif options['deformation']:
+            layer = get_layers_longitudinal_deformation(
+                convo_blocks=blocks,
+                input_shape=input_shape,
+                d_off=options['deformation'],
+                images=images,
+                convo_size=[conv_width] * blocks,
+                pool_size=options['pool_size'],
+                dense_size=dense,
+                number_filters=filters,
+                padding=options['padding']
+            )
+        else:
+            layer = get_layers_longitudinal(
+                convo_blocks=blocks,
+                input_shape=input_shape,
+                images=images,
+                convo_size=[conv_width] * blocks,
+                pool_size=options['pool_size'],
+                dense_size=dense,
+                number_filters=filters,
+                padding=options['padding']
+            )
+        yield config, layer
+
+
+def main():
+    options = parse_inputs()
+
+    table = list()
+    for config, layer in get_configurations(options):
+        rows = profile_layers(layer)
+        if options['per_layer']:
+            table += [dict(config.items() + row.items()) for row in rows]
+        else:
+            table.append(dict(config.items() + summarise(rows).items()))
+
+    output = open(options['output'], 'w') if options['output'] else sys.stdout
+    if options['format'] == 'json':
+        json.dump(table, output, indent=2, sort_keys=True)
+        output.write('\n')
+    elif table:
+        config_keys = ['layers', 'blocks', 'patch', 'filters', 'dense']
+        stat_keys = ['name', 'type', 'output_shape'] if options['per_layer'] else ['n_layers']
+        stat_keys += ['params', 'macs', 'activation_bytes', 'receptive_field']
+        fields = [k for k in config_keys if k in table[0] and k not in stat_keys] + stat_keys
+        writer = csv.DictWriter(output, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(table)
+    if options['output']:
+        output.close()
+
+
+if __name__ == '__main__':
+    main()
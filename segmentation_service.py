@@ -0,0 +1,286 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import threading
+import time
+from Queue import Queue, Empty
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import numpy as np
+from nibabel import load as load_nii
+from data_creation import load_patch_batch_percent
+from numpy_runtime import NumpyNet
+
+
+def parse_inputs():
+    parser = argparse.ArgumentParser(description='Local service to segment longitudinal pairs with warm models.')
+    parser.add_argument('-1', '--iteration1', dest='iter1', required=True)
+    parser.add_argument('-2', '--iteration2', dest='iter2', required=True)
+    parser.add_argument('--images', dest='images', nargs='+', default=['flair', 'pd', 't2'])
+    parser.add_argument('--host', dest='host', default='127.0.0.1')
+    parser.add_argument('--port', dest='port', type=int, default=8000)
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=10000)
+    parser.add_argument('--max-batch', dest='max_batch', type=int, default=20000)
+    parser.add_argument('--max-wait', dest='max_wait', type=float, default=0.01)
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=2)
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=None)
+    parser.add_argument('--threshold', dest='threshold', type=float, default=0.5)
+    return vars(parser.parse_args())
+
+
+def get_samples(x):
+    return len(x.values()[0]) if isinstance(x, dict) else len(x)
+
+
+class BatchingPredictor(object):
+    """
+    Shares the calls to predictor.predict_proba between threads. Each call
+    to predict_proba is queued and a worker thread concatenates the queued
+    inputs (up to max_batch samples, waiting at most max_wait seconds for
+    more requests) into a single prediction and returns its part to each
+    caller.
+    """
+    def __init__(self, predictor, max_batch=20000, max_wait=0.01):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def predict_proba(self, x):
+        request = {'x': x, 'done': threading.Event()}
+        self.queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['y']
+
+    def _next_requests(self):
+        requests = [self.queue.get()]
+        n_samples = get_samples(requests[0]['x'])
+        deadline = time.time() + self.max_wait
+        while n_samples < self.max_batch:
+            try:
+                request = self.queue.get(timeout=max(0, deadline - time.time()))
+            except Empty:
+                break
+            requests.append(request)
+            n_samples += get_samples(request['x'])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._next_requests()
+            inputs = [r['x'] for r in requests]
+            try:
+                x = dict((k, np.concatenate([x_i[k] for x_i in inputs])) for k in inputs[0])\
+                    if isinstance(inputs[0], dict) else np.concatenate(inputs)
+                y = self.predictor.predict_proba(x)
+                limits = np.cumsum([0] + [get_samples(x_i) for x_i in inputs])
+                for r, ini, end in zip(requests, limits[:-1], limits[1:]):
+                    r['y'] = y[ini:end]
+            except Exception as e:
+                for r in requests:
+                    r['error'] = e
+            finally:
+                for r in requests:
+                    r['done'].set()
+
+
+class SegmentationService(object):
+    """
+    Keeps the models of both iterations (exported with numpy_runtime.export_net)
+    in memory and segments a longitudinal pair (baseline and follow-up images,
+    and the deformations for nets that use them) like the main loop of
+    train_test_longitudinal: the probability maps of each iteration, their
+    product and the final mask are written as NIfTI images.
+    """
+    def __init__(
+            self,
+            iter1,
+            iter2,
+            images,
+            batch_size=10000,
+            max_batch=20000,
+            max_wait=0.01,
+            threads=None,
+            threshold=0.5,
+            b_name='\033[30mbaseline_%s\033[0m',
+            f_name='\033[30mfollow_%s\033[0m',
+            d_name='\033[30mdeformation_%s\033[0m'
+    ):
+        nets = [NumpyNet(iter1, n_threads=threads), NumpyNet(iter2, n_threads=threads)]
+        input_shapes = [
+            dict((net.layers[i]['name'], tuple(net.layers[i]['attributes']['shape'][2:])) for i in net.inputs)
+            for net in nets
+        ]
+        if input_shapes[0] != input_shapes[1]:
+            raise ValueError('Both iterations must have the same inputs')
+        self.input_shapes = input_shapes[0]
+        self.predictors = [BatchingPredictor(net, max_batch, max_wait) for net in nets]
+        self.images = images
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.b_name = b_name
+        self.f_name = f_name
+        self.d_name = d_name
+        self.multi_channel = len(self.input_shapes) == 1
+        self.patch_size = self.input_shapes.values()[0] if self.multi_channel\
+            else self.input_shapes[b_name % images[0]]
+        self.defo_size = self.input_shapes.get(d_name % images[0])
+
+    def get_inputs(self, batch):
+        # Same layout as test_net
+        if self.multi_channel:
+            return batch
+        n_images = len(self.images)
+        d_inputs = []
+        if isinstance(batch, tuple):
+            batch, d_batch = batch
+            d_batch = np.split(d_batch, n_images, axis=1)
+            d_inputs = [(self.d_name % im, np.squeeze(d_im, axis=1)) for im, d_im in zip(self.images, d_batch)]
+        batch = np.split(batch, n_images * 2, axis=1)
+        b_inputs = [(self.b_name % im, x_im) for im, x_im in zip(self.images, batch[:n_images])]
+        f_inputs = [(self.f_name % im, x_im) for im, x_im in zip(self.images, batch[n_images:])]
+        return dict(b_inputs + f_inputs + d_inputs)
+
+    def segment(self, baseline, followup, deformation=None, mask=None, output=None):
+        """
+        baseline, followup and deformation are lists of image names (in the
+        order of the images of the service), mask is the name of the mask
+        of the voxels to test (all the non-zero voxels of the first image by
+        default) and output the prefix of the result names. Returns the names
+        of the written images.
+        """
+        if len(baseline) != len(self.images) or len(followup) != len(self.images):
+            raise ValueError('Expected %d baseline and follow-up images' % len(self.images))
+        if (self.defo_size is not None) != (deformation is not None):
+            raise ValueError('The deformations are %srequired' % ('' if self.defo_size is not None else 'not '))
+        output = os.path.join(os.path.dirname(followup[0]), 'segmentation') if output is None else output
+        # Same order as get_names_from_path
+        names = list(followup) + list(baseline)
+        image_nii = load_nii(followup[0])
+        mask = load_nii(mask).get_data() if mask is not None else None
+        images = [np.zeros(image_nii.get_data().shape) for _ in self.predictors]
+        for batch, centers, percent in load_patch_batch_percent(
+                names,
+                self.batch_size,
+                self.patch_size,
+                self.defo_size,
+                d_names=deformation,
+                mask=mask
+        ):
+            inputs = self.get_inputs(batch)
+            [x, y, z] = np.stack(centers, axis=1)
+            for image, predictor in zip(images, self.predictors):
+                image[x, y, z] = predictor.predict_proba(inputs)[:, -1]
+
+        image1, image2 = images
+        results = [
+            ('iter1', image1),
+            ('iter2', image2),
+            ('iter1_x_2', image1 * image2),
+            ('final', (image1 * image2) > self.threshold)
+        ]
+        outputnames = dict()
+        for sufix, image in results:
+            outputnames[sufix] = output + '.' + sufix + '.nii.gz'
+            image_nii.get_data()[:] = image
+            image_nii.to_filename(outputnames[sufix])
+        return outputnames
+
+
+class SegmentationHandler(BaseHTTPRequestHandler):
+    """
+    POST /segment with a JSON object with the arguments of
+    SegmentationService.segment. The answer is sent when the segmentation is
+    finished (with the names of the results). GET /status returns the
+    number of running and waiting requests.
+    """
+    def reply(self, code, content):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_error(404)
+            return
+        self.reply(200, {'running': self.server.running, 'waiting': self.server.waiting})
+
+    def do_POST(self):
+        if self.path != '/segment':
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+            self.server.start()
+            try:
+                outputnames = self.server.service.segment(**request)
+            finally:
+                self.server.finish()
+        except (ValueError, TypeError, KeyError, IOError) as e:
+            self.reply(400, {'error': str(e)})
+            return
+        except Exception as e:
+            # Any other failure is ours, but the client still gets an answer
+            self.log_error('Segmentation failed: %r', e)
+            self.reply(500, {'error': str(e)})
+            return
+        self.reply(200, outputnames)
+
+
+class SegmentationServer(ThreadingMixIn, HTTPServer):
+    # Each connection has its own thread, but only jobs segmentations run at the same time
+    daemon_threads = True
+
+    def __init__(self, address, service, jobs=2):
+        HTTPServer.__init__(self, address, SegmentationHandler)
+        self.service = service
+        self.jobs = threading.Semaphore(jobs)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+
+    def start(self):
+        with self.lock:
+            self.waiting += 1
+        self.jobs.acquire()
+        with self.lock:
+            self.waiting -= 1
+            self.running += 1
+
+    def finish(self):
+        with self.lock:
+            self.running -= 1
+        self.jobs.release()
+
+
+def main():
+    options = parse_inputs()
+    service = SegmentationService(
+        options['iter1'],
+        options['iter2'],
+        options['images'],
+        batch_size=options['batch_size'],
+        max_batch=options['max_batch'],
+        max_wait=options['max_wait'],
+        threads=options['threads'],
+        threshold=options['threshold']
+    )
+    server = SegmentationServer((options['host'], options['port']), service, options['jobs'])
+    print('Serving on http://%s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
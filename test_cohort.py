@@ -0,0 +1,203 @@
+from __future__ import print_function
+import os
+import sys
+import traceback
+from time import strftime
+from multiprocessing import Pool
+from nibabel import load as load_nii
+from nets import create_cnn3d_longitudinal, create_cnn3d_det_string
+from utils import color_codes
+from inference import Predictor
+from checkpoint import load_weights
+from train_test_longitudinal import get_parser, get_images, get_sufix, get_final_sufix
+from train_test_longitudinal import get_names_from_path, get_defonames_from_path, test_net
+
+
+# Nets of the worker process (set by init_worker)
+worker = dict()
+
+
+def parse_inputs():
+    # Same options as train_test_longitudinal (to rebuild the nets and find the weights)
+    parser = get_parser('Segment a cohort with the nets trained by train_test_longitudinal.')
+    parser.add_argument('--model-dir', dest='model_dir', required=True)
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1)
+    parser.add_argument('patients', nargs='+')
+    return vars(parser.parse_args())
+
+
+def create_net(options, n_channels, name):
+    conv_blocks = options['conv_blocks']
+    n_filters = options['number_filters']
+    n_filters = n_filters if len(n_filters) > 1 else n_filters*conv_blocks
+    conv_width = options['conv_width']
+    conv_size = conv_width if isinstance(conv_width, list) else [conv_width]*conv_blocks
+    patch_width = options['patch_width']
+    input_shape = (None, n_channels, patch_width, patch_width, patch_width)
+    if options['multi']:
+        return create_cnn3d_det_string(
+            cnn_path=''.join(options['layers']),
+            input_shape=input_shape,
+            convo_size=conv_size,
+            padding=options['padding'],
+            dense_size=options['dense_size'],
+            pool_size=2,
+            number_filters=n_filters,
+            patience=10,
+            multichannel=True,
+            name=name,
+            epochs=options['epochs'],
+            cache_dir=options['cache_dir']
+        )
+    return create_cnn3d_longitudinal(
+        convo_blocks=conv_blocks,
+        input_shape=input_shape,
+        images=get_images(options),
+        convo_size=conv_size,
+        pool_size=options['pool_size'],
+        dense_size=options['dense_size'],
+        number_filters=n_filters,
+        padding=options['padding'],
+        drop=0.5,
+        register=options['register'],
+        defo=options['deformation'],
+        patience=10,
+        name=name,
+        epochs=options['epochs'],
+        grouped=options['grouped'],
+        cache_dir=options['cache_dir']
+    )
+
+
+def get_net_names(options):
+    sufix = get_sufix(options)
+    final_s = get_final_sufix(options)
+    return [
+        os.path.join(options['model_dir'], net_name)
+        for net_name in ['deep-longitudinal.init' + sufix + '.', 'deep-longitudinal.final' + final_s + sufix + '.']
+    ]
+
+
+def check_weights(net_name):
+    # Same conditions as load_weights (the weights exist and the training was not interrupted)
+    weights_name = net_name + 'model_weights.ckpt'
+    if not os.path.isfile(weights_name) and not os.path.isfile(net_name + 'model_weights.pkl'):
+        return 'There are no weights (%s)' % weights_name
+    if os.path.isfile(net_name + 'training_state.ckpt'):
+        return 'The training of the net was interrupted (%s)' % (net_name + 'training_state.ckpt')
+    return None
+
+
+def init_worker(options):
+    # Each worker builds, loads and compiles both nets once and keeps them for all its patients.
+    # The progress of test_net would be mixed between workers, so the output of the workers is discarded.
+    # If a worker raised an exception, the pool would replace it forever, so the error is kept and
+    # raised by test_patient instead.
+    sys.stdout = open(os.devnull, 'w')
+    worker['options'] = options
+    try:
+        n_channels = 2 * len(get_images(options))
+        memory_budget = int(options['memory_budget'] * 2**30) if options['memory_budget'] else None
+        predictors = list()
+        for net_name in get_net_names(options):
+            net = create_net(options, n_channels, net_name)
+            load_weights(net, net_name + 'model_weights.ckpt')
+            predictors.append((net, Predictor(net, memory_budget)))
+        worker['predictors'] = predictors
+    except Exception:
+        worker['error'] = traceback.format_exc()
+
+
+def test_patient(path):
+    # Same steps (and result names) as the testing part of the main loop of train_test_longitudinal
+    if 'error' in worker:
+        raise RuntimeError('The nets could not be loaded\n' + worker['error'])
+    options = worker['options']
+    case = os.path.basename(os.path.normpath(path))
+    sufix = get_sufix(options)
+    final_s = get_final_sufix(options)
+    images = get_images(options)
+    patch_width = options['patch_width']
+    patch_size = (patch_width, patch_width, patch_width)
+    defo = options['deformation']
+    defo_width = options['conv_blocks']*2+defo if defo else None
+    defo_size = (defo_width, defo_width, defo_width)
+    names_test = get_names_from_path(path, options)
+    defo_names_test = get_defonames_from_path(path, options) if defo else None
+    mask_nii = load_nii(os.path.join(path, options['wm_mask']))
+
+    outputnames = list()
+    results = list()
+    for (net, predictor), outputname in [
+        (worker['predictors'][0], os.path.join(path, 't' + case + sufix + '.iter1.nii.gz')),
+        (worker['predictors'][1], os.path.join(path, 't' + case + final_s + sufix + '.iter2.nii.gz'))
+    ]:
+        try:
+            image_nii = load_nii(outputname)
+            image = image_nii.get_data()
+        except IOError:
+            image_nii = load_nii(os.path.join(path, options['image_folder'], options['flair_f']))
+            image = test_net(
+                net,
+                names_test,
+                mask_nii.get_data(),
+                options['batch_size'],
+                patch_size,
+                defo_size,
+                image_nii.get_data().shape,
+                images,
+                defo_names_test,
+                predictor=predictor
+            )
+            image_nii.get_data()[:] = image
+            image_nii.to_filename(outputname)
+        results.append(image)
+        outputnames.append(outputname)
+
+    image1, image2 = results
+    image_nii.get_data()[:] = image1 * image2
+    outputname_mult = os.path.join(path, 't' + case + final_s + sufix + '.iter1_x_2.nii.gz')
+    image_nii.to_filename(outputname_mult)
+    image_nii.get_data()[:] = (image1 * image2) > 0.5
+    outputname_final = os.path.join(path, 't' + case + final_s + sufix + '.final.nii.gz')
+    image_nii.to_filename(outputname_final)
+
+    return case, outputnames + [outputname_mult, outputname_final]
+
+
+def main():
+    options = parse_inputs()
+    c = color_codes()
+
+    if options['greenspan'] or options['hard_mining']:
+        print(c['r'] + 'Only the nets trained with two iterations are supported' + c['nc'])
+        return
+
+    errors = filter(None, [check_weights(net_name) for net_name in get_net_names(options)])
+    if errors:
+        for error in errors:
+            print(c['r'] + error + c['nc'])
+        return
+
+    patients = options['patients']
+    n_patients = len(patients)
+    print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + 'Starting the segmentation of ' +
+          c['b'] + '%d' % n_patients + c['nc'] + c['c'] + ' patients with ' +
+          c['b'] + '%d' % options['workers'] + c['nc'] + c['c'] + ' workers' + c['nc'])
+    pool = Pool(options['workers'], initializer=init_worker, initargs=(options,))
+    try:
+        for i, (case, outputnames) in enumerate(pool.imap_unordered(test_patient, patients)):
+            print(c['c'] + '[' + strftime("%H:%M:%S") + ']  ' + c['nc'] + 'Patient ' + c['b'] + case + c['nc'] +
+                  c['g'] + ' (%d/%d)' % (i + 1, n_patients) + c['nc'])
+            for outputname in outputnames:
+                print(c['g'] + '                   -- Saved image ' + c['b'] + outputname + c['nc'])
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+if __name__ == '__main__':
+    main()
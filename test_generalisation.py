@@ -1,5 +1,4 @@
 from __future__ import print_function
-import pickle
 import argparse
 import os
 from time import strftime
@@ -10,7 +9,9 @@ from data_creation import save_nifti
 from nibabel import load as load_nii
 # from data_manipulation.metrics import dsc_seg, tp_fraction_seg, fp_fraction_seg
 from scipy.ndimage.interpolation import zoom
-from utils import color_codes, WeightsLogger
+from utils import color_codes
+from compile_cache import NetworkPool
+from checkpoint import save_checkpoint, load_weights
 from train_test_longitudinal import get_defonames_from_path, get_names_from_path, test_net, train_net
 import itertools
 
@@ -25,6 +26,8 @@ def parse_inputs():
     parser.add_argument('-d', '--dense-size', dest='dense_size', type=int, default=256)
     parser.add_argument('-e', '--epochs', action='store', dest='epochs', type=int, default=500)
     parser.add_argument('-l', '--last-width', action='store', dest='last_width', type=int, default=3)
+    parser.add_argument('--compile-cache', action='store', dest='cache_dir', default=None)
+    parser.add_argument('--memory-budget', dest='memory_budget', type=float, default=None)
     parser.add_argument('--image-folder', dest='image_folder', default='time2/preprocessed/')
     parser.add_argument('--deformation-folder', dest='defo_folder', default='time2/deformation/')
     parser.add_argument('--flair-baseline', action='store', dest='flair_b', default='flair_moved.nii.gz')
@@ -58,6 +61,9 @@ def train_all_nets(
         dense_sizes,
         epochs,
         seed,
+        cache_dir=None,
+        net_pool=None,
+        memory_budget=None
 ):
     # We need to prepare the name list to load the leave-one-out data.
     # Since these names are common for all the nets, we can define them before looping.
@@ -97,11 +103,13 @@ def train_all_nets(
             defo=True,
             patience=epochs,
             name=net_name,
-            epochs=epochs
+            epochs=epochs,
+            cache_dir=cache_dir
         )
+        net = net_pool.acquire(net) if net_pool is not None else net
         # First we check that we did not train that patient, in order to save time
         try:
-            net.load_params_from(net_name + 'model_weights.pkl')
+            load_weights(net, net_name + 'model_weights.ckpt')
         except IOError:
             combo_s = ' [c%d.k%d.d%d.n%d]' % (
                 blocks,
@@ -126,18 +134,16 @@ def train_all_nets(
                 net=net,
                 x_train=(zoom(x_train[0], patch_ratio), zoom(x_train[1], defo_ratio)),
                 y_train=y_train,
-                images=images
+                images=images,
+                memory_budget=memory_budget
             ) if max_patch != patch else train_net(
                 net=net,
                 x_train=x_train,
                 y_train=y_train,
-                images=images
+                images=images,
+                memory_budget=memory_budget
             )
-            for callback in net.on_epoch_finished:
-                if isinstance(callback, WeightsLogger):
-                    callback.save()
-            with open(net_name + 'layers.pkl', 'wb') as fnet:
-                pickle.dump(net.layers, fnet, -1)
+            save_checkpoint(net, net_name + 'model.ckpt')
         nets.append(net)
 
     return nets
@@ -157,7 +163,8 @@ def test_all_nets(
         n_filters,
         sufixes,
         iter_name,
-        train_case=False
+        train_case=False,
+        memory_budget=None
 ):
     c = color_codes()
     net_combos = itertools.product(zip(patch_sizes, defo_sizes), n_filters, dense_sizes)
@@ -193,7 +200,8 @@ def test_all_nets(
                 defo_size=defo_size,
                 image_size=image_nii.get_data().shape,
                 images=['flair', 'pd', 't2'],
-                d_names=defo_names_test
+                d_names=defo_names_test,
+                memory_budget=memory_budget
             )
 
             if train_case:
@@ -224,6 +232,8 @@ def main():
     patch_sizes = [(width, width, width) for width in patch_widths]
     pool_size = 1
     batch_size = 100000
+    # The memory budget is given in GB
+    memory_budget = int(options['memory_budget'] * 2**30) if options['memory_budget'] else None
     dense_sizes = [16, 64, 128, 256]
     n_filters = [32, 64]
 
@@ -259,6 +269,8 @@ def main():
 
     print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + 'Starting leave-one-out' + c['nc'])
     # Leave-one-out main loop (we'll do 2 training iterations with testing for each patient)
+    # Each configuration is only compiled once, the nets of the following patients reuse it
+    net_pool = NetworkPool()
     for i in range(0, n_patients):
         # Prepare the data relevant to the leave-one-out (subtract the patient from the dataset and set the path)
         # Also, prepare the network
@@ -293,7 +305,10 @@ def main():
             pool_size=pool_size,
             dense_sizes=dense_sizes,
             epochs=epochs,
-            seed=seed
+            seed=seed,
+            cache_dir=options['cache_dir'],
+            net_pool=net_pool,
+            memory_budget=memory_budget
         )
 
         # Then we test the net.
@@ -315,7 +330,8 @@ def main():
             dense_sizes=dense_sizes,
             n_filters=n_filters,
             sufixes=sufixes,
-            iter_name='.generalise'
+            iter_name='.generalise',
+            memory_budget=memory_budget
         )
 
 
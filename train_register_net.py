@@ -7,6 +7,7 @@ import numpy as np
 from nets import create_cnn3d_register
 from utils import color_codes, random_affine3d_matrix
 from data_creation import load_register_data
+from checkpoint import load_weights
 
 
 def parse_inputs():
@@ -17,6 +18,10 @@ def parse_inputs():
     parser.add_argument('-c', '--conv-blocks', dest='conv_blocks', type=int, default=2)
     parser.add_argument('-n', '--num-filters', action='store', dest='number_filters', type=int, default=32)
     parser.add_argument('-a', '--augment-percentage', dest='augment_p', type=float, default=0.10)
+    parser.add_argument('-B', '--augment-bank', dest='bank_size', type=int, default=None)
+    parser.add_argument('-L', '--levels', dest='levels', type=int, default=None)
+    parser.add_argument('-s', '--stride', dest='stride', type=int, default=1)
+    parser.add_argument('--compile-cache', action='store', dest='cache_dir', default=None)
     parser.add_argument('-i', '--input', action='store', dest='input_size', nargs='+', type=int, default=[32, 32, 32])
     parser.add_argument('--baseline-folder', action='store', dest='b_folder', default='time1/preprocessed')
     parser.add_argument('--followup-folder', action='store', dest='f_folder', default='time2/preprocessed')
@@ -129,11 +134,16 @@ def main():
     conv_blocks = options['conv_blocks']
 
     augment_p = options['augment_p']
+    bank_size = options['bank_size']
+    levels = options['levels']
+    stride = options['stride']
 
     seed = np.random.randint(np.iinfo(np.int32).max)
 
     input_size_s = 'x'.join([str(length) for length in input_size])
     sufix = 's%s.c%s.n%s.a%f' % (input_size_s, conv_width, n_filters, augment_p)
+    sufix += '.L%d' % levels if levels else ''
+    sufix += '.st%d' % stride if levels or stride > 1 else ''
     net_name = os.path.join(dir_name, 'deep-exp_registration.' + sufix + '.')
     net = create_cnn3d_register(
         input_shape=input_size,
@@ -144,7 +154,11 @@ def main():
         data_augment_p=augment_p,
         patience=100,
         name=net_name,
-        epochs=2000
+        epochs=2000,
+        bank_size=bank_size,
+        levels=levels,
+        stride=stride,
+        cache_dir=options['cache_dir']
     )
 
     print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' +
@@ -156,11 +170,12 @@ def main():
         names=names,
         image_size=input_size,
         seed=seed,
+        stride=stride
     )
 
     # We try to get the last weights to keep improving the net over and over
     try:
-        net.load_params_from(net_name + 'model_weights.pkl')
+        load_weights(net, net_name + 'model_weights.ckpt')
     except IOError:
         pass
 
@@ -1,36 +1,58 @@
 from __future__ import print_function
-import pickle
 import argparse
 import os
 import sys
 from time import strftime
 import numpy as np
-from nets import create_cnn3d_longitudinal, create_cnn3d_det_string, create_cnn_greenspan
+from nets import create_cnn3d_longitudinal, create_cnn3d_det_string, create_cnn_greenspan, reset_epoch_finished
 from data_creation import load_patch_batch_percent
 from data_creation import load_lesion_cnn_data
 from nibabel import load as load_nii
 from data_manipulation.metrics import dsc_seg, tp_fraction_seg, fp_fraction_seg
 from utils import color_codes
+from compile_cache import NetworkPool
+from inference import Predictor
+from memory import plan_training
+from numpy_runtime import export_net
+from checkpoint import save_checkpoint, load_weights, resume_training, SaveTrainingState
+from feature_cache import FrozenFeatures
+from training import ResidentTrainer, DataParallelTrainer, FixedSplit, as_list
+from hard_mining import HardNegativeMiner
 from lasagne.layers import DenseLayer
 
 
-def parse_inputs():
-    # I decided to separate this function, for easier acces to the command line parameters
-    parser = argparse.ArgumentParser(description='Test different nets with 3D data.')
+def get_parser(description='Test different nets with 3D data.'):
+    # The parser is shared with the scripts that reuse the nets trained here (test_cohort)
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument('-f', '--folder', dest='dir_name', default='/home/mariano/DATA/Subtraction/')
     parser.add_argument('-i', '--patch-width', dest='patch_width', type=int, default=9)
     parser.add_argument('-p', '--pool-size', dest='pool_size', type=int, default=2)
     parser.add_argument('-k', '--kernel-size', dest='conv_width', nargs='+', type=int, default=3)
     parser.add_argument('-c', '--conv-blocks', dest='conv_blocks', type=int, default=2)
     parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=10000)
+    parser.add_argument('--memory-budget', dest='memory_budget', type=float, default=None)
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-u', '--unbalanced', action='store_false', dest='balanced', default=True)
     group.add_argument('-U', '--unbalanced-freeze', action='store_true', dest='freeze', default=False)
+    parser.add_argument('--frozen-features', action='store_true', dest='frozen_features', default=False)
+    parser.add_argument('--feature-dir', dest='feature_dir', default=None)
+    parser.add_argument('--feature-dtype', dest='feature_dtype', choices=['float16', 'float32'], default=None)
+    parser.add_argument('--resident', action='store_true', dest='resident', default=False)
+    parser.add_argument('--steps-per-call', dest='steps_per_call', type=int, default=1)
+    parser.add_argument('--train-workers', dest='train_workers', type=int, default=None)
+    parser.add_argument('--hard-mining', action='store_true', dest='hard_mining', default=False)
+    parser.add_argument('--mining-pool', dest='mining_pool', type=int, default=20000)
+    parser.add_argument('--mining-refresh', dest='mining_refresh', type=int, default=5)
+    parser.add_argument('--snapshot-every', dest='snapshot_every', type=int, default=0)
+    parser.add_argument('--keyframe-every', dest='keyframe_every', type=int, default=10)
+    parser.add_argument('--keep-keyframes', dest='keep', type=int, default=None)
     parser.add_argument('-d', '--dense-size', dest='dense_size', type=int, default=256)
     parser.add_argument('-D', '--deformation', dest='deformation', type=int, default=0)
     parser.add_argument('-n', '--num-filters', action='store', dest='number_filters', nargs='+', type=int, default=[32])
     parser.add_argument('-l', '--layers', action='store', dest='layers', default='ca')
     parser.add_argument('-e', '--epochs', action='store', dest='epochs', type=int, default=1000)
+    parser.add_argument('-a', '--affine-augment', dest='affine_angle', type=float, default=None)
+    parser.add_argument('-s', '--symmetry-augment', dest='symmetry_p', type=float, default=None)
     parser.add_argument('--image-folder', dest='image_folder', default='time2/preprocessed/')
     parser.add_argument('--sub-folder', dest='sub_folder', default='time2/subtraction/')
     parser.add_argument('--deformation-folder', dest='defo_folder', default='time2/deformation/')
@@ -54,9 +76,51 @@ def parse_inputs():
     parser.add_argument('--brain-mask', action='store', dest='brain_mask', default='brainmask.nii.gz')
     parser.add_argument('--padding', action='store', dest='padding', default='valid')
     parser.add_argument('--register', action='store_true', dest='register', default=False)
+    parser.add_argument('--grouped', action='store_true', dest='grouped', default=False)
+    parser.add_argument('--compile-cache', action='store', dest='cache_dir', default=None)
+    parser.add_argument('--export', action='store_true', dest='export', default=False)
     parser.add_argument('--greenspan', action='store_true', dest='greenspan', default=False)
     parser.add_argument('-m', '--multi-channel', action='store_true', dest='multi', default=False)
-    return vars(parser.parse_args())
+    return parser
+
+
+def parse_inputs():
+    # I decided to separate this function, for easier acces to the command line parameters
+    return vars(get_parser().parse_args())
+
+
+def get_images(options):
+    flair_name = 'flair' if options['use_flair'] else None
+    pd_name = 'pd' if options['use_pd'] else None
+    t2_name = 't2' if options['use_t2'] else None
+    return filter(None, [flair_name, pd_name, t2_name])
+
+
+def get_sufix(options):
+    # Sufix that will be added to the results for the net and images
+    conv_blocks = options['conv_blocks']
+    n_filters = options['number_filters']
+    n_filters = n_filters if len(n_filters) > 1 else n_filters*conv_blocks
+    conv_width = options['conv_width']
+    conv_size = conv_width if isinstance(conv_width, list) else [conv_width]*conv_blocks
+    defo = options['deformation']
+    reg_s = '.reg' if options['register'] else ''
+    filters_s = 'n'.join(['%d' % nf for nf in n_filters])
+    conv_s = 'c'.join(['%d' % cs for cs in conv_size])
+    im_s = '.'.join(get_images(options))
+    mc_s = '.mc' if options['multi'] else ''
+    d_s = 'd%d.' % (conv_blocks*2+defo) if defo else ''
+    hm_s = '.hm' if options['hard_mining'] else ''
+    return '.greenspan' if options['greenspan'] else '%s.%s%s%s.p%d.c%s.n%s.d%d.e%d.pad_%s%s' %\
+        (mc_s, d_s, im_s, reg_s, options['patch_width'], conv_s, filters_s, options['dense_size'],
+         options['epochs'], options['padding'], hm_s)
+
+
+def get_final_sufix(options):
+    # Sufix of the second iteration (frozen convolutions and unbalanced data)
+    f_s = '.f' if options['freeze'] else ''
+    ub_s = '.ub' if not options['balanced'] or options['freeze'] else ''
+    return f_s + ub_s
 
 
 def get_names_from_path(path, options, patients=None):
@@ -124,6 +188,38 @@ def get_defonames_from_path(path, options, patients=None):
     return np.stack(filter(None, name_list))
 
 
+def get_inputs(
+        x,
+        images,
+        b_name='\033[30mbaseline_%s\033[0m',
+        f_name='\033[30mfollow_%s\033[0m',
+        d_name='\033[30mdeformation_%s\033[0m'
+):
+    # Dictionary of net inputs from the patches of load_lesion_cnn_data (and the deformations, if any)
+    d_inputs = []
+    n_images = len(images)
+    if isinstance(x, tuple):
+        x, defo = x
+        defo = np.split(defo, n_images, axis=1)
+        d_inputs = [(d_name % im, np.squeeze(d_im)) for im, d_im in zip(images, defo)]
+    n_channels = x.shape[1]
+    x = np.split(x, n_channels, axis=1)
+    b_inputs = [(b_name % im, x_im) for im, x_im in zip(images, x[:n_images])]
+    f_inputs = [(f_name % im, x_im) for im, x_im in zip(images, x[n_images:])]
+    return dict(b_inputs + f_inputs + d_inputs)
+
+
+def get_trainer(net, steps_per_call=None, workers=None):
+    # Object whose fit trains the net (a Trainer or the net itself)
+    if workers and workers > 1:
+        # Each minibatch is split between the worker processes and their gradients are averaged
+        return DataParallelTrainer(net, n_workers=workers)
+    if steps_per_call:
+        # The training set is kept in shared variables and the net only receives the minibatch indices
+        return ResidentTrainer(net, steps_per_call=steps_per_call)
+    return net
+
+
 def train_net(
         net,
         x_train,
@@ -131,25 +227,78 @@ def train_net(
         images,
         b_name='\033[30mbaseline_%s\033[0m',
         f_name='\033[30mfollow_%s\033[0m',
-        d_name='\033[30mdeformation_%s\033[0m'
+        d_name='\033[30mdeformation_%s\033[0m',
+        memory_budget=None,
+        frozen_features=None,
+        steps_per_call=None,
+        workers=None
 ):
-    defo = False
-    d_inputs = []
     c = color_codes()
-    n_images = len(images)
-    # We try to get the last weights to keep improving the net over and over
-    if isinstance(x_train, tuple):
-        defo = True
-        x_train, defo_train = x_train
-        defo_train = np.split(defo_train, len(images), axis=1)
-        d_inputs = [(d_name % im, np.squeeze(d_im)) for im, d_im in zip(images, defo_train)]
     print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Training' + c['nc'])
-    n_channels = x_train.shape[1]
-    x_train = np.split(x_train, n_channels, axis=1)
-    b_inputs = [(b_name % im, x_im) for im, x_im in zip(images, x_train[:n_images])]
-    f_inputs = [(f_name % im, x_im) for im, x_im in zip(images, x_train[n_images:])]
-    inputs = dict(b_inputs + f_inputs) if not defo else dict(b_inputs + f_inputs + d_inputs)
-    net.fit(inputs, y_train)
+    inputs = get_inputs(x_train, images, b_name, f_name, d_name)
+    if frozen_features is not None:
+        # Only the head of the net is trained (on the outputs of the frozen layers, computed once)
+        print('                Computing the features of the frozen layers')
+        head = FrozenFeatures(net, memory_budget=memory_budget, **frozen_features)
+        inputs = head.features(inputs)
+        net = head.head_net
+    elif memory_budget:
+        plan_training(net, memory_budget)
+        print('                Training batch size = %d' % net.batch_iterator_train.batch_size)
+    trainer = get_trainer(net, steps_per_call, workers)
+    # If the training was interrupted, it continues from the last training state (the optimiser
+    # state of a trainer is part of it, so the trainer has to exist before resuming)
+    epochs = resume_training(net)
+    if epochs is not None:
+        print('                Resuming the training from epoch %d' % len(net.train_history_))
+        if epochs <= 0:
+            return
+    trainer.fit(inputs, y_train, epochs=epochs)
+
+
+def train_hard_mining(net, miner, images, refresh=5, memory_budget=None, steps_per_call=None, workers=None):
+    # The training set is sampled again (favouring the negatives with a higher loss) every refresh epochs.
+    # The trainer (with its optimiser state) and the validation set are the same for the whole training
+    # and the training state is only removed when all the epochs are finished.
+    c = color_codes()
+    if memory_budget:
+        plan_training(net, memory_budget)
+        print('                Training batch size = %d' % net.batch_iterator_train.batch_size)
+    x_valid, y_valid = miner.validation()
+    net.train_split = FixedSplit(get_inputs(x_valid, images), y_valid)
+    trainer = get_trainer(net, steps_per_call, workers)
+
+    handlers = as_list(net.on_training_finished)
+    remove_state = [h for h in handlers if isinstance(getattr(h, '__self__', None), SaveTrainingState)]
+    finished = list()
+    net.on_training_finished = [h for h in handlers if h not in remove_state] +\
+        [lambda nn, train_history: finished.append(len(train_history))]
+
+    if resume_training(net) is not None:
+        print('                Resuming the training from epoch %d' % len(net.train_history_))
+    predictor = Predictor(net, memory_budget)
+    interrupted = False
+    while len(net.train_history_) < net.max_epochs:
+        n_epochs = len(net.train_history_)
+        epochs = min(refresh, net.max_epochs - n_epochs)
+        x_train, y_train = miner.sample()
+        print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Training' + c['nc'])
+        del finished[:]
+        trainer.fit(get_inputs(x_train, images), y_train, epochs=epochs)
+        if not finished:
+            # The training was interrupted (fit does not finish it), so the state is kept to resume it
+            interrupted = True
+            break
+        if len(net.train_history_) - n_epochs < epochs:
+            # Early stopping
+            break
+        print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] + 'Scoring the candidate negatives' + c['nc'])
+        miner.score(lambda x: predictor.predict_proba(get_inputs(x, images)))
+
+    net.on_training_finished = handlers
+    if not interrupted:
+        for finish in remove_state:
+            finish(net, net.train_history_)
 
 
 def train_greenspan(
@@ -188,8 +337,11 @@ def test_net(
         d_names=None,
         b_name='\033[30mbaseline_%s\033[0m',
         f_name='\033[30mfollow_%s\033[0m',
-        d_name='\033[30mdeformation_%s\033[0m'
+        d_name='\033[30mdeformation_%s\033[0m',
+        predictor=None,
+        memory_budget=None
 ):
+    predictor = Predictor(net, memory_budget) if predictor is None else predictor
     defo = False
     d_inputs = []
     n_images = len(images)
@@ -214,7 +366,7 @@ def test_net(
         b_inputs = [(b_name % im, x_im) for im, x_im in zip(images, batch[:n_images])]
         f_inputs = [(f_name % im, x_im) for im, x_im in zip(images, batch[n_images:])]
         inputs = dict(b_inputs + f_inputs) if not defo else dict(b_inputs + f_inputs + d_inputs)
-        y_pred = net.predict_proba(inputs)
+        y_pred = predictor.predict_proba(inputs)
         print('              %f%% of data tested' % percent, end='\r')
         sys.stdout.flush()
         [x, y, z] = np.stack(centers, axis=1)
@@ -232,9 +384,11 @@ def test_greenspan(
             image_size,
             images,
             b_name='\033[30mbaseline_%s\033[0m',
-            f_name='\033[30mfollow_%s\033[0m'
+            f_name='\033[30mfollow_%s\033[0m',
+            predictor=None,
+            memory_budget=None
 ):
-
+    predictor = Predictor(net, memory_budget) if predictor is None else predictor
     n_axis = len(images)
     n_images = len(names) / 2
     test = np.zeros(image_size)
@@ -245,7 +399,7 @@ def test_greenspan(
         b_inputs = [(b_name % im, np.squeeze(x_im[:, :, :n_images, :, :])) for im, x_im in zip(images, batch)]
         f_inputs = [(f_name % im, np.squeeze(x_im[:, :, n_images:, :, :])) for im, x_im in zip(images, batch)]
         inputs = dict(b_inputs + f_inputs)
-        y_pred = net.predict_proba(inputs)
+        y_pred = predictor.predict_proba(inputs)
         print('              %f%% of data tested' % percent, end='\r')
         sys.stdout.flush()
         [x, y, z] = np.stack(centers, axis=1)
@@ -264,8 +418,41 @@ def main():
     defo = options['deformation']
     layers = ''.join(options['layers'])
     greenspan = options['greenspan']
+    # With hard negative mining, the first net is the final one (there is no second iteration)
+    hard_mining = options['hard_mining'] and not greenspan
+    single_iteration = greenspan or hard_mining
     freeze = options['freeze']
     balanced = options['balanced'] if not freeze else False
+    affine_angle = options['affine_angle']
+    symmetry_p = options['symmetry_p']
+    grouped = options['grouped']
+    cache_dir = options['cache_dir']
+    export = options['export']
+    if export and (register or multi and ('t' in layers or 'M' in layers)):
+        # The exported models are run by numpy_runtime, which has no spatial transformers or max unpooling
+        print(c['r'] + 'The nets with spatial transformers or max unpooling can not be exported' + c['nc'])
+        return
+    if options['train_workers'] and options['train_workers'] > 1:
+        # Every net of this script has batch normalisation, that DataParallelTrainer does not support
+        print(c['r'] + 'The nets with batch normalisation can not be trained with --train-workers' + c['nc'])
+        return
+    if symmetry_p and options['resident']:
+        # The resident trainer takes its minibatches without the training batch iterator
+        print(c['r'] + 'The symmetry augmentation can not be used with --resident' + c['nc'])
+        return
+    # With -U, only the dense layers can be trained on the cached outputs of the frozen layers
+    frozen_features = {
+        'dtype': options['feature_dtype'],
+        'directory': options['feature_dir']
+    } if freeze and options['frozen_features'] else None
+    steps_per_call = options['steps_per_call'] if options['resident'] else None
+    train_workers = options['train_workers']
+    # Weight snapshots every snapshot_every epochs (the full weights every keyframe_every snapshots)
+    snapshots = {
+        'snapshot_every': options['snapshot_every'],
+        'keyframe_every': options['keyframe_every'],
+        'keep': options['keep']
+    }
 
     # Prepare the net hyperparameters
     epochs = options['epochs']
@@ -274,6 +461,8 @@ def main():
     patch_size = (32, 32) if greenspan else (patch_width, patch_width, patch_width)
     pool_size = options['pool_size']
     batch_size = options['batch_size']
+    # The memory budget is given in GB
+    memory_budget = int(options['memory_budget'] * 2**30) if options['memory_budget'] else None
     dense_size = options['dense_size']
     conv_blocks = options['conv_blocks']
     n_filters = options['number_filters']
@@ -282,21 +471,8 @@ def main():
     conv_size = conv_width if isinstance(conv_width, list) else [conv_width]*conv_blocks
 
     # Prepare the sufix that will be added to the results for the net and images
-    use_flair = options['use_flair']
-    use_pd = options['use_pd']
-    use_t2 = options['use_t2']
-    flair_name = 'flair' if use_flair else None
-    pd_name = 'pd' if use_pd else None
-    t2_name = 't2' if use_t2 else None
-    images = filter(None, [flair_name, pd_name, t2_name])
-    reg_s = '.reg' if register else ''
-    filters_s = 'n'.join(['%d' % nf for nf in n_filters])
-    conv_s = 'c'.join(['%d' % cs for cs in conv_size])
-    im_s = '.'.join(images)
-    mc_s = '.mc' if multi else ''
-    d_s = 'd%d.' % (conv_blocks*2+defo) if defo else ''
-    sufix = '.greenspan' if greenspan else '%s.%s%s%s.p%d.c%s.n%s.d%d.e%d.pad_%s' %\
-        (mc_s, d_s, im_s, reg_s, patch_width, conv_s, filters_s, dense_size, epochs, padding)
+    images = get_images(options)
+    sufix = get_sufix(options)
 
     # Prepare the data names
     mask_name = options['mask']
@@ -321,6 +497,8 @@ def main():
     with open(metrics_file, 'w') as f:
 
         print(c['c'] + '[' + strftime("%H:%M:%S") + '] ' + 'Starting leave-one-out' + c['nc'])
+        # Each architecture is only compiled once, the following nets reuse the compiled functions
+        net_pool = NetworkPool()
         # Leave-one-out main loop (we'll do 2 training iterations with testing for each patient)
         for i in range(0, n_patients):
             # Prepare the data relevant to the leave-one-out (subtract the patient from the dataset and set the path)
@@ -335,16 +513,18 @@ def main():
                   '<Running iteration ' + c['b'] + '1' + c['nc'] + c['g'] + '>' + c['nc'])
             net_name = os.path.join(path, 'deep-longitudinal.init' + sufix + '.')
             if greenspan:
-                net = create_cnn_greenspan(
+                net = net_pool.acquire(create_cnn_greenspan(
                     input_channels=names.shape[0]/2,
                     patience=25,
                     name=net_name,
-                    epochs=500
-                )
+                    epochs=500,
+                    cache_dir=cache_dir,
+                    snapshots=snapshots
+                ))
                 images = ['axial', 'coronal', 'sagital']
             else:
                 if multi:
-                    net = create_cnn3d_det_string(
+                    net = net_pool.acquire(create_cnn3d_det_string(
                         cnn_path=layers,
                         input_shape=(None, names.shape[0], patch_width, patch_width, patch_width),
                         convo_size=conv_size,
@@ -355,10 +535,13 @@ def main():
                         patience=10,
                         multichannel=True,
                         name=net_name,
-                        epochs=100
-                    )
+                        epochs=100,
+                        symmetry_p=symmetry_p,
+                        cache_dir=cache_dir,
+                        snapshots=snapshots
+                    ))
                 else:
-                    net = create_cnn3d_longitudinal(
+                    net = net_pool.acquire(create_cnn3d_longitudinal(
                         convo_blocks=conv_blocks,
                         input_shape=(None, names.shape[0], patch_width, patch_width, patch_width),
                         images=images,
@@ -372,8 +555,12 @@ def main():
                         defo=defo,
                         patience=10,
                         name=net_name,
-                        epochs=100
-                    )
+                        epochs=100,
+                        symmetry_p=symmetry_p,
+                        grouped=grouped,
+                        cache_dir=cache_dir,
+                        snapshots=snapshots
+                    ))
 
             names_test = get_names_from_path(path, options)
             defo_names_test = get_defonames_from_path(path, options) if defo else None
@@ -382,7 +569,7 @@ def main():
 
             # First we check that we did not train for that patient, in order to save time
             try:
-                net.load_params_from(net_name + 'model_weights.pkl')
+                load_weights(net, net_name + 'model_weights.ckpt')
             except IOError:
                 print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' +
                       c['g'] + 'Loading the data for ' + c['b'] + 'iteration 1' + c['nc'])
@@ -393,25 +580,59 @@ def main():
                 wm_names = [os.path.join(p_path, wm_name) for p_path in paths]
                 pr_names = [os.path.join(p_path, sub_folder, sub_name) for p_path in paths]
 
-                x_train, y_train = load_lesion_cnn_data(
-                    names=names_lou,
-                    mask_names=mask_names,
-                    defo_names=defo_names_lou,
-                    roi_names=wm_names,
-                    pr_names=pr_names,
-                    patch_size=patch_size,
-                    defo_size=defo_size,
-                    random_state=seed
-                )
-
-                # Afterwards we train. Check the relevant training function.
-                if greenspan:
-                    x_train = np.swapaxes(x_train, 1, 2)
-                    train_greenspan(net, x_train, y_train, images)
+                if hard_mining:
+                    miner = HardNegativeMiner(
+                        names=names_lou,
+                        mask_names=mask_names,
+                        roi_names=wm_names,
+                        pr_names=pr_names,
+                        defo_names=defo_names_lou,
+                        patch_size=patch_size,
+                        defo_size=defo_size,
+                        pool_size=options['mining_pool'],
+                        random_state=seed
+                    )
+                    train_hard_mining(
+                        net,
+                        miner,
+                        images,
+                        refresh=options['mining_refresh'],
+                        memory_budget=memory_budget,
+                        steps_per_call=steps_per_call,
+                        workers=train_workers
+                    )
+                    save_checkpoint(net, net_name + 'model.ckpt')
                 else:
-                    train_net(net, x_train, y_train, images)
-                    with open(net_name + 'layers.pkl', 'wb') as fnet:
-                        pickle.dump(net.layers, fnet, -1)
+                    x_train, y_train = load_lesion_cnn_data(
+                        names=names_lou,
+                        mask_names=mask_names,
+                        defo_names=defo_names_lou,
+                        roi_names=wm_names,
+                        pr_names=pr_names,
+                        patch_size=patch_size,
+                        defo_size=defo_size,
+                        random_state=seed,
+                        affine_angle=affine_angle
+                    )
+
+                    # Afterwards we train. Check the relevant training function.
+                    if greenspan:
+                        x_train = np.swapaxes(x_train, 1, 2)
+                        train_greenspan(net, x_train, y_train, images)
+                    else:
+                        train_net(
+                            net,
+                            x_train,
+                            y_train,
+                            images,
+                            memory_budget=memory_budget,
+                            steps_per_call=steps_per_call,
+                            workers=train_workers
+                        )
+                        save_checkpoint(net, net_name + 'model.ckpt')
+            # The exported models can be used without Theano (see segmentation_service)
+            if export and not greenspan:
+                export_net(net, net_name + 'model.npz')
             # Then we test the net. Again we save time by checking if we already tested that patient.
             try:
                 image_nii = load_nii(outputname1)
@@ -429,7 +650,8 @@ def main():
                         batch_size,
                         patch_size,
                         image_nii.get_data().shape,
-                        images
+                        images,
+                        memory_budget=memory_budget
                     )
                 else:
                     image1 = test_net(
@@ -441,12 +663,13 @@ def main():
                         defo_size,
                         image_nii.get_data().shape,
                         images,
-                        defo_names_test
+                        defo_names_test,
+                        memory_budget=memory_budget
                     )
                 image_nii.get_data()[:] = image1
                 image_nii.to_filename(outputname1)
-            if greenspan:
-                # Since Greenspan did not use two iterations, we must get the final mask here.
+            if single_iteration:
+                # Since Greenspan (and hard negative mining) did not use two iterations, we get the final mask here.
                 outputname_final = os.path.join(path, 't' + case + sufix + '.final.nii.gz')
                 mask_nii.get_data()[:] = (image1 > 0.5).astype(dtype=np.int8)
                 mask_nii.to_filename(outputname_final)
@@ -485,7 +708,8 @@ def main():
                             defo_size,
                             image_nii.get_data().shape,
                             images,
-                            d_patient
+                            d_patient,
+                            memory_budget=memory_budget
                         )
 
                         print(c['g'] + '                   -- Saving image ' + c['b'] + outputname + c['nc'])
@@ -497,13 +721,11 @@ def main():
                 # the same as the training of the first iteration.
                 print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] +
                       '<Running iteration ' + c['b'] + '2' + c['nc'] + c['g'] + '>' + c['nc'])
-                f_s = '.f' if freeze else ''
-                ub_s = '.ub' if not balanced else ''
-                final_s = f_s + ub_s
+                final_s = get_final_sufix(options)
                 outputname2 = os.path.join(path, 't' + case + final_s + sufix + '.iter2.nii.gz')
                 net_name = os.path.join(path, 'deep-longitudinal.final' + final_s + sufix + '.')
                 if multi:
-                    net = create_cnn3d_det_string(
+                    net = net_pool.acquire(create_cnn3d_det_string(
                         cnn_path=layers,
                         input_shape=(None, names.shape[0], patch_width, patch_width, patch_width),
                         convo_size=conv_size,
@@ -514,11 +736,14 @@ def main():
                         patience=50,
                         multichannel=True,
                         name=net_name,
-                        epochs=epochs
-                    )
+                        epochs=epochs,
+                        symmetry_p=symmetry_p,
+                        cache_dir=cache_dir,
+                        snapshots=snapshots
+                    ))
                 else:
                     if not freeze:
-                        net = create_cnn3d_longitudinal(
+                        net = net_pool.acquire(create_cnn3d_longitudinal(
                             convo_blocks=conv_blocks,
                             input_shape=(None, names.shape[0], patch_width, patch_width, patch_width),
                             images=images,
@@ -532,18 +757,22 @@ def main():
                             defo=defo,
                             patience=50,
                             name=net_name,
-                            epochs=epochs
-                        )
+                            epochs=epochs,
+                            symmetry_p=symmetry_p,
+                            grouped=grouped,
+                            cache_dir=cache_dir,
+                            snapshots=snapshots
+                        ))
                     else:
                         net.max_epochs = epochs
-                        net.on_epoch_finished[0].name = net_name + 'model_weights.pkl'
+                        reset_epoch_finished(net, net_name)
                         for layer in net.get_all_layers():
                             if not isinstance(layer, DenseLayer):
                                 for param in layer.params:
                                     layer.params[param].discard('trainable')
 
                 try:
-                    net.load_params_from(net_name + 'model_weights.pkl')
+                    load_weights(net, net_name + 'model_weights.ckpt')
                 except IOError:
                     print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' +
                           c['g'] + 'Loading the data for ' + c['b'] + 'iteration 2' + c['nc'])
@@ -564,12 +793,23 @@ def main():
                         patch_size=patch_size,
                         defo_size=defo_size,
                         random_state=seed,
-                        balanced=balanced
+                        balanced=balanced,
+                        affine_angle=affine_angle
                     )
 
-                    train_net(net, x_train, y_train, images)
-                    with open(net_name + 'layers.pkl', 'wb') as fnet:
-                        pickle.dump(net.layers, fnet, -1)
+                    train_net(
+                        net,
+                        x_train,
+                        y_train,
+                        images,
+                        memory_budget=memory_budget,
+                        frozen_features=frozen_features,
+                        steps_per_call=steps_per_call,
+                        workers=train_workers
+                    )
+                    save_checkpoint(net, net_name + 'model.ckpt')
+                if export:
+                    export_net(net, net_name + 'model.npz')
                 try:
                     image_nii = load_nii(outputname2)
                     image2 = image_nii.get_data()
@@ -587,7 +827,8 @@ def main():
                         defo_size,
                         image_nii.get_data().shape,
                         images,
-                        defo_names_test
+                        defo_names_test,
+                        memory_budget=memory_budget
                     )
 
                     image_nii.get_data()[:] = image2
@@ -607,31 +848,31 @@ def main():
             # I plan on replicating Challenge's 2008 evaluation measures here.
             gt = load_nii(os.path.join(path, mask_name)).get_data().astype(dtype=np.bool)
             seg1 = image1 > 0.5
-            if not greenspan:
+            if not single_iteration:
                 seg2 = image2 > 0.5
             dsc1 = dsc_seg(gt, seg1)
-            if not greenspan:
+            if not single_iteration:
                 dsc2 = dsc_seg(gt, seg2)
-            if not greenspan:
+            if not single_iteration:
                 dsc_final = dsc_seg(gt, image)
             else:
                 dsc_final = dsc1
             tpf1 = tp_fraction_seg(gt, seg1)
-            if not greenspan:
+            if not single_iteration:
                 tpf2 = tp_fraction_seg(gt, seg2)
-            if not greenspan:
+            if not single_iteration:
                 tpf_final = tp_fraction_seg(gt, image)
             fpf1 = fp_fraction_seg(gt, seg1)
-            if not greenspan:
+            if not single_iteration:
                 fpf2 = fp_fraction_seg(gt, seg2)
-            if not greenspan:
+            if not single_iteration:
                 fpf_final = fp_fraction_seg(gt, image)
             print(c['c'] + '[' + strftime("%H:%M:%S") + ']    ' + c['g'] +
                   '<DSC ' + c['c'] + case + c['g'] + ' = ' + c['b'] + str(dsc_final) + c['nc'] + c['g'] + '>' + c['nc'])
             f.write('%s;Test 1; %f;%f;%f\n' % (case, dsc1, tpf1, fpf1))
-            if not greenspan:
+            if not single_iteration:
                 f.write('%s;Test 2; %f;%f;%f\n' % (case, dsc2, tpf2, fpf2))
-            if not greenspan:
+            if not single_iteration:
                 f.write('%s;Final; %f;%f;%f\n' % (case, dsc_final, tpf_final, fpf_final))
 
 
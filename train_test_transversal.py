@@ -8,6 +8,7 @@ from nets import create_unet3d_det_string, create_unet3d_shortcuts_det_string
 from nets import create_unet3d_seg_string, create_unet3d_shortcuts_seg_string
 from nets import create_cnn3d_det_string
 from nibabel import load as load_nii
+from checkpoint import load_weights
 
 
 def get_sufix(use_flair, use_pd, use_t2, use_t1, use_gado):
@@ -174,7 +175,7 @@ def patches_network_detection(options, mode):
         print(c['g'] + '-- Training the ' + c['b'] + 'patch-based ' + c['b'] + mode + c['nc'])
         # We try to get the last weights to keep improving the net over and over
         try:
-            net.load_params_from(net_name + 'model_weights.pkl')
+            load_weights(net, net_name + 'model_weights.ckpt')
         except IOError:
             pass
 
@@ -278,7 +279,7 @@ def patches_network_segmentation(options, mode):
         print(c['g'] + '-- Training the ' + c['b'] + 'patch-based ' + c['b'] + mode + c['nc'])
         # We try to get the last weights to keep improving the net over and over
         try:
-            net.load_params_from(net_name + 'model_weights.pkl')
+            load_weights(net, net_name + 'model_weights.ckpt')
         except IOError:
             pass
 
@@ -0,0 +1,434 @@
+import ctypes
+import signal
+from collections import OrderedDict
+from multiprocessing import Process, Pipe
+from multiprocessing.sharedctypes import RawArray
+from time import time
+import numpy as np
+import theano
+import theano.tensor as T
+from lasagne.layers import get_output, get_all_layers, InputLayer, BatchNormLayer
+from sklearn.preprocessing import LabelEncoder
+from compile_cache import get_shared_inputs, reseed_random_states
+
+
+def as_list(handlers):
+    return handlers if isinstance(handlers, (list, tuple)) else [handlers]
+
+
+def get_loss(net, y_batch):
+    # Same training loss and training scores as the train_iter_ of a NeuralNet
+    layers = net.layers_
+    loss = net.objective(layers, target=y_batch, **net._get_params_for('objective'))
+    predict_proba = get_output(layers[-1], None, deterministic=True)
+    scores = [s[1](predict_proba, y_batch) for s in net.scores_train]
+    return loss, scores
+
+
+def get_gradients(net, loss):
+    # Gradients of the trainable parameters (scaled by their grad_scale tag, like nolearn)
+    params = net.get_all_params(trainable=True)
+    grads = theano.grad(loss, params)
+    for i, param in enumerate(params):
+        grad_scale = getattr(param.tag, 'grad_scale', 1)
+        if grad_scale != 1:
+            grads[i] *= grad_scale
+    return params, grads
+
+
+def get_updates(net, params, grads):
+    return net.update(grads, params, **net._get_params_for('update'))
+
+
+def average_outputs(outputs, sizes):
+    # Average of each output weighted by the batch sizes (as in NeuralNet.train_loop)
+    return [np.average([np.mean(o) for o in column], weights=sizes) for column in zip(*outputs)]
+
+
+class FixedSplit(object):
+    """
+    train_split for a NeuralNet (or a Trainer) that trains with all the
+    samples given to fit and always validates with the same set (like
+    training with a different sample of the training set on each fit).
+    """
+    def __init__(self, x_valid, y_valid):
+        self.x_valid = x_valid
+        self.y_valid = y_valid
+
+    def __call__(self, x, y, net):
+        return x, self.x_valid, y, self.y_valid
+
+
+class Trainer(object):
+    """
+    Base of the trainers that replace NeuralNet.fit. Subclasses implement
+    load (which receives the training split and returns its number of
+    samples) and train_epoch (which returns the training outputs of an
+    epoch, averaged like in NeuralNet.train_loop). release is called when
+    the training ends. The validation, the train_history_ entries and the
+    handlers of the net are the same as in NeuralNet.fit. The trainer is
+    stored in net.trainer_, so the training state of the net (see
+    checkpoint.save_training_state) has the shared variables of get_shared
+    instead of the ones of train_iter_.
+    """
+    def __init__(self, net):
+        net.initialize()
+        net.trainer_ = self
+        self.net = net
+        self.batch_size = net.batch_iterator_train.batch_size
+        self.input_layers = [layer for layer in net.layers_.values() if isinstance(layer, InputLayer)]
+
+    def get_shared(self):
+        # Shared variables (other than the parameters) updated by the training functions
+        return []
+
+    def load(self, x, y):
+        raise NotImplementedError
+
+    def train_epoch(self, n_samples):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+    def batches_finished(self, n_batches):
+        for _ in range(n_batches):
+            for func in as_list(self.net.on_batch_finished):
+                func(self.net, self.net.train_history_)
+
+    def validate(self, x, y):
+        # Same validation as NeuralNet.train_loop
+        net = self.net
+        outputs = list()
+        sizes = list()
+        custom_scores = [[] for _ in net.custom_scores] if net.custom_scores else []
+        for xb, yb in net.batch_iterator_test(x, y):
+            outputs.append(net.apply_batch_func(net.eval_iter_, xb, yb))
+            sizes.append(len(yb))
+            if net.custom_scores:
+                y_prob = net.apply_batch_func(net.predict_iter_, xb)
+                for (_, scorer), custom_score in zip(net.custom_scores, custom_scores):
+                    custom_score.append(scorer(yb, y_prob))
+        valid_outputs = average_outputs(outputs, sizes) if outputs else []
+        avg_custom_scores = np.average(custom_scores, weights=sizes, axis=1) if custom_scores and sizes else []
+        return valid_outputs, avg_custom_scores
+
+    def fit(self, x, y, epochs=None):
+        net = self.net
+        if net.check_input:
+            x, y = net._check_good_input(x, y)
+        if net.use_label_encoder:
+            net.enc_ = LabelEncoder()
+            y = net.enc_.fit_transform(y).astype(np.int32)
+            net.classes_ = net.enc_.classes_
+        try:
+            self.train_loop(x, y, epochs)
+        except KeyboardInterrupt:
+            pass
+        return net
+
+    def train_loop(self, x, y, epochs=None):
+        net = self.net
+        epochs = epochs or net.max_epochs
+        x_train, x_valid, y_train, y_valid = net.train_split(x, y, net)
+        n_samples = self.load(x_train, y_train)
+        del x_train, y_train
+        try:
+            self.run_epochs(n_samples, x_valid, y_valid, epochs)
+        finally:
+            self.release()
+
+    def run_epochs(self, n_samples, x_valid, y_valid, epochs):
+        net = self.net
+        history = net.train_history_
+        best_valid_loss = min([row['valid_loss'] for row in history]) if history else np.inf
+        best_train_loss = min([row['train_loss'] for row in history]) if history else np.inf
+        for func in as_list(net.on_training_started):
+            func(net, history)
+
+        num_epochs_past = len(history)
+        for epoch in range(1, epochs + 1):
+            t0 = time()
+            train_outputs = self.train_epoch(n_samples)
+            valid_outputs, custom_scores = self.validate(x_valid, y_valid)
+
+            if train_outputs[0] < best_train_loss:
+                best_train_loss = train_outputs[0]
+            if valid_outputs and valid_outputs[0] < best_valid_loss:
+                best_valid_loss = valid_outputs[0]
+
+            info = {
+                'epoch': num_epochs_past + epoch,
+                'train_loss': train_outputs[0],
+                'train_loss_best': best_train_loss == train_outputs[0],
+                'valid_loss': valid_outputs[0] if valid_outputs else np.nan,
+                'valid_loss_best': best_valid_loss == valid_outputs[0] if valid_outputs else np.nan,
+                'valid_accuracy': valid_outputs[1] if valid_outputs else np.nan,
+                'dur': time() - t0,
+            }
+            if len(custom_scores):
+                for (name, _), score in zip(net.custom_scores, custom_scores):
+                    info[name] = score
+            for index, (name, _) in enumerate(net.scores_train):
+                info[name] = train_outputs[index + 1]
+            for index, (name, _) in enumerate(net.scores_valid):
+                info[name] = valid_outputs[index + 2]
+            history.append(info)
+
+            try:
+                for func in as_list(net.on_epoch_finished):
+                    func(net, history)
+            except StopIteration:
+                break
+
+        for func in as_list(net.on_training_finished):
+            func(net, history)
+
+
+class ResidentTrainer(Trainer):
+    """
+    Trains a NeuralNet (like the ones from create_classifier_net) with its
+    training set stored in shared variables. The training samples are
+    shuffled and copied once and each call of the compiled step function
+    only receives the index of its minibatch (the batch is selected with
+    givens). With steps_per_call > 1, a scan runs that many minibatches
+    (with their updates) in each call. The batch size is the one of
+    net.batch_iterator_train, but its data augmentation is not applied.
+    """
+    def __init__(self, net, steps_per_call=1, seed=None):
+        super(ResidentTrainer, self).__init__(net)
+        self.steps_per_call = steps_per_call
+        self.random = np.random.RandomState(seed)
+        self.y_batch = net.y_tensor_type('y_batch')
+        self.x_shared = OrderedDict(
+            (layer.input_var, theano.shared(
+                np.empty((0,) + tuple(layer.shape[1:]), dtype=layer.input_var.dtype),
+                name=layer.name
+            ))
+            for layer in self.input_layers
+        )
+        self.y_shared = theano.shared(np.empty((0,), dtype=self.y_batch.dtype), name='y')
+        self.step = self.compile()
+
+    def get_shared(self):
+        # State of the update rule and random streams (the training set is not part of it)
+        data = set(id(v) for v in self.x_shared.values() + [self.y_shared])
+        return [v for v in get_shared_inputs(self.step) if id(v) not in data]
+
+    def get_batch(self, index):
+        # Replacements of the inputs and the targets with their minibatch
+        batch = slice(index * self.batch_size, (index + 1) * self.batch_size)
+        replace = OrderedDict((var, x[batch]) for var, x in self.x_shared.items())
+        replace[self.y_batch] = self.y_shared[batch]
+        return replace
+
+    def compile(self):
+        loss, scores = get_loss(self.net, self.y_batch)
+        params, grads = get_gradients(self.net, loss)
+        updates = get_updates(self.net, params, grads)
+        outputs = [loss] + scores
+
+        if self.steps_per_call == 1:
+            index = T.lscalar('index')
+            return theano.function(
+                [index],
+                outputs,
+                updates=updates,
+                givens=self.get_batch(index),
+                name='resident_step'
+            )
+
+        def step(index):
+            replace = self.get_batch(index)
+            step_outputs = theano.clone(outputs + updates.values(), replace=replace)
+            return step_outputs[:len(outputs)], OrderedDict(zip(updates.keys(), step_outputs[len(outputs):]))
+
+        indices = T.lvector('indices')
+        scan_outputs, scan_updates = theano.scan(step, sequences=indices)
+        scan_outputs = scan_outputs if isinstance(scan_outputs, list) else [scan_outputs]
+        return theano.function([indices], scan_outputs, updates=scan_updates, name='resident_steps')
+
+    def load(self, x, y):
+        # Shuffled copies of the training set (keyed by input layer name) in the shared variables
+        x = x if isinstance(x, dict) else {self.input_layers[0].name: x}
+        order = self.random.permutation(len(y))
+        for layer in self.input_layers:
+            self.x_shared[layer.input_var].set_value(
+                np.asarray(x[layer.name], dtype=layer.input_var.dtype)[order],
+                borrow=True
+            )
+        self.y_shared.set_value(np.asarray(y, dtype=self.y_batch.dtype)[order], borrow=True)
+        return len(y)
+
+    def train_epoch(self, n_samples):
+        n_batches = (n_samples + self.batch_size - 1) // self.batch_size
+        sizes = [min(self.batch_size, n_samples - i * self.batch_size) for i in range(n_batches)]
+        order = self.random.permutation(n_batches)
+        outputs = list()
+        for i in range(0, n_batches, self.steps_per_call):
+            indices = order[i:i + self.steps_per_call]
+            if self.steps_per_call == 1:
+                outputs.append(self.step(indices[0]))
+            else:
+                outputs += zip(*self.step(indices))
+            self.batches_finished(len(indices))
+        return average_outputs(outputs, [sizes[i] for i in order])
+
+
+class SharedArrays(object):
+    """
+    Arrays with the shapes of a list of shared variables, stored in a single
+    block of shared memory (that forked processes can read and write).
+    """
+    def __init__(self, params):
+        dtype = np.dtype(theano.config.floatX)
+        shapes = [p.get_value(borrow=True).shape for p in params]
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        self.raw = RawArray(ctypes.c_char, max(1, sum(sizes) * dtype.itemsize))
+        flat = np.frombuffer(self.raw, dtype=dtype, count=sum(sizes))
+        offsets = np.cumsum([0] + sizes)
+        self.arrays = [flat[ini:end].reshape(shape) for ini, end, shape in zip(offsets[:-1], offsets[1:], shapes)]
+
+    def read(self, params):
+        for p, a in zip(params, self.arrays):
+            p.set_value(a)
+
+    def write(self, params):
+        for a, p in zip(self.arrays, params):
+            np.copyto(a, p.get_value(borrow=True))
+
+
+def weighted_sum(arrays, weights):
+    return sum(w * a for w, a in zip(weights, arrays))
+
+
+class DataParallelTrainer(Trainer):
+    """
+    Synchronous data-parallel training of a NeuralNet on the CPU. When the
+    training starts, n_workers processes are forked with a copy of the net
+    (and its compiled gradient function) and of the training split. Each
+    minibatch (with the size and shuffling of net.batch_iterator_train) is
+    split between the workers, that read the current parameters from shared
+    memory and write the gradients of their part back. The gradients are
+    averaged (weighted by the size of each part) and applied once with the
+    update rule of the net, so the updates are the same as training the
+    whole minibatch in one process (up to the random numbers of dropout).
+    That is not true with batch normalisation (each worker would normalise
+    with the statistics of its part), so nets with a BatchNormLayer are not
+    supported. The data augmentation of the batch iterator is not applied.
+    The random streams of each worker are reseeded with its index, so the
+    workers do not share their dropout masks. The optimiser state is the one of apply_gradients.
+    """
+    def __init__(self, net, n_workers=2):
+        super(DataParallelTrainer, self).__init__(net)
+        if any(isinstance(layer, BatchNormLayer) for layer in get_all_layers(net.layers_.values())):
+            raise ValueError('The data-parallel training of nets with batch normalisation is not supported')
+        self.n_workers = n_workers
+        self.shuffle = getattr(net.batch_iterator_train, 'shuffle', False)
+        y_batch = net.y_tensor_type('y_batch')
+        loss, scores = get_loss(net, y_batch)
+        self.params, grads = get_gradients(net, loss)
+        self.n_outputs = 1 + len(scores)
+        inputs = [theano.In(layer.input_var, name=layer.name) for layer in self.input_layers]
+        self.gradient = theano.function(
+            inputs + [theano.In(y_batch, name='y')],
+            [loss] + scores + grads,
+            allow_input_downcast=True,
+            name='gradient'
+        )
+        grad_inputs = [p.type() for p in self.params]
+        self.apply_gradients = theano.function(
+            grad_inputs,
+            [],
+            updates=get_updates(net, self.params, grad_inputs),
+            name='apply_gradients'
+        )
+        # The shared memory has to be allocated before forking the workers
+        self.shared_params = SharedArrays(self.params)
+        self.shared_grads = [SharedArrays(self.params) for _ in range(n_workers)]
+        self.x = None
+        self.y = None
+        self.seed = None
+        self.workers = list()
+        self.connections = list()
+
+    def get_shared(self):
+        # State of the update rule (the random streams of the workers are reseeded when they start)
+        return get_shared_inputs(self.apply_gradients)
+
+    def load(self, x, y):
+        # The workers are forked with the training split
+        x = x if isinstance(x, dict) else {self.input_layers[0].name: x}
+        self.x = dict((layer.name, x[layer.name]) for layer in self.input_layers)
+        self.y = y
+        self.seed = np.random.randint(np.iinfo(np.int32).max - self.n_workers)
+        for i in range(self.n_workers):
+            connection, worker_connection = Pipe()
+            worker = Process(target=self.work, args=(i, worker_connection))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+            self.connections.append(connection)
+        return len(y)
+
+    def release(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (IOError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join()
+        self.workers = list()
+        self.connections = list()
+        self.x = None
+        self.y = None
+
+    def work(self, i, connection):
+        # The main process handles the interruptions
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Otherwise, every worker would have the random streams of the main process
+        reseed_random_states([self.gradient], self.net, np.random.RandomState(self.seed + i))
+        while True:
+            indices = connection.recv()
+            if indices is None:
+                break
+            try:
+                self.shared_params.read(self.params)
+                outputs = self.gradient(
+                    y=self.y[indices],
+                    **dict((name, x_i[indices]) for name, x_i in self.x.items())
+                )
+                for a, g in zip(self.shared_grads[i].arrays, outputs[self.n_outputs:]):
+                    np.copyto(a, g)
+                connection.send([float(np.mean(o)) for o in outputs[:self.n_outputs]])
+            except Exception as e:
+                # Not every exception can be pickled
+                connection.send(RuntimeError('Worker %d: %s' % (i, e)))
+
+    def step(self, batch):
+        shards = [shard for shard in np.array_split(batch, self.n_workers) if len(shard)]
+        self.shared_params.write(self.params)
+        for connection, shard in zip(self.connections, shards):
+            connection.send(shard)
+        results = [connection.recv() for connection in self.connections[:len(shards)]]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        weights = [len(shard) / float(len(batch)) for shard in shards]
+        self.apply_gradients(*[
+            weighted_sum(grads, weights) for grads in zip(*[g.arrays for g in self.shared_grads[:len(shards)]])
+        ])
+        return [weighted_sum(outputs, weights) for outputs in zip(*results)]
+
+    def train_epoch(self, n_samples):
+        order = np.random.permutation(n_samples) if self.shuffle else np.arange(n_samples)
+        outputs = list()
+        sizes = list()
+        for i in range(0, n_samples, self.batch_size):
+            batch = order[i:i + self.batch_size]
+            outputs.append(self.step(batch))
+            sizes.append(len(batch))
+            self.batches_finished(1)
+        return average_outputs(outputs, sizes)
@@ -5,8 +5,10 @@ import nibabel as nib
 
 import re
 from math import floor
-import pickle
 import os
+import json
+import threading
+from Queue import Queue
 from scipy import ndimage as nd
 
 
@@ -108,11 +110,12 @@ def plot_layer_tree(final_layer):
     plt.show()
 
 
-def random_affine3d_matrix(x_range=np.pi, y_range=np.pi, z_range=np.pi, t_range=5):
-    x_angle = x_range * np.random.random() - (x_range / 2)
-    y_angle = y_range * np.random.random() - (y_range / 2)
-    z_angle = z_range * np.random.random() - (z_range / 2)
-    t = t_range * np.random.random(3) - (t_range / 2)
+def random_affine3d_matrix(x_range=np.pi, y_range=np.pi, z_range=np.pi, t_range=5, random=np.random):
+    # random can be a RandomState (by default, the global numpy generator is used)
+    x_angle = x_range * random.random() - (x_range / 2)
+    y_angle = y_range * random.random() - (y_range / 2)
+    z_angle = z_range * random.random() - (z_range / 2)
+    t = t_range * random.random(3) - (t_range / 2)
 
     sx = np.sin(x_angle)
     cx = np.cos(x_angle)
@@ -175,13 +178,20 @@ def remove_small_regions(path, file_str='.mask.', file_sufix='.s3', min_size=3):
         nib.save(nu_mask_nii, im.replace('.nii', file_sufix + '.nii'))
 
 
+def same_shapes(arrays, params):
+    # Whether a list of buffers (or None) can hold the values of params
+    return arrays is not None and len(arrays) == len(params) and\
+        all(a.shape == p.get_value(borrow=True).shape for a, p in zip(arrays, params))
+
+
 class EarlyStopping(object):
     """From https://github.com/dnouri/kfkd-tutorial"""
-    def __init__(self, patience=50):
+    def __init__(self, patience=50, checkpoints=None):
         self.patience = patience
         self.best_valid = np.inf
         self.best_valid_epoch = 0
-        self.best_weights = None
+        # The best weights are kept in the preallocated buffer of a CheckpointManager
+        self.checkpoints = CheckpointManager() if checkpoints is None else checkpoints
 
     def __call__(self, nn, train_history):
         current_valid = train_history[-1]['valid_loss']
@@ -195,29 +205,165 @@ class EarlyStopping(object):
         if current_valid < self.best_valid:
             self.best_valid = current_valid
             self.best_valid_epoch = current_epoch
-            self.best_weights = [w.get_value() for w in nn.get_all_params()]
+            self.checkpoints.store_best(nn, current_epoch, current_valid)
         elif self.best_valid_epoch + self.patience <= current_epoch:
             print('Early stopping.')
             print('Best valid loss was {:.6f} at epoch {}.'.format(
                 self.best_valid, self.best_valid_epoch))
-            nn.get_all_params_values()
+            self.checkpoints.restore_best(nn)
             raise StopIteration()
 
+    def reset(self):
+        # For a new training run
+        self.best_valid = np.inf
+        self.best_valid_epoch = 0
 
-class WeightsLogger(object):
-    """Based on EarlyStopping"""
-    def __init__(self, filename):
-        self.params = list()
+    def get_state(self):
+        # The best weights are part of the state of the CheckpointManager
+        return {'best_valid': float(self.best_valid), 'best_valid_epoch': self.best_valid_epoch}, []
+
+    def set_state(self, state, arrays):
+        self.best_valid = state['best_valid']
+        self.best_valid_epoch = state['best_valid_epoch']
+
+
+class CheckpointManager(object):
+    """
+    Keeps the weights of the best epoch in a buffer that is allocated once
+    (store_best and restore_best) and, as an on_epoch_finished handler,
+    writes the scores of each epoch to filename (one JSON object per line).
+    With snapshot_every > 0, the weights are also written to snapshot_dir
+    every snapshot_every epochs: the full weights every keyframe_every
+    snapshots and the difference with the previous snapshot otherwise. Only
+    the last keep keyframes (and their differences) are kept (all of them
+    with keep=None). The files are written by a background thread that
+    holds at most queue_size pending writes. finish (an on_training_finished
+    handler) waits for them.
+    """
+    def __init__(self, filename=None, snapshot_every=0, keyframe_every=10, keep=None, snapshot_dir=None, queue_size=4):
+        self.filename = filename
+        self.snapshot_every = snapshot_every
+        self.keyframe_every = keyframe_every
+        self.keep = keep
+        self.snapshot_dir = filename + '.snapshots' if snapshot_dir is None and filename else snapshot_dir
+        self.queue = Queue(maxsize=queue_size)
+        self.thread = None
+        self.best = None
+        self.best_epoch = None
+        self.best_loss = np.inf
+        self.previous = None
+        self.n_snapshots = 0
+        self.snapshots = list()
+
+    def reset(self, filename=None, snapshot_dir=None):
+        # For a new training run (with new files), once the pending writes of the last one are done
+        self.finish()
         self.filename = filename
+        self.snapshot_dir = filename + '.snapshots' if snapshot_dir is None and filename else snapshot_dir
+        self.best = None
+        self.best_epoch = None
+        self.best_loss = np.inf
+        self.previous = None
+        self.n_snapshots = 0
+        self.snapshots = list()
+
+    def store_best(self, nn, epoch, loss):
+        params = nn.get_all_params()
+        # The buffer is reallocated if the parameters change (like the head of a frozen net)
+        if not same_shapes(self.best, params):
+            self.best = [np.empty_like(p.get_value(borrow=True)) for p in params]
+        for b, p in zip(self.best, params):
+            np.copyto(b, p.get_value(borrow=True))
+        self.best_epoch = epoch
+        self.best_loss = loss
+
+    def restore_best(self, nn):
+        if self.best is None:
+            return False
+        for p, b in zip(nn.get_all_params(), self.best):
+            p.set_value(b)
+        return True
 
     def __call__(self, nn, train_history):
-        params = dict(
-            train=train_history[-1]['train_loss'],
-            valids=train_history[-1]['valid_loss'],
-            weights=nn.get_all_params()
+        epoch = train_history[-1]['epoch']
+        if self.filename:
+            scores = dict(
+                (k, v.item() if isinstance(v, np.generic) else v) for k, v in train_history[-1].items() if np.isscalar(v)
+            )
+            self.put(('scores', json.dumps(scores, sort_keys=True)))
+        if self.snapshot_every and epoch % self.snapshot_every == 0:
+            params = nn.get_all_params()
+            keyframe = self.n_snapshots % self.keyframe_every == 0
+            if not same_shapes(self.previous, params):
+                self.previous = [np.empty_like(p.get_value(borrow=True)) for p in params]
+            values = [p.get_value(borrow=True) for p in params]
+            arrays = [v.copy() if keyframe else v - prev for v, prev in zip(values, self.previous)]
+            for prev, v in zip(self.previous, values):
+                np.copyto(prev, v)
+            self.n_snapshots += 1
+            self.put(('snapshot', (epoch, keyframe, arrays)))
+
+    def get_state(self):
+        best = self.best if self.best is not None else []
+        previous = self.previous if self.previous is not None else []
+        state = {
+            'best_epoch': self.best_epoch,
+            'best_loss': float(self.best_loss),
+            'best': len(best),
+            'n_snapshots': self.n_snapshots,
+            'snapshots': list(self.snapshots)
+        }
+        return state, best + previous
+
+    def set_state(self, state, arrays):
+        n_best = state['best']
+        self.best = arrays[:n_best] if n_best else None
+        self.previous = arrays[n_best:] if len(arrays) > n_best else None
+        self.best_epoch = state['best_epoch']
+        self.best_loss = state['best_loss']
+        self.n_snapshots = state['n_snapshots']
+        self.snapshots = [tuple(snapshot) for snapshot in state['snapshots']]
+
+    def put(self, item):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, content = item
+            try:
+                if kind == 'scores':
+                    with open(self.filename, 'a') as f:
+                        f.write(content + '\n')
+                else:
+                    self.write_snapshot(*content)
+            except (IOError, OSError) as e:
+                print('Could not write the checkpoint %s (%s)' % (kind, e))
+
+    def write_snapshot(self, epoch, keyframe, arrays):
+        if not os.path.isdir(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        snapshot_name = os.path.join(
+            self.snapshot_dir,
+            'epoch_%04d.%s.npz' % (epoch, 'full' if keyframe else 'delta')
         )
-        self.params.append(params)
-
-    def save(self):
-        with open(self.filename, 'wb') as f:
-            pickle.dump(self.params, f, -1)
+        np.savez(snapshot_name, *arrays)
+        self.snapshots.append((keyframe, snapshot_name))
+        keyframes = [i for i, (k, _) in enumerate(self.snapshots) if k]
+        if self.keep and len(keyframes) > self.keep:
+            first = keyframes[-self.keep]
+            for _, old_name in self.snapshots[:first]:
+                os.remove(old_name)
+            self.snapshots = self.snapshots[first:]
+
+    def finish(self, nn=None, train_history=None):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None